@@ -0,0 +1,101 @@
+"""Deadline-bounded ("anytime") layout.
+
+A coarse but valid layout (plain layering plus normalization) is built first.
+The remaining time budget is spent on refinement passes, and a pass result is
+kept only when it lowers `layout_cost`. When the deadline expires, the best
+layout found so far is returned.
+
+Layering is made by `tube` steps, and the deadline is checked between them.
+When it expires before layering is done, the coarse layout is made instead:
+virtual layers with the width limit (`virtual_layers.place_rows`), which take
+time proportional to the graph size rather than to the amount of layers.
+Deadline is also checked between passes, so the last step or pass may overrun
+it by its own duration (and a coarse layout by the time to make and score it).
+"""
+
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+from siebenapp import RenderResult
+from compact import CompactGraph
+from refine import layout_cost, reduce_crossings, straighten_fakes
+from render import (
+    RenderStep,
+    add_fake_goals,
+    find_previous,
+    normalize_cols,
+    tube,
+    tube_with_fakes,
+    tweak_horizontal,
+)
+from virtual_layers import layout_rows, place_rows, virtual_layers
+
+# A single refinement pass over a normalized layout
+Refinement = Callable[[RenderResult], RenderResult]
+
+
+@dataclass
+class AnytimeResult:
+    rr: RenderResult
+    cost: float
+    elapsed: float
+    complete: bool  # True when refinement converged before the deadline
+    passes: list[str] = field(default_factory=list)  # accepted passes, in order
+    coarse: bool = False  # True when layering didn't fit and virtual layers were used
+
+
+def refinement_passes(width: int) -> list[tuple[str, Refinement]]:
+    return [
+        ("horizontal", lambda rr: tweak_horizontal(rr, width)),
+        ("crossings", reduce_crossings),
+        ("fakes", straighten_fakes),
+    ]
+
+
+def coarse_layout(rr: RenderResult, width: int, fake_goals: bool) -> RenderResult:
+    """Virtual layers with the width limit, normalized, without `tube` steps."""
+    g = CompactGraph.from_result(rr)
+    opts = layout_rows(g, place_rows(g, virtual_layers(g), width))
+    placed = RenderResult(rr.rows, node_opts=opts, select=rr.select, roots=rr.roots)
+    laid_out = normalize_cols(placed, width)
+    return add_fake_goals(laid_out, width) if fake_goals else laid_out
+
+
+def render_anytime(
+    rr: RenderResult,
+    width: int,
+    budget: float,
+    fake_goals: bool = False,
+    clock: Callable[[], float] = time.perf_counter,
+) -> AnytimeResult:
+    """Render `rr` spending no more than `budget` seconds on layering and
+    refinement."""
+    started = clock()
+    deadline = started + budget
+    layering = tube_with_fakes if fake_goals else tube
+    step = RenderStep(rr, list(rr.roots), [], find_previous(rr), {})
+    while step.roots and clock() < deadline:
+        step = layering(step, width)
+    if step.roots:
+        best = coarse_layout(rr, width, fake_goals)
+        elapsed = clock() - started
+        return AnytimeResult(best, layout_cost(best), elapsed, False, coarse=True)
+    best = normalize_cols(step.rr, width)
+    best_cost = layout_cost(best)
+    accepted: list[str] = []
+
+    improved = True
+    while improved:
+        improved = False
+        for name, fn in refinement_passes(width):
+            if clock() >= deadline:
+                elapsed = clock() - started
+                return AnytimeResult(best, best_cost, elapsed, False, accepted)
+            candidate = fn(best)
+            cost = layout_cost(candidate)
+            if cost < best_cost:
+                best, best_cost = candidate, cost
+                accepted.append(name)
+                improved = True
+    return AnytimeResult(best, best_cost, clock() - started, True, accepted)
@@ -0,0 +1,187 @@
+"""Choosing render width automatically.
+
+A graph is laid out with several candidate widths in parallel worker
+processes, every layout is scored, and the best one is returned. Score is
+`layout_cost` (crossings and horizontal edge length) plus the amount of fake
+goals long edges would need, all per edge, plus a penalty for the share of
+empty slots of the layers x width canvas. Without it, the cost just falls as
+the width grows (there are less layers, so long edges are shorter), and the
+top of any range wins.
+
+The graph is converted into `CompactGraph` arrays once, and the arrays are put
+into a single shared memory block. Workers get only its name and layout, so
+the graph is not serialized for every candidate.
+
+With a time budget, only candidates finished in time are compared (but at
+least one is always waited for). Candidates not started yet are cancelled;
+already running ones can't be interrupted and are left to finish in the
+background.
+"""
+
+import os
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, field, fields
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+from siebenapp import GoalIndex, RenderResult
+from compact import CompactGraph
+from refine import CROSSING_WEIGHT, crossings, edge_span, layer_span
+from virtual_layers import render_virtual
+
+# One fake goal is worth that many columns of total edge length
+FAKE_WEIGHT = 1.0
+
+# Cost of a completely empty layers x width canvas
+EMPTY_WEIGHT = 10.0
+
+# Arrays of `CompactGraph` put into shared memory
+ARRAYS = [f.name for f in fields(CompactGraph) if f.name != "index"]
+
+# Layout function used by workers: (graph, width) -> laid out graph
+Layout = Callable[[RenderResult, int], RenderResult]
+
+# Shared memory block name and (array name, dtype, length, offset) for arrays
+GraphSpec = tuple[str, list[tuple[str, str, int, int]]]
+
+
+class SharedGraph:
+    """Arrays of a `CompactGraph` in shared memory (without the goal index)."""
+
+    def __init__(self, g: CompactGraph):
+        arrays = [np.ascontiguousarray(getattr(g, name)) for name in ARRAYS]
+        layout = []
+        offset = 0
+        for name, array in zip(ARRAYS, arrays):
+            layout.append((name, array.dtype.str, len(array), offset))
+            # Keep every array aligned for any dtype
+            offset += -(-array.nbytes // 8) * 8
+        self.shm = SharedMemory(create=True, size=max(offset, 1))
+        for (_, _, _, start), array in zip(layout, arrays):
+            self.shm.buf[start : start + array.nbytes] = array.tobytes()
+        self.spec: GraphSpec = (self.shm.name, layout)
+
+    def close(self) -> None:
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach(spec: GraphSpec) -> tuple[CompactGraph, SharedMemory]:
+    """Read-only `CompactGraph` over a shared block; goal ids are goal numbers.
+
+    Keep the returned block open while the graph is used.
+    """
+    name, layout = spec
+    shm = SharedMemory(name=name)
+    arrays = {}
+    for array_name, dtype, length, offset in layout:
+        array = np.ndarray((length,), dtype, buffer=shm.buf, offset=offset)
+        array.flags.writeable = False
+        arrays[array_name] = array
+    size = len(arrays["offsets"]) - 1
+    return CompactGraph(GoalIndex.of_real(list(range(size))), **arrays), shm
+
+
+@dataclass
+class WidthScore:
+    width: int
+    crossings: int
+    edge_span: float
+    fakes: int
+    empty: float  # share of empty slots in layers x width
+    cost: float
+    elapsed: float
+
+
+@dataclass
+class AutoWidthResult:
+    rr: RenderResult
+    width: int
+    scores: list[WidthScore] = field(default_factory=list)  # finished candidates
+    complete: bool = True  # False when some candidates didn't fit into the budget
+
+
+def score_width(
+    spec: GraphSpec, width: int, layout: Layout
+) -> tuple[WidthScore, list[int], list[int]]:
+    """Lay out a shared graph with `width`, return its score and (rows, cols)
+    of goals by their numbers."""
+    started = time.perf_counter()
+    g, shm = attach(spec)
+    try:
+        laid_out = layout(g.to_result(), width)
+    finally:
+        del g
+        shm.close()
+    n_crossings = crossings(laid_out)
+    span = edge_span(laid_out)
+    edges = sum(len(row.edges) for row in laid_out.rows)
+    fakes = layer_span(laid_out) - edges
+    opts = [laid_out.node_opts[number] for number in range(len(laid_out.rows))]
+    layers = 1 + max((o["row"] for o in opts), default=0)
+    empty = 1 - len(opts) / (layers * width)
+    cost = (CROSSING_WEIGHT * n_crossings + span + FAKE_WEIGHT * fakes) / max(
+        edges, 1
+    ) + EMPTY_WEIGHT * empty
+    score = WidthScore(
+        width, n_crossings, span, fakes, empty, cost, time.perf_counter() - started
+    )
+    return score, [o["row"] for o in opts], [o["col"] for o in opts]
+
+
+def auto_width(
+    rr: RenderResult,
+    widths: Iterable[int] = range(2, 11),
+    budget: Optional[float] = None,
+    executor: Optional[Executor] = None,
+    layout: Layout = render_virtual,
+) -> AutoWidthResult:
+    """Render `rr` with the best of `widths`, spending about `budget` seconds.
+
+    `layout` has to be a module-level function, so workers can import it.
+    """
+    widths = list(widths)
+    g = CompactGraph.from_result(rr)
+    shared = SharedGraph(g)
+    own_executor = executor is None
+    if executor is None:
+        workers = min(len(widths), os.cpu_count() or 1)
+        executor = ProcessPoolExecutor(max_workers=workers)
+    pending: set[Future] = set()
+    try:
+        futures: list[Future] = [
+            executor.submit(score_width, shared.spec, width, layout)
+            for width in widths
+        ]
+        done, pending = wait(futures, timeout=budget)
+        if not done:
+            done, pending = wait(futures, return_when=FIRST_COMPLETED)
+        for future in pending:
+            future.cancel()
+    finally:
+        if own_executor:
+            executor.shutdown(wait=not pending, cancel_futures=True)
+        shared.close()
+
+    results = [f.result() for f in futures if f in done]
+    scores = sorted((r[0] for r in results), key=lambda s: s.width)
+    best, rows, cols = min(results, key=lambda r: (r[0].cost, r[0].width))
+    new_opts = {
+        goal_id: {"row": rows[number], "col": cols[number]}
+        for number, goal_id in enumerate(g.index)
+    }
+    return AutoWidthResult(
+        RenderResult(rr.rows, node_opts=new_opts, select=rr.select, roots=rr.roots),
+        best.width,
+        scores,
+        complete=not pending,
+    )
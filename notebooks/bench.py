@@ -0,0 +1,424 @@
+"""Benchmarks for layout stages.
+
+Run all of them with `python bench.py`, or only some: `python bench.py fake_goals`.
+"""
+
+import sys
+import time
+from typing import Any, Callable
+
+from sieben_example1 import EXAMPLE
+from sieben_random import random_tree
+
+BENCHMARKS: dict[str, Callable[[], None]] = {}
+
+
+def benchmark(fn: Callable[[], None]) -> Callable[[], None]:
+    BENCHMARKS[fn.__name__.removeprefix("bench_")] = fn
+    return fn
+
+
+def timed(fn: Callable[..., Any], *args, **kwargs) -> tuple[Any, float]:
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def table(header: list[str], rows: list[list[Any]]) -> None:
+    cells = [header] + [
+        [f"{v:.4f}" if isinstance(v, float) else str(v) for v in row] for row in rows
+    ]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(header))]
+    for row in cells:
+        print("  ".join(v.rjust(w) for v, w in zip(row, widths)))
+
+
+@benchmark
+def bench_fake_goals() -> None:
+    """Fake goals with and without edge concentration, and the time of adding
+    them plus a later pass over the result (crossing reduction)."""
+    from refine import fake_count, reduce_crossings
+    from render import add_fake_goals, render
+
+    width = 5
+    rows = []
+    for name, rr in [("example", EXAMPLE)] + [
+        (f"random {n}", random_tree(n, 1)) for n in (200, 1000, 2000)
+    ]:
+        laid_out = render(rr, width)
+        result = [name, len(rr.rows)]
+        for concentrate in (False, True):
+            with_fakes, t = timed(add_fake_goals, laid_out, width, concentrate)
+            _, t1 = timed(reduce_crossings, with_fakes)
+            result.extend([fake_count(with_fakes), t + t1])
+        rows.append(result)
+    table(["graph", "goals", "fakes", "time", "fakes (conc.)", "time (conc.)"], rows)
+
+
+@benchmark
+def bench_virtual_layers() -> None:
+    """Step-by-step `tube` vs the width limit on top of virtual layers."""
+    from render import layout_of, render
+    from virtual_layers import render_virtual
+
+    width = 5
+    rows = []
+    for n in (500, 2000, 5000):
+        rr = random_tree(n, 1)
+        result = [n]
+        for fn in (render, render_virtual):
+            laid_out, t = timed(fn, rr, width)
+            result.extend([1 + max(r for r, _ in layout_of(laid_out).values()), t])
+        rows.append(result)
+    table(["goals", "rows (tube)", "time (tube)", "rows (virt.)", "time (virt.)"], rows)
+
+
+@benchmark
+def bench_vertical() -> None:
+    """Spring energy before and after vertical relaxation, and its time."""
+    from compact import CompactGraph
+    from vertical import energy, solve_vertical, strengths
+    from virtual_layers import place_rows, virtual_layers
+
+    width = 5
+    rows = []
+    for n in (300, 1000, 3000):
+        g = CompactGraph.from_result(random_tree(n, 1))
+        initial = place_rows(g, virtual_layers(g), width)
+        result, t = timed(solve_vertical, g, initial, width)
+        before = energy(g, initial, strengths(g))
+        rows.append([n, before, result.energy, result.iterations, t])
+    table(["goals", "energy before", "energy after", "iterations", "time"], rows)
+
+
+@benchmark
+def bench_sqlite_loader() -> None:
+    """Loading a SiebenApp database and laying it out (with virtual layers):
+    through `RenderRow` objects vs right into compact arrays."""
+    import os
+    import tempfile
+
+    from compact import CompactGraph
+    from sqlite_loader import load_compact, load_result, save_result
+    from virtual_layers import place_rows, virtual_layers
+
+    def per_row(path: str) -> CompactGraph:
+        return CompactGraph.from_result(load_result(path))
+
+    width = 5
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in (10_000, 100_000):
+            path = os.path.join(tmp, f"{n}.db")
+            save_result(random_tree(n, 1), path)
+            for name, load in [("per-row", per_row), ("compact", load_compact)]:
+                g, t_load = timed(load, path)
+                _, t_layout = timed(lambda: place_rows(g, virtual_layers(g), width))
+                rows.append([n, name, t_load, t_layout, t_load + t_layout])
+    table(["goals", "loader", "load", "layout", "total"], rows)
+
+
+@benchmark
+def bench_layout_store() -> None:
+    """Render stages writing columns of a `LayoutStore` in place, reading the
+    result goal by goal, and memory of the store against a dict per goal."""
+    from render import build_with, layout_of, tube, tweak_horizontal
+
+    width = 5
+    rows = []
+    for n in (300, 1000, 3000):
+        rr = random_tree(n, 1)
+        step, t_layers = timed(build_with, rr, tube, width)
+        laid_out, t_tweak = timed(tweak_horizontal, step.rr, width)
+        _, t_read = timed(layout_of, laid_out)
+        store = laid_out.node_opts
+        dicts = store.to_dicts()
+        store_bytes = sum(c.nbytes for c in store.columns.values()) + sum(
+            p.nbytes for p in store.present.values()
+        )
+        dict_bytes = sum(
+            sys.getsizeof(opts) + sum(sys.getsizeof(v) for v in opts.values())
+            for opts in dicts.values()
+        )
+        rows.append([n, t_layers, t_tweak, t_read, store_bytes, dict_bytes])
+    table(["goals", "layers", "tweak", "read", "store bytes", "dict bytes"], rows)
+
+
+@benchmark
+def bench_auto_width() -> None:
+    """Widths chosen by `auto_width` from two ranges, with the time taken."""
+    from autowidth import auto_width
+
+    rows = []
+    for name, rr in [("example", EXAMPLE)] + [
+        (f"random {n}", random_tree(n, 1)) for n in (100, 500, 2000)
+    ]:
+        for top in (10, 20):
+            result, t = timed(auto_width, rr, range(2, top + 1))
+            best = next(s for s in result.scores if s.width == result.width)
+            rows.append([name, f"2..{top}", result.width, best.cost, best.empty, t])
+    table(["graph", "widths", "chosen", "cost", "empty", "time"], rows)
+
+
+def _edited(rr, edits: int):
+    """A copy of `rr` with some goals renamed, some edges and goals added, and
+    the last goal removed (with edges to it), plus another selection."""
+    from siebenapp import EdgeType, RenderResult, RenderRow
+
+    rows = list(rr.rows)
+    removed = rows.pop().goal_id
+    rows = [
+        RenderRow(
+            r.goal_id,
+            r.raw_id,
+            r.name,
+            r.is_open,
+            r.is_switchable,
+            [e for e in r.edges if e[0] != removed],
+            r.attrs,
+        )
+        if any(e[0] == removed for e in r.edges)
+        else r
+        for r in rows
+    ]
+    for i in range(edits):
+        r = rows[i * 97 % len(rows)]
+        new_edges = r.edges + [(len(rr.rows) + i + 1, EdgeType.PARENT)]
+        rows[i * 97 % len(rows)] = RenderRow(
+            r.goal_id, r.raw_id, f"{r.name}!", r.is_open, False, new_edges, r.attrs
+        )
+        goal_id = len(rr.rows) + i + 1
+        rows.append(RenderRow(goal_id, goal_id, f"new {i}", True, True, [], {}))
+    return RenderResult(rows, select=(2, 2), node_opts={}, roots=rr.roots)
+
+
+@benchmark
+def bench_diff() -> None:
+    """Diff of snapshots differing by a handful of edits: naive comparison of
+    rows by goal ids, and `diff` (first and second time). Edited snapshots
+    share unchanged rows with original ones; separately built snapshots have
+    to compare every row field by field."""
+    from diff import diff
+
+    def naive(old, new) -> int:
+        new_rows = {row.goal_id: row for row in new.rows}
+        return sum(1 for row in old.rows if new_rows.get(row.goal_id) != row)
+
+    rows = []
+    for n in (10_000, 100_000):
+        old = random_tree(n, 1)
+        new = _edited(old, 5)
+        _, t_naive = timed(naive, old, new)
+        result, t_cold = timed(diff, old, new)
+        _, t_warm = timed(diff, old, new)
+        separate = _edited(random_tree(n, 1), 5)
+        _, t_separate = timed(diff, old, separate)
+        changes = len(result.added_rows + result.removed_rows + result.modified_rows)
+        rows.append([n, changes, t_naive, t_cold, t_warm, t_separate])
+    header = ["goals", "changed rows", "naive", "diff", "diff again", "separate"]
+    table(header, rows)
+
+
+@benchmark
+def bench_edits() -> None:
+    """A stream of small edits (a goal added under the previous one, the oldest
+    goal removed): a new `RenderResult` per edit, and `apply` to a single one."""
+    from siebenapp import EdgeType, RenderEdit, RenderResult, RenderRow
+
+    def edits(rr, count: int):
+        for i in range(count):
+            parent = rr.rows[-1 - i].goal_id if i == 0 else 10**7 + i - 1
+            new = RenderRow(10**7 + i, 10**7 + i, f"new {i}", True, True, [], {})
+            yield parent, new, rr.rows[i].goal_id
+
+    def rebuild(rr, count: int) -> RenderResult:
+        for parent, new, removed in list(edits(rr, count)):
+            rows = [
+                RenderRow(
+                    r.goal_id,
+                    r.raw_id,
+                    r.name,
+                    r.is_open,
+                    r.is_switchable,
+                    [e for e in r.edges if e[0] != removed]
+                    + ([(new.goal_id, EdgeType.PARENT)] if r.goal_id == parent else []),
+                    r.attrs,
+                )
+                for r in rr.rows
+                if r.goal_id != removed
+            ]
+            rr = RenderResult(rows + [new], node_opts={}, roots=rr.roots - {removed})
+        return rr
+
+    def apply(rr, count: int) -> RenderResult:
+        rr = RenderResult(rr.rows, node_opts={}, roots=rr.roots)
+        for parent, new, removed in list(edits(rr, count)):
+            edges = rr.by_id(parent).edges + [(new.goal_id, EdgeType.PARENT)]
+            rr.apply(RenderEdit([new], {parent: edges}, [removed]))
+        return rr
+
+    rows = []
+    for n in (10_000, 100_000):
+        rr = random_tree(n, 1)
+        expected, t_rebuild = timed(rebuild, rr, 20)
+        result, t_apply = timed(apply, rr, 20)
+        assert result.rows == expected.rows
+        rows.append([n, 20, t_rebuild, t_apply])
+    table(["goals", "edits", "rebuild", "apply"], rows)
+
+
+@benchmark
+def bench_spatial() -> None:
+    """Viewport (30 rows) and nearest goal queries on a laid out canvas: a scan
+    of all `node_opts` vs `GridIndex`, plus index build and a small update."""
+    import math
+    from random import Random
+
+    from spatial import GridIndex
+    from virtual_layers import render_virtual
+
+    def scan_query(opts, top: int) -> list:
+        return [g for g, o in opts.items() if top <= o["row"] <= top + 30]
+
+    def scan_nearest(opts, row: float, col: float):
+        return min(
+            opts, key=lambda g: math.hypot(opts[g]["row"] - row, opts[g]["col"] - col)
+        )
+
+    rows = []
+    for n in (5000, 50_000):
+        rr = render_virtual(random_tree(n, 1), 8)
+        opts = rr.node_opts
+        height = max(o["row"] for o in opts.values())
+        rnd = Random(0)
+        points = [(rnd.uniform(0, height), rnd.uniform(0, 7)) for _ in range(100)]
+        index, t_build = timed(GridIndex.from_result, rr)
+        _, t_scan_q = timed(lambda: [scan_query(opts, int(r)) for r, _ in points])
+        _, t_index_q = timed(
+            lambda: [index.query(int(r), 0, int(r) + 30, 8) for r, _ in points]
+        )
+        _, t_scan_n = timed(lambda: [scan_nearest(opts, r, c) for r, c in points])
+        _, t_index_n = timed(lambda: [index.nearest(r, c) for r, c in points])
+        moves = {g: (opts[g]["row"] + 1, opts[g]["col"]) for g in list(opts)[:10]}
+        _, t_update = timed(index.update, moves)
+        rows.append([n, t_build, t_scan_q, t_index_q, t_scan_n, t_index_n, t_update])
+    header = ["goals", "build", "scan 100 views", "index", "scan 100 nearest"]
+    table(header + ["index", "move 10"], rows)
+
+
+@benchmark
+def bench_visibility() -> None:
+    """Only open goals of a focused subtree: filtering rows one by one, and a
+    mask over the compact graph (building the graph is measured separately)."""
+    from compact import CompactGraph
+    from siebenapp import RenderResult, RenderRow
+    from visibility import filter_goals
+
+    def by_rows(rr, root) -> RenderResult:
+        scope, stack = set(), [root]
+        while stack:
+            goal_id = stack.pop()
+            if goal_id not in scope:
+                scope.add(goal_id)
+                stack.extend(e[0] for e in rr.by_id(goal_id).edges)
+        visible = {g for g in scope if rr.by_id(g).is_open}
+        rows = [
+            RenderRow(
+                r.goal_id,
+                r.raw_id,
+                r.name,
+                r.is_open,
+                r.is_switchable,
+                [e for e in r.edges if e[0] in visible],
+                r.attrs,
+            )
+            for r in rr.rows
+            if r.goal_id in visible
+        ]
+        return RenderResult(rows, node_opts={}, roots={root})
+
+    rows = []
+    for n in (10_000, 100_000):
+        rr = random_tree(n, 1)
+        root = rr.rows[0].goal_id
+        _, t_rows = timed(by_rows, rr, root)
+        g, t_graph = timed(CompactGraph.from_result, rr)
+        v, t_mask = timed(filter_goals, g, [g.index.numbers[root]], True)
+        filtered, t_result = timed(v.result, rr)
+        shared = sum(r is rr.by_id(r.goal_id) for r in filtered.rows)
+        rows.append([n, v.size, t_rows, t_graph, t_mask, t_result, shared])
+    header = ["goals", "visible", "by rows", "graph", "mask", "result"]
+    table(header + ["rows shared"], rows)
+
+
+@benchmark
+def bench_layout_delta() -> None:
+    """Single-goal edits (a new child goal, a renamed goal, a closed one),
+    sent to a client as a full JSON layout and as a binary delta."""
+    import json
+
+    from layout_delta import apply_delta, encode_delta
+    from render import render
+    from service import result_from_json, result_to_json
+    from siebenapp import EdgeType, RenderEdit, RenderResult, RenderRow
+
+    def edited(rr: RenderResult, kind: str) -> RenderResult:
+        rr = RenderResult(rr.rows, node_opts=rr.node_opts, roots=rr.roots)
+        goal = rr.rows[len(rr.rows) // 2]
+        if kind == "add":
+            new = RenderRow(10**7, 10**7, "new", True, True, [], {})
+            edges = goal.edges + [(new.goal_id, EdgeType.PARENT)]
+            rr.apply(RenderEdit([new], {goal.goal_id: edges}))
+        else:
+            renamed = kind == "rename"
+            name = goal.name + "!" if renamed else goal.name
+            is_open = goal.is_open if renamed else False
+            row = RenderRow(
+                goal.goal_id,
+                goal.raw_id,
+                name,
+                is_open,
+                goal.is_switchable,
+                goal.edges,
+                goal.attrs,
+            )
+            rr.apply(RenderEdit(replace_rows=[row]))
+        return rr
+
+    def send_json(rr: RenderResult) -> bytes:
+        return json.dumps(result_to_json(rr)).encode()
+
+    def receive_delta(previous: RenderResult, data: bytes) -> RenderResult:
+        client = RenderResult(
+            previous.rows,
+            node_opts=previous.node_opts,
+            select=previous.select,
+            roots=previous.roots,
+        )
+        apply_delta(client, data)
+        return client
+
+    rows = []
+    for n, fake_goals in ((1000, False), (1000, True), (3000, False)):
+        source = random_tree(n, 1)
+        previous = render(source, 5, fake_goals)
+        for kind in ("add", "rename", "close"):
+            current = render(edited(source, kind), 5, fake_goals, previous)
+            full, t_json = timed(send_json, current)
+            _, t_json_in = timed(lambda: result_from_json(json.loads(full)))
+            delta, t_delta = timed(encode_delta, previous, current)
+            client, t_delta_in = timed(receive_delta, previous, delta)
+            assert client == current, f"{n} goals, {kind}: delta lost changes"
+            rows.append(
+                [n, fake_goals, kind, len(full), t_json, t_json_in]
+                + [len(delta), t_delta, t_delta_in]
+            )
+    header = ["goals", "fakes", "edit", "JSON bytes", "encode", "decode"]
+    table(header + ["delta bytes", "encode", "decode+apply"], rows)
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or list(BENCHMARKS):
+        print(f"## {name}")
+        BENCHMARKS[name]()
+        print()
@@ -0,0 +1,112 @@
+"""Array-backed (compact) representation of a goal graph.
+
+Goals are numbered with `GoalIndex`, and outgoing edges are kept in CSR form:
+edges of goal `i` are `targets[offsets[i]:offsets[i + 1]]`. Array-based
+stages work with numbers only and translate them back to goal ids at the end.
+"""
+
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+from siebenapp import EdgeType, GoalIndex, RenderResult, RenderRow
+
+
+@dataclass
+class CompactGraph:
+    index: GoalIndex
+    offsets: np.ndarray  # int64, size N + 1
+    targets: np.ndarray  # int32, size E
+    edge_types: np.ndarray  # int8 (EdgeType values), size E
+    is_open: np.ndarray  # bool, size N
+    is_switchable: np.ndarray  # bool, size N
+    roots: np.ndarray  # int32, root numbers in `list(rr.roots)` order
+
+    @classmethod
+    def from_result(cls, rr: RenderResult) -> "CompactGraph":
+        index = rr.goal_index
+        size = len(rr.rows)
+        degrees = np.fromiter((len(row.edges) for row in rr.rows), np.int64, size)
+        offsets = np.zeros(len(rr.rows) + 1, np.int64)
+        np.cumsum(degrees, out=offsets[1:])
+        numbers = index.numbers
+        targets = np.fromiter(
+            (numbers[e[0]] for row in rr.rows for e in row.edges), np.int32, offsets[-1]
+        )
+        edge_types = np.fromiter(
+            (e[1] for row in rr.rows for e in row.edges), np.int8, offsets[-1]
+        )
+        return cls(
+            index,
+            offsets,
+            targets,
+            edge_types,
+            np.fromiter((row.is_open for row in rr.rows), bool, len(rr.rows)),
+            np.fromiter((row.is_switchable for row in rr.rows), bool, len(rr.rows)),
+            np.fromiter((numbers[g] for g in rr.roots), np.int32, len(rr.roots)),
+        )
+
+    @property
+    def size(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.targets)
+
+    def children(self, number: int) -> np.ndarray:
+        return self.targets[self.offsets[number] : self.offsets[number + 1]]
+
+    def sources(self) -> np.ndarray:
+        """Source number of every edge (CSR expanded back to an edge list)."""
+        return np.repeat(np.arange(self.size, dtype=np.int32), np.diff(self.offsets))
+
+    def edges_of(self, numbers: np.ndarray) -> np.ndarray:
+        """Positions (in `targets`) of all outgoing edges of given goals."""
+        starts = self.offsets[numbers]
+        lengths = self.offsets[numbers + 1] - starts
+        total = int(lengths.sum())
+        if not total:
+            return np.zeros(0, np.int64)
+        # Position of an edge = start of its goal + its rank among goal edges
+        shifts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return shifts + np.arange(total)
+
+    def reachable(self, start: Optional[np.ndarray] = None) -> np.ndarray:
+        """Mask of goals reachable from `start` numbers (roots by default)."""
+        mask = np.zeros(self.size, bool)
+        frontier = np.unique(self.roots if start is None else start)
+        mask[frontier] = True
+        while len(frontier):
+            next_goals = np.unique(self.targets[self.edges_of(frontier)])
+            frontier = next_goals[~mask[next_goals]]
+            mask[frontier] = True
+        return mask
+
+    def to_result(self) -> RenderResult:
+        """A `RenderResult` for stages that need one (names are goal numbers)."""
+        targets = self.targets.tolist()
+        edge_types = [EdgeType(t) for t in self.edge_types.tolist()]
+        offsets = self.offsets.tolist()
+        ids = self.index.ids
+        rows = [
+            RenderRow(
+                goal_id=goal_id,
+                raw_id=number,
+                name=str(number),
+                is_open=bool(self.is_open[number]),
+                is_switchable=bool(self.is_switchable[number]),
+                edges=[
+                    (ids[targets[i]], edge_types[i])
+                    for i in range(offsets[number], offsets[number + 1])
+                ],
+                attrs={},
+            )
+            for number, goal_id in enumerate(ids)
+        ]
+        return RenderResult(
+            rows,
+            node_opts={goal_id: {} for goal_id in ids},
+            roots={ids[number] for number in self.roots.tolist()},
+        )
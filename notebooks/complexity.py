@@ -0,0 +1,217 @@
+"""Empirical complexity of layout stages.
+
+Every stage is run on random trees of geometrically growing sizes. Time (best
+of a few runs) and peak memory (traced allocations) are fitted with a power
+law `c * n^k`, and the closest of O(n), O(n log n) and O(n^2) models is picked.
+Exponents are compared with a stored baseline, and a stage is flagged when an
+exponent grows by more than `TOLERANCE`.
+
+Run with `python complexity.py [stage ...]`, or `python complexity.py --save`
+to write a new baseline.
+"""
+
+import json
+import math
+import os
+import sys
+import timeit
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Optional
+
+import numpy as np
+
+from siebenapp import RenderResult
+from render import (
+    add_fake_goals,
+    adjust_horisontal,
+    build_with,
+    calc_shift,
+    find_previous,
+    normalize_cols,
+    shift_neutral,
+    tube,
+    tweak_horizontal,
+)
+from sieben_random import random_tree
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "complexity.json")
+
+# Exponent growth which is treated as a regression
+TOLERANCE = 0.3
+
+WIDTH = 5
+
+MODELS: dict[str, Callable[[float], float]] = {
+    "O(n)": lambda n: n,
+    "O(n log n)": lambda n: n * math.log(n),
+    "O(n^2)": lambda n: n * n,
+}
+
+# Prepares inputs of a stage (not measured), returns the measured call
+Stage = Callable[[RenderResult], Callable[[], Any]]
+
+STAGES: dict[str, Stage] = {}
+
+
+def stage(fn: Stage) -> Stage:
+    STAGES[fn.__name__.removeprefix("stage_")] = fn
+    return fn
+
+
+def _layered(rr: RenderResult) -> RenderResult:
+    return build_with(rr, tube, WIDTH).rr
+
+
+@stage
+def stage_find_previous(rr: RenderResult) -> Callable[[], Any]:
+    return lambda: find_previous(rr)
+
+
+@stage
+def stage_tube(rr: RenderResult) -> Callable[[], Any]:
+    return lambda: build_with(rr, tube, WIDTH)
+
+
+@stage
+def stage_calc_shift(rr: RenderResult) -> Callable[[], Any]:
+    layered = _layered(rr)
+    return lambda: calc_shift(layered, shift_neutral)
+
+
+@stage
+def stage_adjust_horisontal(rr: RenderResult) -> Callable[[], Any]:
+    layered = _layered(rr)
+    return lambda: adjust_horisontal(layered, 1.0)
+
+
+@stage
+def stage_normalize_cols(rr: RenderResult) -> Callable[[], Any]:
+    adjusted = adjust_horisontal(adjust_horisontal(_layered(rr), 1.0), 0.5)
+    return lambda: normalize_cols(adjusted, WIDTH)
+
+
+@stage
+def stage_add_fake_goals(rr: RenderResult) -> Callable[[], Any]:
+    laid_out = tweak_horizontal(_layered(rr), WIDTH)
+    return lambda: add_fake_goals(laid_out, WIDTH)
+
+
+@dataclass
+class Fit:
+    exponent: float  # k of the best `c * n^k`
+    model: str  # closest of MODELS
+
+
+@dataclass
+class StageReport:
+    stage: str
+    sizes: list[int]
+    seconds: list[float]
+    peak_bytes: list[int]
+    time: Fit
+    memory: Fit
+
+
+def fit(sizes: list[int], values: list[float]) -> Fit:
+    """Fit values with a power law (in log-log scale) and with every model
+    (least squares of relative errors)."""
+    n = np.array(sizes, float)
+    y = np.maximum(np.array(values, float), 1e-12)
+    exponent = float(np.polyfit(np.log(n), np.log(y), 1)[0])
+    errors = {}
+    for name, model in MODELS.items():
+        f = np.array([model(x) for x in sizes]) / y
+        scale = f.sum() / (f * f).sum()
+        errors[name] = float(((scale * f - 1) ** 2).sum())
+    return Fit(exponent, min(errors, key=lambda name: errors[name]))
+
+
+def measure(name: str, sizes: Iterable[int], repeat: int = 3) -> StageReport:
+    sizes = list(sizes)
+    seconds: list[float] = []
+    peaks: list[int] = []
+    for size in sizes:
+        run = STAGES[name](random_tree(size, 1))
+        timer = timeit.Timer(run)
+        number, _ = timer.autorange()
+        seconds.append(min(timer.repeat(repeat, number)) / number)
+        tracemalloc.start()
+        try:
+            run()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    return StageReport(
+        name, sizes, seconds, peaks, fit(sizes, seconds), fit(sizes, peaks)
+    )
+
+
+def geometric(start: int = 125, factor: int = 2, count: int = 5) -> list[int]:
+    return [start * factor**i for i in range(count)]
+
+
+def regressions(
+    reports: list[StageReport], baseline: dict[str, Any], tolerance: float = TOLERANCE
+) -> list[str]:
+    """Stages (and measures) whose exponents grew compared with `baseline`."""
+    result = []
+    for report in reports:
+        known = baseline.get(report.stage)
+        if known is None:
+            continue
+        for measure_name in ("time", "memory"):
+            was = known[measure_name]["exponent"]
+            now = getattr(report, measure_name).exponent
+            if now > was + tolerance:
+                result.append(f"{report.stage} {measure_name}: {was:.2f} -> {now:.2f}")
+    return result
+
+
+def load_baseline(path: str = BASELINE) -> dict[str, Any]:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(reports: list[StageReport], path: str = BASELINE) -> None:
+    data = load_baseline(path)
+    for r in reports:
+        data[r.stage] = {
+            measure_name: {"exponent": round(f.exponent, 3), "model": f.model}
+            for measure_name, f in (("time", r.time), ("memory", r.memory))
+        }
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+        f.write("\n")
+
+
+def main(args: list[str], sizes: Optional[list[int]] = None) -> int:
+    save = "--save" in args
+    names = [a for a in args if a != "--save"] or list(STAGES)
+    reports = [measure(name, sizes or geometric()) for name in names]
+    baseline = load_baseline()
+    print(
+        f"{'stage':18} {'time':>6} {'model':>11} {'memory':>7} {'model':>11}"
+        f" {'baseline':>9}"
+    )
+    for r in reports:
+        known = baseline.get(r.stage)
+        was = f"{known['time']['exponent']:.2f}" if known else "-"
+        print(
+            f"{r.stage:18} {r.time.exponent:6.2f} {r.time.model:>11}"
+            f" {r.memory.exponent:7.2f} {r.memory.model:>11} {was:>9}"
+        )
+    if save:
+        save_baseline(reports)
+        print(f"Baseline saved to {BASELINE}")
+        return 0
+    regressed = regressions(reports, baseline)
+    for line in regressed:
+        print(f"REGRESSION: {line}")
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
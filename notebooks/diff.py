@@ -0,0 +1,79 @@
+"""Structural diff between two snapshots of a goal tree.
+
+Rows are matched by goal ids (not by positions in `rows`). Rows shared by both
+snapshots (the same `RenderRow` objects) are unchanged, others are compared as
+dataclasses, which stops at the first differing field. Edges are compared only
+for rows which were added, removed or modified. So a diff takes O(V) for
+snapshots sharing rows, and O(V + E) at most (when all rows are rebuilt).
+"""
+
+from collections import Counter
+from dataclasses import dataclass, field
+
+from siebenapp import EdgeType, GoalId, RenderResult
+
+# (source, target, type)
+Edge = tuple[GoalId, GoalId, EdgeType]
+
+
+@dataclass
+class GraphDiff:
+    added_rows: list[GoalId] = field(default_factory=list)
+    removed_rows: list[GoalId] = field(default_factory=list)
+    # Same goal id, but something else differs: name, flags, attrs or edges
+    modified_rows: list[GoalId] = field(default_factory=list)
+    added_edges: list[Edge] = field(default_factory=list)
+    removed_edges: list[Edge] = field(default_factory=list)
+    roots_changed: bool = False
+    select_changed: bool = False
+
+    @property
+    def structure_changed(self) -> bool:
+        return bool(
+            self.added_rows
+            or self.removed_rows
+            or self.modified_rows
+            or self.roots_changed
+        )
+
+    @property
+    def only_select(self) -> bool:
+        """True when a re-render is not needed at all, only a re-draw."""
+        return self.select_changed and not self.structure_changed
+
+
+def _edge_changes(
+    source: GoalId, old: list, new: list
+) -> tuple[list[Edge], list[Edge]]:
+    old_edges = Counter((e[0], e[1]) for e in old)
+    new_edges = Counter((e[0], e[1]) for e in new)
+    added = [(source, t, k) for (t, k) in (new_edges - old_edges).elements()]
+    removed = [(source, t, k) for (t, k) in (old_edges - new_edges).elements()]
+    return added, removed
+
+
+def diff(old: RenderResult, new: RenderResult) -> GraphDiff:
+    """What changed from `old` to `new` (layout options are not compared)."""
+    result = GraphDiff(
+        roots_changed=old.roots != new.roots,
+        select_changed=old.select != new.select,
+    )
+    for row in new.rows:
+        goal_id = row.goal_id
+        position = old.index.get(goal_id)
+        if position is None:
+            result.added_rows.append(goal_id)
+            result.added_edges.extend((goal_id, e[0], e[1]) for e in row.edges)
+            continue
+        old_row = old.rows[position]
+        if old_row is row or old_row == row:
+            continue
+        result.modified_rows.append(goal_id)
+        added, removed = _edge_changes(goal_id, old_row.edges, row.edges)
+        result.added_edges.extend(added)
+        result.removed_edges.extend(removed)
+    for row in old.rows:
+        if row.goal_id not in new.index:
+            result.removed_rows.append(row.goal_id)
+            result.removed_edges.extend((row.goal_id, e[0], e[1]) for e in row.edges)
+    return result
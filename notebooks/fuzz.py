@@ -0,0 +1,320 @@
+"""Differential fuzzing of layout engines against the reference pipeline.
+
+The reference is `render` (`tube` layering, `tweak_horizontal`, which ends with
+`normalize_cols`). A faster engine is registered with `@engine(name)`, and has
+to produce exactly the same layout on random graphs: the same layers (goals
+by rows, ordered by cols), the same (row, col) of every goal, and the same
+fake goals. Fake goals are compared by positions rather than by ids, so an
+engine may number them differently. Engines registered with `layering=True`
+replace only the layering, and are compared with raw `tube` layers instead.
+
+A failing graph is shrunk greedily: goals are removed (their children are
+moved to their parents) and extra edges are dropped while the engine still
+fails, and the width is lowered. Timings of both pipelines are collected too,
+so a run also tells the speedup per graph size.
+
+Run with `python fuzz.py [engine ...]`.
+"""
+
+import sys
+import time
+from dataclasses import dataclass, field
+from random import Random
+from typing import Callable, Iterable, Iterator, Optional
+
+from siebenapp import GoalId, RenderEdit, RenderResult, is_fake_row
+from render import build_with, iter_layers, render, tube, tube_with_fakes
+from sieben_random import random_tree
+
+# Layout function: (graph, width) -> laid out graph, like `render`
+Engine = Callable[[RenderResult, int], RenderResult]
+
+
+@dataclass
+class EngineInfo:
+    fn: Engine
+    fake_goals: bool  # compared with `render(..., fake_goals=True)` then
+    layering: bool  # compared with `tube` layers, before horizontal tweaking
+
+
+ENGINES: dict[str, EngineInfo] = {}
+
+
+def engine(
+    name: str, fake_goals: bool = False, layering: bool = False
+) -> Callable[[Engine], Engine]:
+    def register(fn: Engine) -> Engine:
+        ENGINES[name] = EngineInfo(fn, fake_goals, layering)
+        return fn
+
+    return register
+
+
+def reference(rr: RenderResult, width: int, info: EngineInfo) -> RenderResult:
+    if info.layering:
+        return build_with(rr, tube_with_fakes if info.fake_goals else tube, width).rr
+    return render(rr, width, fake_goals=info.fake_goals)
+
+
+def _streamed(rr: RenderResult, width: int, fake_goals: bool) -> RenderResult:
+    """Layers taken from `iter_layers` one by one, like a drawing client does.
+    Positions come only from yielded layers."""
+    layers = iter_layers(rr, width, fake_goals)
+    placed: dict[GoalId, dict] = {}
+    while True:
+        try:
+            layer = next(layers)
+        except StopIteration as stop:
+            laid_out: RenderResult = stop.value
+            break
+        for goal_id, row, col in layer:
+            assert goal_id not in placed, f"Goal {goal_id} is placed twice"
+            placed[goal_id] = {"row": row, "col": col}
+    node_opts = {row.goal_id: placed.get(row.goal_id, {}) for row in laid_out.rows}
+    return RenderResult(laid_out.rows, node_opts=node_opts, roots=laid_out.roots)
+
+
+@engine("progressive", layering=True)
+def _progressive(rr: RenderResult, width: int) -> RenderResult:
+    return _streamed(rr, width, False)
+
+
+@engine("progressive-fakes", fake_goals=True, layering=True)
+def _progressive_fakes(rr: RenderResult, width: int) -> RenderResult:
+    return _streamed(rr, width, True)
+
+
+# Goal id of a fake goal is replaced by its position
+Key = tuple
+
+
+def _key(rr: RenderResult, goal_id: GoalId) -> Key:
+    if is_fake_row(rr.by_id(goal_id)):
+        opts = rr.node_opts[goal_id]
+        return ("fake", opts["row"], opts["col"])
+    return ("goal", goal_id)
+
+
+def layers(rr: RenderResult) -> list[list[Key]]:
+    """Keys of placed goals, row by row, ordered by cols."""
+    placed = [
+        (opts["row"], opts["col"], _key(rr, goal_id))
+        for goal_id, opts in rr.node_opts.items()
+        if opts.get("row") is not None
+    ]
+    result: list[list[Key]] = []
+    for row, _, key in sorted(placed, key=lambda p: (p[0], p[1])):
+        while len(result) <= row:
+            result.append([])
+        result[row].append(key)
+    return result
+
+
+def positions(rr: RenderResult) -> dict[Key, tuple[int, int]]:
+    return {
+        _key(rr, goal_id): (opts.get("row"), opts.get("col"))
+        for goal_id, opts in rr.node_opts.items()
+    }
+
+
+def structure(rr: RenderResult) -> list[tuple[Key, Key, int]]:
+    """Edges with fake goals replaced by their positions."""
+    return sorted(
+        (_key(rr, row.goal_id), _key(rr, e[0]), int(e[1]))
+        for row in rr.rows
+        for e in row.edges
+    )
+
+
+def compare(expected: RenderResult, actual: RenderResult) -> list[str]:
+    """Differences of `actual` from `expected`, empty when they're equivalent."""
+    problems: list[str] = []
+    try:
+        actual_layers = layers(actual)
+        actual_positions = positions(actual)
+        actual_structure = structure(actual)
+    except (AssertionError, KeyError, TypeError) as e:
+        return [f"malformed result: {e!r}"]
+    if actual_layers != layers(expected):
+        problems.append("layers differ")
+    expected_positions = positions(expected)
+    moved = [
+        (key, expected_positions.get(key), actual_positions.get(key))
+        for key in expected_positions.keys() | actual_positions.keys()
+        if expected_positions.get(key) != actual_positions.get(key)
+    ]
+    if moved:
+        problems.append(f"{len(moved)} goals placed differently, e.g. {min(moved)}")
+    if actual_structure != structure(expected):
+        problems.append("fake goal structure differs")
+    return problems
+
+
+def random_graph(seed: int, size: int) -> RenderResult:
+    """A random goal tree of `size` goals, with shape parameters picked by `seed`."""
+    rnd = Random(seed)
+    return random_tree(
+        size,
+        seed,
+        blockers=rnd.choice([0.0, 0.3, 0.6]),
+        max_children=rnd.choice([None, 2, 4]),
+        closed=rnd.random(),
+    )
+
+
+def _fails(name: str, rr: RenderResult, width: int) -> bool:
+    info = ENGINES[name]
+    expected = reference(rr, width, info)
+    try:
+        actual = info.fn(rr, width)
+    except Exception:
+        return True
+    return bool(compare(expected, actual))
+
+
+def _without_goals(rr: RenderResult, goal_ids: list[GoalId]) -> RenderResult:
+    """`rr` without some goals; their children are moved to their parents (or
+    become roots)."""
+    result = RenderResult(rr.rows, node_opts=rr.node_opts, roots=rr.roots)
+    for goal_id in goal_ids:
+        children = result.by_id(goal_id).edges
+        set_edges = {}
+        for parent in set(result.parents[goal_id]):
+            edges = [e for e in result.by_id(parent).edges if e[0] != goal_id]
+            known = {e[0] for e in edges}
+            set_edges[parent] = edges + [e for e in children if e[0] not in known]
+        was_root = goal_id in result.roots
+        result.apply(RenderEdit(set_edges=set_edges, remove_rows=[goal_id]))
+        if was_root:
+            result.roots.update(e[0] for e in children)
+    return result
+
+
+def _without_edge(rr: RenderResult, source: GoalId, target: GoalId) -> RenderResult:
+    result = RenderResult(rr.rows, node_opts=rr.node_opts, roots=rr.roots)
+    edges = [e for e in result.by_id(source).edges if e[0] != target]
+    result.apply(RenderEdit(set_edges={source: edges}))
+    return result
+
+
+def _smaller(rr: RenderResult) -> Iterator[RenderResult]:
+    """Candidates for shrinking: without halves of goals, then quarters, and so
+    on down to single goals, then without single edges."""
+    goals = [row.goal_id for row in rr.rows]
+    chunk = len(goals) // 2
+    while chunk > 0:
+        for start in range(0, len(goals), chunk):
+            yield _without_goals(rr, goals[start : start + chunk])
+        chunk //= 2
+    for row in rr.rows:
+        for e in row.edges:
+            # Dropped edge must not be the only way to reach a goal
+            if len(rr.parents[e[0]]) > 1:
+                yield _without_edge(rr, row.goal_id, e[0])
+
+
+def shrink(name: str, rr: RenderResult, width: int) -> tuple[RenderResult, int]:
+    """A graph and width the engine still fails on, where no single goal or edge
+    can be removed (and width can't be lowered) without fixing the failure."""
+    while width > 1 and _fails(name, rr, width - 1):
+        width -= 1
+    progress = True
+    while progress:
+        progress = False
+        for candidate in _smaller(rr):
+            if candidate.rows and _fails(name, candidate, width):
+                rr = candidate
+                progress = True
+                break
+    return rr, width
+
+
+@dataclass
+class Failure:
+    engine: str
+    seed: int
+    size: int
+    width: int
+    problems: list[str]
+    shrunk: RenderResult
+    shrunk_width: int
+
+
+@dataclass
+class FuzzReport:
+    failures: list[Failure] = field(default_factory=list)
+    cases: int = 0
+    # Total time of the reference and of the engine, by (engine, size)
+    timings: dict[tuple[str, int], tuple[float, float]] = field(default_factory=dict)
+
+    def speedup(self, name: str, size: int) -> float:
+        t_reference, t_engine = self.timings[name, size]
+        return t_reference / t_engine if t_engine else float("inf")
+
+
+def fuzz(
+    engines: Optional[Iterable[str]] = None,
+    sizes: Iterable[int] = (5, 20, 100, 300),
+    seeds: Iterable[int] = range(10),
+    widths: Iterable[int] = (2, 3, 5),
+) -> FuzzReport:
+    """Compare engines (all registered by default) with the reference pipeline."""
+    names = list(engines) if engines is not None else list(ENGINES)
+    report = FuzzReport()
+    for size in sizes:
+        for seed in seeds:
+            rr = random_graph(seed, size)
+            for width in widths:
+                # Reference results by (fake goals, layering only) modes
+                expected_by_mode: dict[tuple, tuple[RenderResult, float]] = {}
+                for name in names:
+                    info = ENGINES[name]
+                    mode = (info.fake_goals, info.layering)
+                    if mode not in expected_by_mode:
+                        started = time.perf_counter()
+                        expected = reference(rr, width, info)
+                        elapsed = time.perf_counter() - started
+                        expected_by_mode[mode] = (expected, elapsed)
+                    expected, t_reference = expected_by_mode[mode]
+                    started = time.perf_counter()
+                    try:
+                        actual = info.fn(rr, width)
+                        problems = []
+                    except Exception as e:
+                        problems = [f"raised {e!r}"]
+                    t_engine = time.perf_counter() - started
+                    problems = problems or compare(expected, actual)
+                    total = report.timings.get((name, size), (0.0, 0.0))
+                    report.timings[name, size] = (
+                        total[0] + t_reference,
+                        total[1] + t_engine,
+                    )
+                    report.cases += 1
+                    if problems:
+                        shrunk, shrunk_width = shrink(name, rr, width)
+                        report.failures.append(
+                            Failure(
+                                name, seed, size, width, problems, shrunk, shrunk_width
+                            )
+                        )
+    return report
+
+
+if __name__ == "__main__":
+    report = fuzz(sys.argv[1:] or None)
+    print(f"{report.cases} cases, {len(report.failures)} failures")
+    for f in report.failures:
+        print(
+            f"{f.engine}: seed {f.seed}, {f.size} goals, width {f.width}: "
+            + "; ".join(f.problems)
+        )
+        print(f"  shrunk to {len(f.shrunk.rows)} goals, width {f.shrunk_width}:")
+        for row in f.shrunk.rows:
+            print(f"    {row.goal_id} -> {[(e[0], e[1].name) for e in row.edges]}")
+    print()
+    print("engine             goals  reference  engine  speedup")
+    for (name, size), (t_reference, t_engine) in report.timings.items():
+        print(
+            f"{name:17} {size:6} {t_reference:10.4f} {t_engine:7.4f}"
+            f" {report.speedup(name, size):8.2f}"
+        )
@@ -0,0 +1,341 @@
+"""Binary deltas between consecutive layouts, for clients of a render service.
+
+A re-render usually moves a few goals, yet a full `result_to_json` re-send
+carries every row and every position. A delta carries only what differs from
+the previous layout the client already has: removed goals, new or changed
+rows (fake goals come and go, and their ids are reused), edge lists which
+changed, new positions (row and col in `node_opts`, None for goals which
+weren't placed) of moved goals, and select and roots when they changed. Other
+layout options aren't sent.
+
+Row order matters too (it breaks ties between equal columns), and applying
+an edit keeps the remaining rows in their order and appends new ones. When
+the new layout orders rows differently, the delta also carries the new order
+as runs of consecutive rows of that applied order.
+
+Encoding: integers are LEB128 varints, signed ones zigzag-encoded. A goal id
+is a varint too: `zigzag(id) << 1` for an int id, `index << 1 | 1` for a str
+id from the string table at the start of a delta. An edge is `id << 2 | type`.
+Rows and cols are 0 for None, `zigzag(n) << 2 | 1` for an int, or 2 followed
+by a float64. A run of rows is its zigzag-encoded start relative to the end of
+the previous run, and its length.
+
+    data = encode_delta(previous, current)  # on the server
+    apply_delta(previous, data)  # on the client, `previous` becomes `current`
+"""
+
+import struct
+from dataclasses import dataclass, field
+from typing import Optional
+
+from siebenapp import EdgeType, GoalId, RenderEdit, RenderResult, RenderRow
+
+MAGIC = b"SLD\x01"
+
+# Flags of optional sections
+SELECT = 1
+ROOTS = 2
+ORDER = 4
+
+Edges = list[tuple[GoalId, EdgeType]]
+
+EDGE_TYPES = {int(t): t for t in EdgeType}
+
+Position = tuple[Optional[int], Optional[float]]
+
+# Rows from `start` to `start + length` of the order left by an applied edit
+Run = tuple[int, int]
+
+
+@dataclass
+class LayoutDelta:
+    removed: list[GoalId] = field(default_factory=list)
+    rows: list[RenderRow] = field(default_factory=list)  # new or changed
+    edges: dict[GoalId, Edges] = field(default_factory=dict)
+    moved: dict[GoalId, Position] = field(default_factory=dict)
+    select: Optional[tuple[GoalId, GoalId]] = None
+    roots: Optional[set[GoalId]] = None
+    order: Optional[list[Run]] = None
+
+    def edit(self, rr: RenderResult) -> RenderEdit:
+        """Changes turning `rr` (the previous layout) into the new one."""
+        opts = rr.node_opts
+        return RenderEdit(
+            add_rows=[row for row in self.rows if row.goal_id not in rr.index],
+            set_edges=self.edges,
+            remove_rows=self.removed,
+            node_opts={
+                goal_id: opts.get(goal_id, {}) | {"row": row, "col": col}
+                for goal_id, (row, col) in self.moved.items()
+            },
+            replace_rows=[row for row in self.rows if row.goal_id in rr.index],
+        )
+
+
+def diff(previous: RenderResult, current: RenderResult) -> LayoutDelta:
+    delta = LayoutDelta()
+    delta.removed = [g for g in previous.index if g not in current.index]
+    for row in current.rows:
+        if row.goal_id not in previous.index:
+            delta.rows.append(row)
+            continue
+        old = previous.by_id(row.goal_id)
+        if old == row:
+            continue
+        if (old.raw_id, old.name, old.is_open, old.is_switchable, old.attrs) == (
+            row.raw_id,
+            row.name,
+            row.is_open,
+            row.is_switchable,
+            row.attrs,
+        ):
+            delta.edges[row.goal_id] = row.edges
+        else:
+            delta.rows.append(row)
+    old_opts = previous.node_opts
+    for goal_id, opts in current.node_opts.items():
+        position = opts.get("row"), opts.get("col")
+        old = old_opts.get(goal_id, {})
+        if (old.get("row"), old.get("col")) != position:
+            delta.moved[goal_id] = position
+    if current.select != previous.select:
+        delta.select = current.select
+    if current.roots != previous.roots:
+        delta.roots = current.roots
+    runs = _runs(previous, current, delta)
+    if runs != [(0, len(current.rows))]:
+        delta.order = runs
+    return delta
+
+
+def _runs(
+    previous: RenderResult, current: RenderResult, delta: LayoutDelta
+) -> list[Run]:
+    """Order of `current` rows as runs of the order left by `delta.edit`."""
+    removed = set(delta.removed)
+    applied = [row.goal_id for row in previous.rows if row.goal_id not in removed]
+    added = [row.goal_id for row in delta.rows if row.goal_id not in previous.index]
+    applied.extend(added)
+    position = {g: i for i, g in enumerate(applied)}
+    runs: list[Run] = []
+    for row in current.rows:
+        i = position[row.goal_id]
+        if runs and runs[-1][0] + runs[-1][1] == i:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((i, 1))
+    return runs
+
+
+def _zigzag(n: int) -> int:
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+
+def _unzigzag(n: int) -> int:
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+class _Writer:
+    def __init__(self):
+        self.out = bytearray()
+        self.strings: dict[str, int] = {}
+
+    def varint(self, n: int) -> None:
+        out = self.out
+        while n >= 0x80:
+            out.append(n & 0x7F | 0x80)
+            n >>= 7
+        out.append(n)
+
+    def text(self, s: str) -> None:
+        data = s.encode()
+        self.varint(len(data))
+        self.out += data
+
+    def id_code(self, goal_id: GoalId) -> int:
+        if isinstance(goal_id, int):
+            return _zigzag(goal_id) << 1
+        number = self.strings.setdefault(goal_id, len(self.strings))
+        return number << 1 | 1
+
+    def goal(self, goal_id: GoalId) -> None:
+        self.varint(self.id_code(goal_id))
+
+    def edges(self, edges: Edges) -> None:
+        self.varint(len(edges))
+        for target, edge_type in edges:
+            self.varint(self.id_code(target) << 2 | int(edge_type))
+
+    def row(self, row: RenderRow) -> None:
+        self.goal(row.goal_id)
+        self.varint(_zigzag(row.raw_id))
+        self.text(row.name)
+        self.out.append(row.is_open | row.is_switchable << 1)
+        self.edges(row.edges)
+        self.varint(len(row.attrs))
+        for key, value in row.attrs.items():
+            self.text(key)
+            self.text(value)
+
+    def number(self, n: Optional[float]) -> None:
+        if n is None:
+            self.out.append(0)
+        elif isinstance(n, int):
+            self.varint(_zigzag(n) << 2 | 1)
+        else:
+            self.out.append(2)
+            self.out += struct.pack("<d", n)
+
+
+def encode(delta: LayoutDelta) -> bytes:
+    w = _Writer()
+    flags = (
+        (SELECT if delta.select is not None else 0)
+        | (ROOTS if delta.roots is not None else 0)
+        | (ORDER if delta.order is not None else 0)
+    )
+    w.varint(flags)
+    w.varint(len(delta.removed))
+    for goal_id in delta.removed:
+        w.goal(goal_id)
+    w.varint(len(delta.rows))
+    for row in delta.rows:
+        w.row(row)
+    w.varint(len(delta.edges))
+    for goal_id, edges in delta.edges.items():
+        w.goal(goal_id)
+        w.edges(edges)
+    w.varint(len(delta.moved))
+    for goal_id, (row_number, col) in delta.moved.items():
+        w.goal(goal_id)
+        w.number(row_number)
+        w.number(col)
+    if delta.select is not None:
+        w.goal(delta.select[0])
+        w.goal(delta.select[1])
+    if delta.roots is not None:
+        w.varint(len(delta.roots))
+        for goal_id in delta.roots:
+            w.goal(goal_id)
+    if delta.order is not None:
+        w.varint(len(delta.order))
+        end = 0
+        for start, length in delta.order:
+            w.varint(_zigzag(start - end))
+            w.varint(length)
+            end = start + length
+    # The string table goes first, so str ids are known while reading
+    body = w.out
+    w.out = bytearray(MAGIC)
+    w.varint(len(w.strings))
+    for s in w.strings:
+        w.text(s)
+    return bytes(w.out + body)
+
+
+class _Reader:
+    def __init__(self, data: bytes):
+        if data[: len(MAGIC)] != MAGIC:
+            raise ValueError("Not a layout delta")
+        self.data = data
+        self.pos = len(MAGIC)
+        self.strings = [self.text() for _ in range(self.varint())]
+
+    def varint(self) -> int:
+        data, pos = self.data, self.pos
+        byte = data[pos]
+        if byte < 0x80:
+            self.pos = pos + 1
+            return byte
+        result = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                self.pos = pos
+                return result
+            shift += 7
+
+    def text(self) -> str:
+        size = self.varint()
+        self.pos += size
+        return self.data[self.pos - size : self.pos].decode()
+
+    def of_code(self, code: int) -> GoalId:
+        if code & 1:
+            return self.strings[code >> 1]
+        code >>= 1
+        return code >> 1 if not code & 1 else -((code + 1) >> 1)
+
+    def goal(self) -> GoalId:
+        return self.of_code(self.varint())
+
+    def edges(self) -> Edges:
+        result = []
+        for _ in range(self.varint()):
+            code = self.varint()
+            result.append((self.of_code(code >> 2), EDGE_TYPES[code & 3]))
+        return result
+
+    def row(self) -> RenderRow:
+        goal_id = self.goal()
+        raw_id = _unzigzag(self.varint())
+        name = self.text()
+        flags = self.data[self.pos]
+        self.pos += 1
+        edges = self.edges()
+        attrs = {self.text(): self.text() for _ in range(self.varint())}
+        return RenderRow(
+            goal_id, raw_id, name, bool(flags & 1), bool(flags & 2), edges, attrs
+        )
+
+    def number(self) -> Optional[float]:
+        code = self.varint()
+        if code & 1:
+            return _unzigzag(code >> 2)
+        if not code:
+            return None
+        self.pos += 8
+        return struct.unpack_from("<d", self.data, self.pos - 8)[0]
+
+
+def decode(data: bytes) -> LayoutDelta:
+    r = _Reader(data)
+    flags = r.varint()
+    delta = LayoutDelta()
+    delta.removed = [r.goal() for _ in range(r.varint())]
+    delta.rows = [r.row() for _ in range(r.varint())]
+    delta.edges = {r.goal(): r.edges() for _ in range(r.varint())}
+    for _ in range(r.varint()):
+        goal_id = r.goal()
+        delta.moved[goal_id] = (r.number(), r.number())  # type: ignore
+    if flags & SELECT:
+        delta.select = (r.goal(), r.goal())
+    if flags & ROOTS:
+        delta.roots = {r.goal() for _ in range(r.varint())}
+    if flags & ORDER:
+        delta.order = []
+        end = 0
+        for _ in range(r.varint()):
+            start = end + _unzigzag(r.varint())
+            end = start + r.varint()
+            delta.order.append((start, end - start))
+    return delta
+
+
+def encode_delta(previous: RenderResult, current: RenderResult) -> bytes:
+    return encode(diff(previous, current))
+
+
+def apply_delta(rr: RenderResult, data: bytes) -> None:
+    """Turn `rr` (the layout a delta was made against) into the new layout."""
+    delta = decode(data)
+    rr.apply(delta.edit(rr))
+    if delta.select is not None:
+        rr.select = delta.select
+    if delta.roots is not None:
+        rr.roots = delta.roots
+    if delta.order is not None:
+        applied = [row.goal_id for row in rr.rows]
+        rr.reorder([g for start, n in delta.order for g in applied[start : start + n]])
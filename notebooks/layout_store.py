@@ -0,0 +1,347 @@
+"""Columnar storage of layout attributes (`RenderResult.node_opts`).
+
+Instead of a dict for every goal, `LayoutStore` keeps a typed array for every
+attribute ("row", "col", and any extra ones), indexed by dense goal numbers
+from `GoalIndex`, plus a mask of goals having a value. It is a read-only
+mapping of goal ids to `NodeOpts` views, so code like `node_opts[g]["row"]`
+or `opts | {"col": 1}` keeps working with it, while columnar stages below
+update whole columns in place.
+
+`render` keeps node options of its results in a store: `tube` fills rows and
+cols of every new layer, and horizontal stages (`adjust_horisontal`,
+`resolve_collisions`, `normalize_cols`) are thin wrappers around the stages
+below. As stages change a store in place, make a `copy()` before them when
+the previous layout is still needed (`LayoutStore.of` does it).
+"""
+
+from collections.abc import ItemsView, Mapping, MutableMapping, ValuesView
+from itertools import repeat
+from typing import Any, Iterator, Optional
+
+import numpy as np
+
+from siebenapp import GoalId, GoalIndex, RenderResult
+from compact import CompactGraph
+
+# Dense number used by `normalize_columns` for empty slots (real numbers are >= 0)
+EMPTY_SLOT = -1
+
+# Types of columns created by default, others are stored as Python objects
+DTYPES: dict[str, Any] = {"row": np.int32, "col": np.float64}
+
+# Cached value of a goal without a value in the column
+_MISSING = object()
+
+
+class NodeOpts(MutableMapping):
+    """Attributes of a single goal: a live view of its cells in a store."""
+
+    __slots__ = ("store", "number")
+
+    def __init__(self, store: "LayoutStore", number: int):
+        self.store = store
+        self.number = number
+
+    def __getitem__(self, key: str) -> Any:
+        values = self.store._values.get(key) or self.store.values_of(key)
+        value = values[self.number]
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key: str, default: Any = None) -> Any:
+        values = self.store._values.get(key)
+        if values is None:
+            if key not in self.store.columns:
+                return default
+            values = self.store.values_of(key)
+        value = values[self.number]
+        return default if value is _MISSING else value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.store.set_value(key, self.number, value)
+
+    def __delitem__(self, key: str) -> None:
+        self.store.del_value(key, self.number)
+
+    def __iter__(self) -> Iterator[str]:
+        values = self.store.values_of
+        return (k for k in self.store.columns if values(k)[self.number] is not _MISSING)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __or__(self, other: Mapping) -> dict:
+        return self.to_dict() | dict(other)
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+    def to_dict(self) -> dict[str, Any]:
+        store = self.store
+        result = {}
+        for key in store.columns:
+            value = (store._values.get(key) or store.values_of(key))[self.number]
+            if value is not _MISSING:
+                result[key] = value
+        return result
+
+
+class LayoutStore(Mapping):
+    """Layout attributes of all goals from `index`, column by column.
+
+    Reading goal by goal goes through Python lists made from columns on first
+    access, so write columns through `column()`, which drops its list.
+    """
+
+    def __init__(self, index: GoalIndex):
+        self.index = index
+        self.columns: dict[str, np.ndarray] = {}
+        self.present: dict[str, np.ndarray] = {}
+        self._values: dict[str, list] = {}
+
+    @classmethod
+    def from_dicts(cls, index: GoalIndex, node_opts: Mapping) -> "LayoutStore":
+        """Store of `node_opts`, goals missing from `index` are skipped."""
+        store = cls(index)
+        for goal_id, opts in node_opts.items():
+            number = index.numbers.get(goal_id)
+            if number is None:
+                continue
+            for key, value in opts.items():
+                if value is not None:
+                    store.set_value(key, number, value)
+        return store
+
+    @classmethod
+    def of(cls, rr: RenderResult) -> "LayoutStore":
+        """A new store with node options of `rr`, numbered like `rr.goal_index`."""
+        opts = rr.node_opts
+        if isinstance(opts, LayoutStore) and opts.index.ids == rr.goal_index.ids:
+            return opts.copy()
+        return cls.from_dicts(rr.goal_index, opts)
+
+    def to_dicts(self) -> dict[GoalId, dict]:
+        result: dict[GoalId, dict] = {goal_id: {} for goal_id in self.index}
+        ids = self.index.ids
+        for key, values in self.columns.items():
+            numbers = np.flatnonzero(self.present[key]).tolist()
+            for number, value in zip(numbers, values[numbers].tolist()):
+                result[ids[number]][key] = value
+        return result
+
+    def copy(self) -> "LayoutStore":
+        result = LayoutStore(self.index)
+        result.columns = {k: v.copy() for k, v in self.columns.items()}
+        result.present = {k: v.copy() for k, v in self.present.items()}
+        result._values = {k: list(v) for k, v in self._values.items()}
+        return result
+
+    def extend(self, goal_ids: list[GoalId]) -> None:
+        """Add goals without values (e.g. fake goals) at the end of the index.
+
+        The index is copied first, as it's usually shared with a RenderResult.
+        """
+        index = GoalIndex()
+        index.ids = list(self.index.ids)
+        index.numbers = dict(self.index.numbers)
+        index.real = bytearray(self.index.real)
+        for goal_id in goal_ids:
+            index.add(goal_id)
+        added = len(index) - len(self.index)
+        self.index = index
+        for key, values in self.columns.items():
+            self.columns[key] = np.concatenate([values, np.zeros(added, values.dtype)])
+            self.present[key] = np.concatenate(
+                [self.present[key], np.zeros(added, bool)]
+            )
+        self._values.clear()
+
+    def fill(self, key: str, numbers: np.ndarray, values: Any) -> None:
+        """Set `key` of goals `numbers` to `values`, unless they have it already."""
+        column = self.column(key)
+        present = self.present[key]
+        missing = ~present[numbers]
+        column[numbers[missing]] = (
+            values[missing] if isinstance(values, np.ndarray) else values
+        )
+        present[numbers[missing]] = True
+
+    def column(self, key: str, dtype: Any = None) -> np.ndarray:
+        """Array of `key` values (created empty when missing), to update in place."""
+        if key not in self.columns:
+            dtype = dtype or DTYPES.get(key, object)
+            self.columns[key] = np.zeros(len(self.index), dtype)
+            self.present[key] = np.zeros(len(self.index), bool)
+        self._values.pop(key, None)
+        return self.columns[key]
+
+    def set_column(
+        self, key: str, values: np.ndarray, present: Optional[np.ndarray] = None
+    ) -> None:
+        """Replace a whole column (e.g. with another dtype)."""
+        assert len(values) == len(self.index)
+        self.columns[key] = values
+        self.present[key] = (
+            np.ones(len(values), bool) if present is None else present.copy()
+        )
+        self._values.pop(key, None)
+
+    def values_of(self, key: str) -> list:
+        """Python values of a column, `_MISSING` for goals without a value."""
+        values = self._values.get(key)
+        if values is None:
+            if key not in self.columns:
+                raise KeyError(key)
+            values = self.columns[key].tolist()
+            for number in np.flatnonzero(~self.present[key]).tolist():
+                values[number] = _MISSING
+            self._values[key] = values
+        return values
+
+    def value(self, key: str, number: int) -> Any:
+        value = self.values_of(key)[number]
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def set_value(self, key: str, number: int, value: Any) -> None:
+        values = self._values.pop(key, None)
+        column = self.column(key)
+        column[number] = value
+        self.present[key][number] = True
+        if values is not None:
+            values[number] = column[number : number + 1].tolist()[0]
+            self._values[key] = values
+
+    def del_value(self, key: str, number: int) -> None:
+        self.value(key, number)  # raises KeyError for missing values
+        self.present[key][number] = False
+        if key in self._values:
+            self._values[key][number] = _MISSING
+
+    def __getitem__(self, goal_id: GoalId) -> NodeOpts:
+        number = self.index.numbers.get(goal_id)
+        if number is None:
+            raise KeyError(goal_id)
+        return NodeOpts(self, number)
+
+    def get(self, goal_id: GoalId, default: Any = None) -> Any:
+        number = self.index.numbers.get(goal_id)
+        return default if number is None else NodeOpts(self, number)
+
+    def __contains__(self, goal_id: object) -> bool:
+        return goal_id in self.index.numbers
+
+    def __iter__(self) -> Iterator[GoalId]:
+        return iter(self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def items(self) -> ItemsView:
+        return _Items(self)
+
+    def values(self) -> ValuesView:
+        return _Values(self)
+
+
+class _Items(ItemsView):
+    def __iter__(self) -> Iterator[tuple[GoalId, NodeOpts]]:
+        store = self._mapping
+        return zip(store.index.ids, map(NodeOpts, repeat(store), range(len(store))))
+
+
+class _Values(ValuesView):
+    def __iter__(self) -> Iterator[NodeOpts]:
+        store = self._mapping
+        return map(NodeOpts, repeat(store), range(len(store)))
+
+
+def neighbours(g: CompactGraph) -> tuple[np.ndarray, np.ndarray]:
+    """Distinct connected pairs (a, b) of goal numbers, in both directions."""
+    sources = g.sources().astype(np.int64)
+    targets = g.targets.astype(np.int64)
+    pairs = np.unique(
+        np.concatenate([sources * g.size + targets, targets * g.size + sources])
+    )
+    return pairs // g.size, pairs % g.size
+
+
+def adjust_columns(
+    store: LayoutStore, pairs: tuple[np.ndarray, np.ndarray], mult: float
+) -> None:
+    """Move goals towards average cols of their neighbours, in place."""
+    a, b = pairs
+    # `bincount` adds weights one by one, and pairs are sorted by (a, b), so
+    # neighbours of a goal are summed in the order of their dense numbers
+    cols = store.column("col")
+    if cols.dtype != np.float64:
+        cols = cols.astype(np.float64)
+        store.set_column("col", cols, store.present["col"])
+    size = len(cols)
+    count = np.bincount(a, minlength=size)
+    total = np.bincount(a, cols[b] - cols[a], size)
+    cols += mult * np.divide(total, count, out=np.zeros(size), where=count > 0)
+
+
+def _row_starts(sorted_rows: np.ndarray) -> np.ndarray:
+    """Index of the first item of its row, for every item of sorted rows."""
+    starts = np.flatnonzero(np.diff(sorted_rows, prepend=sorted_rows[:1] - 1))
+    return np.repeat(starts, np.diff(starts, append=len(sorted_rows)))
+
+
+def resolve_columns(store: LayoutStore, width: int) -> int:
+    """Put goals into distinct slots within rows in place, see `resolve_collisions`."""
+    rows = store.columns["row"]
+    cols = store.columns["col"]
+    order = np.lexsort((np.arange(len(rows)), cols, rows))
+    first = _row_starts(rows[order])
+    i = np.arange(len(order)) - first
+    counts = np.bincount(first)[first]
+    wanted = np.clip(np.rint(cols[order]), 0, width - 1).astype(np.int64)
+    # With u = slot - i, the greedy rule `slot = min(max(wanted, previous + 1),
+    # size - count + i)` becomes a running maximum of `wanted - i` from 0,
+    # capped by `size - count`; runs of rows are split apart by a row offset
+    shift = first * (2 * (width + len(rows)))
+    u = np.maximum.accumulate(np.maximum(wanted - i, 0) + shift) - shift
+    u = np.minimum(u, np.maximum(width, counts) - counts)
+    new_cols = np.empty(len(rows), np.int64)
+    new_cols[order] = u + i
+    cells = rows.astype(np.int64) * (2 * (width + len(rows))) + np.rint(cols)
+    fixed = len(cells) - len(np.unique(cells))
+    store.set_column("col", new_cols, store.present["col"])
+    return fixed
+
+
+def normalize_columns(store: LayoutStore, width: int) -> None:
+    """Turn cols into integer slots within rows in place, see `normalize_cols`."""
+    rows = store.columns["row"]
+    cols = store.columns["col"]
+    # Like Python `round`, `np.rint` goes to the even integer on ties
+    rounded = np.rint(cols)
+    empty_rows: list[int] = []
+    empty_cols: list[int] = []
+    order = np.lexsort((rounded, rows))
+    bounds = np.flatnonzero(np.diff(rows[order], prepend=-1, append=-1))
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        non_empty = set(rounded[order[start:end]].astype(int).tolist())
+        need_drop = (end - start) - len(non_empty)
+        empty = {x for x in range(width)}.difference(non_empty)
+        # Fake goals may overflow a layer, so there may be not enough empty slots
+        for i in range(min(need_drop, len(empty))):
+            empty.pop()
+        empty_rows.extend([int(rows[order[start]])] * len(empty))
+        empty_cols.extend(empty)
+    # Empty slots get EMPTY_SLOT numbers, so they go first among equal cols
+    all_rows = np.concatenate([rows, np.array(empty_rows, rows.dtype)])
+    all_cols = np.concatenate([cols, np.array(empty_cols, cols.dtype)])
+    numbers = np.concatenate(
+        [np.arange(len(rows)), np.full(len(empty_rows), EMPTY_SLOT)]
+    )
+    order = np.lexsort((numbers, all_cols, all_rows))
+    slot = np.arange(len(order)) - _row_starts(all_rows[order])
+    goals = numbers[order] != EMPTY_SLOT
+    new_cols = np.empty(len(rows), np.int64)
+    new_cols[numbers[order][goals]] = slot[goals]
+    store.set_column("col", new_cols, store.present["col"])
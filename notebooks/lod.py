@@ -0,0 +1,285 @@
+"""Level of detail: collapse goals far from the selection before layout.
+
+Goals within `distance` edges (in any direction) from the selected goal stay
+visible. Hidden goals are replaced with summary pseudo goals (string ids):
+
+* hidden descendants of a visible goal `v` are collapsed into `"{v}_more"`,
+  a summary with no outgoing edges;
+* all other hidden goals (ancestors of the visible area, unrelated subgraphs)
+  are collapsed into `ABOVE`, a summary with no incoming edges.
+
+That's why collapsing never creates cycles, and layout (`build_with` and the
+rest) scales with the visible neighbourhood only. Later, a summary may be
+expanded: its goals are laid out separately and placed from the row of the
+summary down (or above everything, for `ABOVE`). The rest of the layout keeps
+its rows and cols, except that rows may be inserted to make room.
+"""
+
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional
+
+from siebenapp import EdgeType, GoalId, RenderResult, RenderRow
+from render import layout_of, render
+
+ABOVE = "more_above"
+
+
+def summary_id(goal_id: GoalId) -> str:
+    return f"{goal_id}_more"
+
+
+def incoming(rr: RenderResult) -> dict[GoalId, list[GoalId]]:
+    result: dict[GoalId, list[GoalId]] = {row.goal_id: [] for row in rr.rows}
+    for row in rr.rows:
+        for e in row.edges:
+            result[e[0]].append(row.goal_id)
+    return result
+
+
+def neighbourhood(rr: RenderResult, center: GoalId, distance: int) -> list[GoalId]:
+    """Goals not farther than `distance` edges from `center`, in BFS order."""
+    parents = incoming(rr)
+    seen: dict[GoalId, int] = {center: 0}
+    queue: deque[GoalId] = deque([center])
+    while queue:
+        g = queue.popleft()
+        if seen[g] == distance:
+            continue
+        for g1 in [e[0] for e in rr.by_id(g).edges] + parents[g]:
+            if g1 not in seen:
+                seen[g1] = seen[g] + 1
+                queue.append(g1)
+    return list(seen)
+
+
+@dataclass
+class Collapsed:
+    source: RenderResult  # a full graph
+    rr: RenderResult  # visible goals and summaries, ready for layout
+    owner: dict[GoalId, str]  # hidden (not expanded yet) goal -> its summary
+    # Summary -> its hidden goals, the other way round
+    groups: dict[str, list[GoalId]] = field(default_factory=dict)
+
+    def __post_init__(self):
+        if not self.groups:
+            for g, summary in self.owner.items():
+                self.groups.setdefault(summary, []).append(g)
+
+    def members(self, summary: str) -> list[GoalId]:
+        return self.groups.get(summary, [])
+
+    def expand(
+        self, laid_out: RenderResult, summary: str, width: int
+    ) -> RenderResult:
+        """Replace `summary` in a laid out graph with its goals.
+
+        Only the goals of the summary are laid out, and their layers are put
+        into free cols of rows starting from the row of the summary. A row
+        without enough room for a layer is inserted, moving everything below
+        down. Goals of `ABOVE` go into new rows above everything else, as
+        they are ancestors of the visible goals. Edges of the new goals and of
+        summaries are rebuilt, and goals the new goals link to (other
+        summaries, goals of summaries expanded earlier) are moved below them,
+        along with their own descendants when needed, so all edges still go
+        down. Work is proportional to the laid out graph, not to the source.
+        """
+        ordered = self.groups.pop(summary)
+        members = set(ordered)
+        for g in ordered:
+            del self.owner[g]
+        # `parents` of the source graph are built once and then reused
+        parents = self.source.parents
+        sub = RenderResult(
+            [_restricted(self.source.by_id(g), members) for g in ordered],
+            select=self.source.select,
+            node_opts={g: {} for g in members},
+            roots={g for g in members if not any(p in members for p in parents[g])},
+        )
+        placed = layout_of(render(sub, width))
+        placement = layout_of(laid_out)
+        top_row, _ = placement.pop(summary)
+        height = 1 + max(row for row, _ in placed.values())
+        by_layer: list[list[GoalId]] = [[] for _ in range(height)]
+        for g, (row, _) in placed.items():
+            by_layer[row].append(g)
+        row = top_row
+        for layer, goals in enumerate(by_layer):
+            busy = {c for r, c in placement.values() if r == row}
+            free = [c for c in range(width) if c not in busy]
+            if summary == ABOVE or len(free) < len(goals):
+                placement = _insert_row(placement, row)
+                free = list(range(width))
+            for g in sorted(goals, key=lambda g: placed[g][1]):
+                col = min(free, key=lambda c: (abs(c - placed[g][1]), c))
+                free.remove(col)
+                placement[g] = (row, col)
+            row += 1
+        present = set(placement)
+        rows = [
+            self._mapped(self.source.by_id(g), present)
+            if g in self.source.index
+            else self._summary(laid_out.by_id(g), members)
+            for g in placement
+        ]
+        placement = _without_empty_rows(
+            _pushed_down(placement, rows, list(members), width)
+        )
+        return RenderResult(
+            rows,
+            select=laid_out.select,
+            node_opts={g: {"row": r, "col": c} for g, (r, c) in placement.items()},
+            roots={g for g in laid_out.roots if g in present}
+            | {g for g in members if g in sub.roots and summary == ABOVE},
+        )
+
+    def _summary(self, row: RenderRow, new_goals: set[GoalId]) -> RenderRow:
+        """A summary row with edges to `new_goals` from goals it still holds
+        added (goals it already links to stay in the layout)."""
+        if row.goal_id != ABOVE:
+            # Summaries of descendants have no edges (see `collapse`)
+            return row
+        edges: dict[GoalId, EdgeType] = dict(row.edges)
+        for g in new_goals:
+            for p in self.source.parents[g]:
+                if self.owner.get(p) != ABOVE:
+                    continue
+                for target, edge_type in self.source.by_id(p).edges:
+                    if target == g:
+                        edges[g] = max(edges.get(g, EdgeType.BLOCKER), edge_type)
+        return _with_edges(row, list(edges.items()))
+
+    def _mapped(self, row: RenderRow, present: set[GoalId]) -> RenderRow:
+        edges: dict[GoalId, EdgeType] = {}
+        for target, edge_type in row.edges:
+            if target not in present:
+                target = self.owner[target]
+            if target in present:
+                edges[target] = max(edges.get(target, EdgeType.BLOCKER), edge_type)
+        return _with_edges(row, list(edges.items()))
+
+
+def _with_edges(row: RenderRow, edges: list[tuple[GoalId, EdgeType]]) -> RenderRow:
+    return RenderRow(
+        row.goal_id,
+        row.raw_id,
+        row.name,
+        row.is_open,
+        row.is_switchable,
+        edges,
+        row.attrs,
+    )
+
+
+def _restricted(row: RenderRow, goals: set[GoalId]) -> RenderRow:
+    return _with_edges(row, [e for e in row.edges if e[0] in goals])
+
+
+def _insert_row(
+    placement: dict[GoalId, tuple[int, int]], at: int
+) -> dict[GoalId, tuple[int, int]]:
+    """Move goals from row `at` and below one row down."""
+    return {g: (r + 1 if r >= at else r, c) for g, (r, c) in placement.items()}
+
+
+def _pushed_down(
+    placement: dict[GoalId, tuple[int, int]],
+    rows: list[RenderRow],
+    starts: list[GoalId],
+    width: int,
+) -> dict[GoalId, tuple[int, int]]:
+    """Move goals below all their parents, starting from `starts` and going
+    down through goals which were moved. Inserted rows move everything below
+    them, so edges which already go down keep going down."""
+    children = {row.goal_id: [e[0] for e in row.edges] for row in rows}
+    parents: dict[GoalId, list[GoalId]] = {g: [] for g in children}
+    for row in rows:
+        for e in row.edges:
+            parents[e[0]].append(row.goal_id)
+    queue = deque(starts)
+    queue.extend(g for start in starts for g in children[start])
+    while queue:
+        g = queue.popleft()
+        need = 1 + max((placement[p][0] for p in parents[g]), default=-1)
+        if placement[g][0] >= need:
+            continue
+        col = placement.pop(g)[1]
+        busy = {c for r, c in placement.values() if r == need}
+        free = [c for c in range(width) if c not in busy]
+        if not free:
+            placement = _insert_row(placement, need)
+            free = list(range(width))
+        placement[g] = (need, min(free, key=lambda c: (abs(c - col), c)))
+        queue.extend(children[g])
+    return placement
+
+
+def _without_empty_rows(
+    placement: dict[GoalId, tuple[int, int]]
+) -> dict[GoalId, tuple[int, int]]:
+    used = {r: i for i, r in enumerate(sorted({r for r, _ in placement.values()}))}
+    return {g: (used[r], c) for g, (r, c) in placement.items()}
+
+
+def _summary_row(goal_id: str, amount: int, edges) -> RenderRow:
+    return RenderRow(goal_id, 0, f"{amount} more goals", True, False, edges, {})
+
+
+def collapse(
+    rr: RenderResult, distance: int, center: Optional[GoalId] = None
+) -> Collapsed:
+    """Collapse all goals farther than `distance` from `center` (selected goal
+    by default) into summary pseudo goals."""
+    if center is None:
+        center = rr.select[0]
+    visible_order = neighbourhood(rr, center, distance)
+    visible = set(visible_order)
+
+    # Hidden descendants belong to the nearest visible goal above them
+    owner: dict[GoalId, str] = {}
+    queue: deque[tuple[GoalId, str]] = deque()
+    for g in visible_order:
+        for e in rr.by_id(g).edges:
+            if e[0] not in visible and e[0] not in owner:
+                owner[e[0]] = summary_id(g)
+                queue.append((e[0], summary_id(g)))
+    while queue:
+        g, summary = queue.popleft()
+        for e in rr.by_id(g).edges:
+            if e[0] not in visible and e[0] not in owner:
+                owner[e[0]] = summary
+                queue.append((e[0], summary))
+    below = set(owner.values())
+    for row in rr.rows:
+        if row.goal_id not in visible and row.goal_id not in owner:
+            owner[row.goal_id] = ABOVE
+
+    result = Collapsed(rr, rr, owner)
+    rows: list[RenderRow] = []
+    has_parent: set[GoalId] = set()
+    above_edges: dict[GoalId, EdgeType] = {}
+    for row in rr.rows:
+        g = row.goal_id
+        if g in visible:
+            mapped = result._mapped(row, visible | below)
+            rows.append(mapped)
+            has_parent.update(e[0] for e in mapped.edges)
+        elif owner[g] == ABOVE:
+            # Only these edges from hidden goals to visible ones are kept. Edges
+            # from hidden descendants are dropped, or they could make a cycle
+            for target, edge_type in row.edges:
+                if target in visible:
+                    above_edges[target] = max(
+                        above_edges.get(target, EdgeType.BLOCKER), edge_type
+                    )
+    amounts: dict[str, int] = {}
+    for summary in owner.values():
+        amounts[summary] = amounts.get(summary, 0) + 1
+    rows.extend(_summary_row(s, amounts[s], []) for s in sorted(below))
+    roots = {g for g in visible if g not in has_parent and g not in above_edges}
+    if ABOVE in amounts:
+        rows.append(_summary_row(ABOVE, amounts[ABOVE], list(above_edges.items())))
+        roots.add(ABOVE)
+    node_opts: dict[GoalId, dict] = {row.goal_id: {} for row in rows}
+    result.rr = RenderResult(rows, select=rr.select, node_opts=node_opts, roots=roots)
+    return result
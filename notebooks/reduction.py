@@ -0,0 +1,111 @@
+"""Transitive reduction pre-pass.
+
+An edge `a -> c` is redundant for layout when `c` is also reachable from `a`
+through another path: the longer path already forces `c` below `a`. Dropping
+such edges makes every later stage cheaper (`find_previous`, readiness checks
+in `tube`, neighbour sets in `calc_shift`, fake goals), while original edges
+are put back for drawing.
+
+Reachability is kept as bitsets (Python ints). Goals are numbered in DFS
+post-order, so descendants of a goal get smaller numbers, and a bitset is
+stored as (offset, bits) to cover only the range of numbers it uses. A bitset
+is dropped as soon as all parents of its goal are processed.
+"""
+
+from siebenapp import GoalId, RenderResult, RenderRow
+from render import render
+
+# Descendants of a goal: bit `i` of `bits` stands for the goal number `offset + i`
+Reach = tuple[int, int]
+
+EMPTY: Reach = (0, 0)
+
+
+def _union(a: Reach, b: Reach) -> Reach:
+    if not a[1]:
+        return b
+    if not b[1]:
+        return a
+    offset = min(a[0], b[0])
+    return offset, (a[1] << (a[0] - offset)) | (b[1] << (b[0] - offset))
+
+
+def _has(reach: Reach, number: int) -> bool:
+    return number >= reach[0] and bool(reach[1] >> (number - reach[0]) & 1)
+
+
+def postorder(rr: RenderResult) -> list[GoalId]:
+    """All goals, every goal after all its descendants."""
+    result: list[GoalId] = []
+    done: set[GoalId] = set()
+    starts = list(rr.roots) + [row.goal_id for row in rr.rows]
+    for start in starts:
+        if start in done:
+            continue
+        done.add(start)
+        stack = [(start, iter(rr.by_id(start).edges))]
+        while stack:
+            goal_id, edges = stack[-1]
+            for e in edges:
+                if e[0] not in done:
+                    done.add(e[0])
+                    stack.append((e[0], iter(rr.by_id(e[0]).edges)))
+                    break
+            else:
+                stack.pop()
+                result.append(goal_id)
+    return result
+
+
+def redundant_edges(rr: RenderResult) -> set[tuple[GoalId, GoalId]]:
+    """Edges (source, target) implied by other paths."""
+    order = postorder(rr)
+    number = {goal_id: i for i, goal_id in enumerate(order)}
+    waiting: dict[int, int] = {i: 0 for i in range(len(order))}
+    for row in rr.rows:
+        for target in {e[0] for e in row.edges}:
+            waiting[number[target]] += 1
+
+    result: set[tuple[GoalId, GoalId]] = set()
+    reach: dict[int, Reach] = {}
+    for i, goal_id in enumerate(order):
+        children = list(dict.fromkeys(number[e[0]] for e in rr.by_id(goal_id).edges))
+        below = EMPTY
+        for c in children:
+            below = _union(below, reach[c])
+        for c in children:
+            if _has(below, c):
+                result.add((goal_id, order[c]))
+            below = _union(below, (c, 1))
+        reach[i] = below
+        for c in children:
+            waiting[c] -= 1
+            if not waiting[c]:
+                del reach[c]
+    return result
+
+
+def reduce_edges(rr: RenderResult) -> RenderResult:
+    """A copy of `rr` without redundant edges, to be used for layout only."""
+    redundant = redundant_edges(rr)
+    rows = [
+        RenderRow(
+            row.goal_id,
+            row.raw_id,
+            row.name,
+            row.is_open,
+            row.is_switchable,
+            [e for e in row.edges if (row.goal_id, e[0]) not in redundant],
+            row.attrs,
+        )
+        for row in rr.rows
+    ]
+    return RenderResult(rows, select=rr.select, node_opts=rr.node_opts, roots=rr.roots)
+
+
+def render_reduced(rr: RenderResult, width: int) -> RenderResult:
+    """Lay out a reduced graph, then return placements with original edges."""
+    laid_out = render(reduce_edges(rr), width)
+    return RenderResult(
+        rr.rows, node_opts=laid_out.node_opts, select=rr.select, roots=rr.roots
+    )
@@ -0,0 +1,169 @@
+"""Layout quality metrics and refinement passes over a finished layout.
+
+All functions expect every goal to have integer "row" and "col" (i.e. the
+layout is already normalized), and never change rows of goals.
+"""
+
+from typing import Iterator
+
+from siebenapp import GoalId, RenderResult, is_fake_row
+
+# One crossing is worth that many columns of total edge length
+CROSSING_WEIGHT = 4.0
+
+
+def is_fake(rr: RenderResult, goal_id: GoalId) -> bool:
+    return is_fake_row(rr.by_id(goal_id))
+
+
+def edges(rr: RenderResult) -> Iterator[tuple[GoalId, GoalId]]:
+    for row in rr.rows:
+        for e in row.edges:
+            yield row.goal_id, e[0]
+
+
+def _position(rr: RenderResult, goal_id: GoalId) -> tuple[int, float]:
+    opts = rr.node_opts[goal_id]
+    return opts["row"], opts["col"]
+
+
+def _inversions(values: list[float]) -> int:
+    """Amount of pairs i < j with values[i] > values[j] (merge sort, in place)."""
+    if len(values) < 2:
+        return 0
+    middle = len(values) // 2
+    left, right = values[:middle], values[middle:]
+    result = _inversions(left) + _inversions(right)
+    i = j = k = 0
+    while i < len(left) and j < len(right):
+        if left[i] <= right[j]:
+            values[k] = left[i]
+            i += 1
+        else:
+            values[k] = right[j]
+            result += len(left) - i
+            j += 1
+        k += 1
+    values[k:] = left[i:] + right[j:]
+    return result
+
+
+def crossings(rr: RenderResult) -> int:
+    """Amount of edge crossings.
+
+    Long edges are split into segments between neighbour rows (as if there
+    were fake goals on them), then crossings are counted as inversions between
+    segments of every gap, in O(S log S) for S segments.
+    """
+    gaps: dict[int, list[tuple[float, float]]] = {}
+    for source, target in edges(rr):
+        (r1, c1), (r2, c2) = sorted((_position(rr, source), _position(rr, target)))
+        span = r2 - r1
+        for r in range(r1, r2):
+            x1 = c1 + (c2 - c1) * (r - r1) / span
+            x2 = c1 + (c2 - c1) * (r + 1 - r1) / span
+            gaps.setdefault(r, []).append((x1, x2))
+    total = 0
+    for segments in gaps.values():
+        segments.sort()
+        total += _inversions([s[1] for s in segments])
+    return total
+
+
+def edge_span(rr: RenderResult) -> float:
+    """Total horizontal length of all edges."""
+    return sum(
+        abs(_position(rr, source)[1] - _position(rr, target)[1])
+        for source, target in edges(rr)
+    )
+
+
+def layer_span(rr: RenderResult) -> int:
+    """Total vertical length of all edges (1 for each edge between neighbours)."""
+    return sum(
+        abs(_position(rr, source)[0] - _position(rr, target)[0])
+        for source, target in edges(rr)
+    )
+
+
+def fake_count(rr: RenderResult) -> int:
+    return sum(1 for row in rr.rows if is_fake_row(row))
+
+
+def layout_cost(rr: RenderResult) -> float:
+    """Single number to compare layouts of the same graph: less is better."""
+    return CROSSING_WEIGHT * crossings(rr) + edge_span(rr)
+
+
+def _layers(rr: RenderResult) -> dict[int, list[GoalId]]:
+    layers: dict[int, list[GoalId]] = {}
+    for goal_id, opts in rr.node_opts.items():
+        layers.setdefault(opts["row"], []).append(goal_id)
+    return layers
+
+
+def _with_cols(rr: RenderResult, cols: dict[GoalId, float]) -> RenderResult:
+    new_opts = {
+        goal_id: opts | {"col": cols[goal_id]} for goal_id, opts in rr.node_opts.items()
+    }
+    return RenderResult(rr.rows, node_opts=new_opts, select=rr.select, roots=rr.roots)
+
+
+def reduce_crossings(rr: RenderResult) -> RenderResult:
+    """One down and one up barycenter sweep.
+
+    Goals of every layer are re-ordered by the average column of their
+    neighbours in the previous layers of the sweep. A layer keeps its set of
+    occupied columns, so the width limit is respected.
+    """
+    cols = {goal_id: opts["col"] for goal_id, opts in rr.node_opts.items()}
+    rows = {goal_id: opts["row"] for goal_id, opts in rr.node_opts.items()}
+    above: dict[GoalId, list[GoalId]] = {goal_id: [] for goal_id in cols}
+    below: dict[GoalId, list[GoalId]] = {goal_id: [] for goal_id in cols}
+    for source, target in edges(rr):
+        upper, lower = sorted((source, target), key=rows.__getitem__)
+        if rows[upper] != rows[lower]:
+            above[lower].append(upper)
+            below[upper].append(lower)
+    layers = _layers(rr)
+    for order, neighbours in ((sorted(layers), above), (sorted(layers)[::-1], below)):
+        for layer in order:
+            goals = layers[layer]
+            slots = sorted(cols[g] for g in goals)
+            barycenter = {
+                g: (
+                    sum(cols[n] for n in neighbours[g]) / len(neighbours[g])
+                    if neighbours[g]
+                    else cols[g]
+                )
+                for g in goals
+            }
+            goals.sort(key=lambda g: (barycenter[g], cols[g]))
+            for g, slot in zip(goals, slots):
+                cols[g] = slot
+    return _with_cols(rr, cols)
+
+
+def straighten_fakes(rr: RenderResult) -> RenderResult:
+    """Move fake goals right under the goal they continue, when there's room.
+
+    Layers are visited top down, so a whole chain of fake goals may become a
+    straight vertical line in one pass.
+    """
+    cols = {goal_id: opts["col"] for goal_id, opts in rr.node_opts.items()}
+    upper: dict[GoalId, GoalId] = {}
+    for source, target in edges(rr):
+        if is_fake(rr, target):
+            upper[target] = source
+    layers = _layers(rr)
+    for layer in sorted(layers):
+        occupied = {cols[g] for g in layers[layer]}
+        for g in layers[layer]:
+            if g not in upper:
+                continue
+            wanted = cols[upper[g]]
+            if wanted != cols[g] and wanted not in occupied:
+                occupied.discard(cols[g])
+                occupied.add(wanted)
+                cols[g] = wanted
+    return _with_cols(rr, cols)
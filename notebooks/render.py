@@ -0,0 +1,595 @@
+"""Layering pipeline from part 13, extracted from marimo cells into a plain module.
+
+UI values used by the notebook (render width, amount of steps, fake goals flag)
+are passed as arguments here. Everything else follows the notebook code.
+"""
+
+from collections.abc import Mapping
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Any, Callable, Generator, Iterator, Optional
+
+import numpy as np
+
+from siebenapp import (
+    FAKE_ATTR,
+    EdgeType,
+    GoalId,
+    RenderResult,
+    RenderRow,
+    is_real_goal,
+)
+from compact import CompactGraph
+from layout_store import (
+    EMPTY_SLOT,
+    LayoutStore,
+    adjust_columns,
+    neighbours,
+    normalize_columns,
+    resolve_columns,
+)
+
+# A goal placed into a layer: (goal id, row, col)
+Placement = tuple[GoalId, int, int]
+
+# Cells (row, rounded col) are packed into a single int as `row << 32 | col`
+CELL_BITS = 32
+CELL_BIAS = 1 << (CELL_BITS - 1)
+
+
+# How much debug info `tube` puts into `RenderStep.raw` in fake goals mode
+class Capture(IntEnum):
+    OFF = 0  # only "passing_edges", needed by the next step
+    SUMMARY = 1  # sizes of debug structures instead of structures
+    FULL = 2  # everything, lists of rows are built on first access
+
+
+class LazyRaw(Mapping):
+    """Debug info where some values are computed on first access."""
+
+    def __init__(self, values: dict[str, Any], deferred: dict[str, Callable[[], Any]]):
+        self._values = values
+        self._deferred = deferred
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._deferred:
+            self._values[key] = self._deferred.pop(key)()
+        return self._values[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._values) + list(self._deferred))
+
+    def __len__(self) -> int:
+        return len(self._values) + len(self._deferred)
+
+
+@dataclass
+class RenderStep:
+    rr: RenderResult
+    roots: list[int]
+    layers: list[list[int]]
+    previous: dict[int, list[int]]
+    raw: Mapping[str, Any]  # for untyped, debug info
+    capture: Capture = Capture.OFF
+
+
+def pp(step: RenderStep):
+    return [step.roots, step.layers]
+
+
+def find_previous(rr: RenderResult) -> dict[int, list[int]]:
+    result: dict[int, list[int]] = {g: [] for g in rr.roots}
+    to_visit: set[int] = set(rr.roots)
+    while to_visit:
+        g = to_visit.pop()
+        connections = [e[0] for e in rr.by_id(g).edges]
+        for g1 in connections:
+            to_visit.add(g1)
+            result[g1] = result.get(g1, []) + [g]
+    return result
+
+
+def build_with(
+    rr: RenderResult,
+    fn: Callable[[RenderStep, int], RenderStep],
+    width: int,
+    steps: Optional[int] = None,
+    capture: Capture = Capture.OFF,
+) -> RenderStep:
+    step = RenderStep(rr, list(rr.roots), [], find_previous(rr), {}, capture)
+    counter = 0
+    while step.roots and (steps is None or counter < steps):
+        step = fn(step, width)
+        counter += 1
+    return step
+
+
+def tube(step: RenderStep, width: int, fake_goals: bool = False) -> RenderStep:
+    raw: dict[str, Any] = {}
+    new_layer: list[int] = []
+    already_added: set[int] = set(g for l in step.layers for g in l)
+
+    for goal_id in step.roots:
+        if len(new_layer) >= width:
+            break
+        if all(g in already_added for g in step.previous[goal_id]):
+            new_layer.append(goal_id)
+    new_roots: list[int] = step.roots[len(new_layer) :] + [
+        e[0] for gid in new_layer for e in step.rr.by_id(gid).edges
+    ]
+
+    new_rows = list(step.rr.rows)
+    new_previous = dict(step.previous)
+    # The first step copies node options into a store, next ones fill it in place
+    store = step.rr.node_opts
+    if not step.layers or not isinstance(store, LayoutStore):
+        store = LayoutStore.of(step.rr)
+    if fake_goals:
+        passing_edges = step.raw.get("passing_edges", set())
+        fakes = passing_edges.difference(set(new_layer))
+        fake_edges = set(
+            (g, f) for f in fakes for g in step.previous[f] if g in already_added
+        )
+        fake_for = set(e[0] for e in fake_edges)
+        add_to_new_layer = []
+        for down_goal in fake_for:
+            # Create a new fake goal
+            original_idx = step.rr.index[down_goal]
+            original_row = step.rr.by_id(down_goal)
+            fake_row_id = len(new_rows) + 1
+            replace_edges = set(f for g, f in fake_edges if g == down_goal)
+            edge_type = max(
+                [EdgeType.BLOCKER]
+                + [e[1] for e in original_row.edges if e in replace_edges]
+            )
+            new_edges = [e for e in original_row.edges if e[0] not in replace_edges]
+            new_edges.append((fake_row_id, edge_type))
+            clone_row = RenderRow(
+                original_row.goal_id,
+                original_row.raw_id,
+                original_row.name,
+                original_row.is_open,
+                original_row.is_switchable,
+                new_edges,
+                original_row.attrs,
+            )
+            fake_row = RenderRow(
+                fake_row_id,
+                fake_row_id,
+                f"fake {down_goal}@{len(step.layers) + 1}",
+                False,
+                False,
+                [e for e in original_row.edges if e[0] in fakes],
+                {FAKE_ATTR: "1"},
+            )
+            new_rows.pop(original_idx)
+            new_rows.insert(original_idx, clone_row)
+            new_rows.append(fake_row)
+            add_to_new_layer.append(fake_row_id)
+            new_previous[fake_row_id] = [down_goal]
+        store.extend(add_to_new_layer)
+        raw["passing_edges"] = fakes.union(
+            set(e[0] for g in new_layer for e in step.rr.by_id(g).edges)
+        )
+        if step.capture == Capture.SUMMARY:
+            raw["fakes"] = len(fakes)
+            raw["fake_edges"] = len(fake_edges)
+            raw["fake_for"] = len(fake_for)
+            raw["add_rows"] = raw["mod_rows"] = len(fake_for)
+        elif step.capture == Capture.FULL:
+            raw["fakes"] = fakes
+            raw["fake_edges"] = fake_edges
+            raw["fake_for"] = fake_for
+        new_layer.extend(add_to_new_layer)
+
+    numbers = np.array([store.index.number(g) for g in new_layer], np.int64)
+    store.fill("row", numbers, len(step.layers))
+    store.fill("col", numbers, np.arange(len(new_layer)))
+    new_layers = step.layers + [new_layer]
+    already_added.update(set(g for l in new_layers for g in l))
+    filtered_roots: list[int] = []
+    for g in new_roots:
+        if g not in already_added:
+            filtered_roots.append(g)
+            already_added.add(g)
+
+    result = RenderResult(
+        new_rows,
+        node_opts=store,
+        select=step.rr.select,
+        roots=step.rr.roots,
+    )
+    debug: Mapping[str, Any] = raw
+    if fake_goals and step.capture == Capture.FULL:
+        # Rows are taken from the result when (and if) somebody looks at them
+        debug = LazyRaw(
+            raw,
+            {
+                "add_rows": lambda: [result.by_id(f) for f in add_to_new_layer],
+                "mod_rows": lambda: [result.by_id(g) for g in fake_for],
+            },
+        )
+    return RenderStep(
+        result, filtered_roots, new_layers, new_previous, debug, step.capture
+    )
+
+
+def tube_with_fakes(step: RenderStep, width: int) -> RenderStep:
+    return tube(step, width, fake_goals=True)
+
+
+def iter_layers(
+    rr: RenderResult, width: int, fake_goals: bool = False
+) -> Generator[list[Placement], None, RenderResult]:
+    """Same layering as `build_with(rr, tube, width)`, but every layer is yielded
+    as soon as it's placed, so consumers may start drawing the top of a tree.
+
+    Columns are raw `tube` columns, horizontal tweaking needs a whole layout.
+    No intermediate RenderResults are built: pending state is the frontier,
+    the set of placed goals and counters of not yet placed parents (dropped
+    once a goal is placed). Fake goals change rows on the fly, so in that mode
+    `tube` steps are made as usual, and only yielding is progressive.
+
+    The generator returns the graph placed goals belong to: `rr` itself, or
+    its copy with fake goals (`laid_out = yield from iter_layers(...)`).
+    """
+    if fake_goals:
+        step = RenderStep(rr, list(rr.roots), [], find_previous(rr), {})
+        while step.roots:
+            step = tube_with_fakes(step, width)
+            row = len(step.layers) - 1
+            yield [(g, row, col) for col, g in enumerate(step.layers[-1])]
+        return step.rr
+
+    waiting: dict[GoalId, int] = {
+        g: len(set(previous)) for g, previous in find_previous(rr).items()
+    }
+    roots: list[GoalId] = list(rr.roots)
+    placed: set[GoalId] = set()
+    row = 0
+    while roots:
+        new_layer: list[GoalId] = []
+        for goal_id in roots:
+            if len(new_layer) >= width:
+                break
+            if waiting[goal_id] == 0:
+                new_layer.append(goal_id)
+        new_roots = roots[len(new_layer) :]
+        for goal_id in new_layer:
+            children = [e[0] for e in rr.by_id(goal_id).edges]
+            new_roots.extend(children)
+            for child in set(children):
+                waiting[child] -= 1
+            del waiting[goal_id]
+            placed.add(goal_id)
+        yield [(g, row, col) for col, g in enumerate(new_layer)]
+        row += 1
+        queued: set[GoalId] = set()
+        roots = []
+        for g in new_roots:
+            if g not in placed and g not in queued:
+                roots.append(g)
+                queued.add(g)
+    return rr
+
+
+def avg(vals):
+    return sum(vals) / len(vals)
+
+
+def shift_neutral(ds):
+    # A goal without connections has nothing to be attracted to
+    return avg([d[1] for d in ds]) if ds else 0.0
+
+
+def calc_shift(rr: RenderResult, shift_fn):
+    connected: dict[int, set[int]] = {row.goal_id: set() for row in rr.rows}
+    for row in rr.rows:
+        for e in row.edges:
+            connected[e[0]].add(row.goal_id)
+            connected[row.goal_id].add(e[0])
+
+    result = {}
+    for row in rr.rows:
+        goal_id = row.goal_id
+        opts = rr.node_opts[goal_id]
+        row_, col_ = opts["row"], opts["col"]
+        deltas = [
+            (rr.node_opts[c]["row"] - row_, rr.node_opts[c]["col"] - col_)
+            for c in connected[goal_id]
+        ]
+        result[goal_id] = shift_fn(deltas)
+    return result
+
+
+def adjust_horisontal(rr: RenderResult, mult):
+    store = LayoutStore.of(rr)
+    adjust_columns(store, neighbours(CompactGraph.from_result(rr)), mult)
+    return RenderResult(rr.rows, node_opts=store, select=rr.select, roots=rr.roots)
+
+
+def normalize_cols(rr: RenderResult, width: int) -> RenderResult:
+    """Turn float columns into integer slots 0..width-1 within each layer.
+
+    Goals are sorted by dense numbers from `rr.goal_index` instead of goal ids,
+    so string pseudo goals are welcome, and empty slots get `EMPTY_SLOT`.
+    """
+    store = LayoutStore.of(rr)
+    normalize_columns(store, width)
+    return RenderResult(rr.rows, node_opts=store, select=rr.select, roots=rr.roots)
+
+
+def pack_cell(row: int, col: int) -> int:
+    return (row << CELL_BITS) | (col + CELL_BIAS)
+
+
+def unpack_cell(cell: int) -> tuple[int, int]:
+    return cell >> CELL_BITS, (cell & ((1 << CELL_BITS) - 1)) - CELL_BIAS
+
+
+def find_collisions(rr: RenderResult) -> dict[tuple[int, int], list[GoalId]]:
+    """Goals sharing the same (row, rounded col) cell, for every such cell."""
+    cells: dict[int, list[GoalId]] = {}
+    for goal_id, opts in rr.node_opts.items():
+        cell = pack_cell(opts["row"], round(opts["col"]))
+        cells.setdefault(cell, []).append(goal_id)
+    return {unpack_cell(c): goals for c, goals in cells.items() if len(goals) > 1}
+
+
+def resolve_collisions(rr: RenderResult, width: int) -> tuple[RenderResult, int]:
+    """Put goals into distinct integer slots 0..width-1, keeping their order.
+
+    Goals of a row are taken from left to right, and every goal gets the slot
+    nearest to its rounded column which is right of the previous goal and
+    leaves enough slots for the rest. Rows with more goals than `width`
+    (possible with fake goals) just get slots 0..N-1. Returns the new result
+    and the amount of collisions fixed (goals sharing a cell with another one).
+    """
+    store = LayoutStore.of(rr)
+    fixed = resolve_columns(store, width)
+    result = RenderResult(rr.rows, node_opts=store, select=rr.select, roots=rr.roots)
+    return result, fixed
+
+
+def previous_cols(rr: RenderResult, previous: RenderResult) -> dict[GoalId, float]:
+    """Columns of goals that were already placed in a `previous` render."""
+    result = {}
+    for goal_id in rr.node_opts:
+        col = previous.node_opts.get(goal_id, {}).get("col")
+        if col is not None:
+            result[goal_id] = col
+    return result
+
+
+def adjust_until_stable(
+    rr: RenderResult,
+    mult: float,
+    tolerance: float,
+    max_passes: int,
+    anchors: Optional[dict[GoalId, float]] = None,
+    anchor: float = 0.5,
+) -> tuple[RenderResult, int]:
+    """Repeat `adjust_horisontal` until no goal moves by `tolerance` or more.
+
+    Goals from `anchors` are also pulled back to their anchor columns with
+    the given strength, so the result stays close to them. Returns the
+    adjusted result and the amount of passes made.
+    """
+    anchors = anchors or {}
+    store = LayoutStore.of(rr)
+    pairs = neighbours(CompactGraph.from_result(rr))
+    anchored = np.array([store.index.number(g) for g in anchors], np.int64)
+    targets = np.array(list(anchors.values()), np.float64)
+    passes = 0
+    while passes < max_passes:
+        before = store.columns["col"].astype(np.float64)
+        adjust_columns(store, pairs, mult)
+        cols = store.column("col")
+        cols[anchored] = (1 - anchor) * cols[anchored] + anchor * targets
+        passes += 1
+        if np.abs(cols - before).max(initial=0.0) < tolerance:
+            break
+    result = RenderResult(rr.rows, node_opts=store, select=rr.select, roots=rr.roots)
+    return result, passes
+
+
+def tweak_horizontal(
+    rr: RenderResult,
+    width: int,
+    previous: Optional[RenderResult] = None,
+    tolerance: float = 0.25,
+    max_passes: int = 8,
+) -> RenderResult:
+    """Horizontal adjustment and normalization.
+
+    When a `previous` render of (almost) the same graph is given, columns are
+    warm-started from it and anchored to it, and the adjustment is repeated
+    until columns stop moving. Otherwise, two fixed passes are made.
+    """
+    if previous is not None:
+        anchors = previous_cols(rr, previous)
+        seeded = LayoutStore.of(rr)
+        numbers = np.array([seeded.index.number(g) for g in anchors], np.int64)
+        cols = seeded.column("col").astype(np.float64)
+        cols[numbers] = list(anchors.values())
+        seeded.set_column("col", cols, seeded.present["col"])
+        r1 = RenderResult(rr.rows, node_opts=seeded, select=rr.select, roots=rr.roots)
+        r2, _ = adjust_until_stable(r1, 0.5, tolerance, max_passes, anchors)
+        store = r2.node_opts
+    else:
+        store = LayoutStore.of(rr)
+        pairs = neighbours(CompactGraph.from_result(rr))
+        adjust_columns(store, pairs, 1.0)
+        adjust_columns(store, pairs, 0.5)
+    resolve_columns(store, width)
+    normalize_columns(store, width)
+    return RenderResult(rr.rows, node_opts=store, select=rr.select, roots=rr.roots)
+
+
+class _FakeChains:
+    """Fake goals being added to a laid out graph by `add_fake_goals`."""
+
+    def __init__(self, r: RenderResult):
+        self.r = r
+        # Fake goals have int ids too, so new ones go above all of them
+        self.next_id = 1 + max((g for g in r.index if is_real_goal(g)), default=0)
+        self.edges: dict[GoalId, list[tuple[GoalId, EdgeType]]] = {}
+        self.opts: dict[GoalId, dict] = {}
+        self.names: dict[GoalId, str] = {}
+
+    def pos(self, goal_id: GoalId) -> tuple[int, float]:
+        opts = self.opts.get(goal_id) or self.r.node_opts[goal_id]
+        return opts["row"], opts["col"]
+
+    def chain(
+        self, label: GoalId, first_row: int, last_row: int, edge_type: EdgeType
+    ) -> list[GoalId]:
+        """Fake goals on rows `first_row`..`last_row`, linked with edges. Their
+        cols are set later. `label` is a goal the chain belongs to."""
+        result: list[GoalId] = []
+        for row in range(first_row, last_row + 1):
+            fake_id = self.next_id
+            self.next_id += 1
+            self.names[fake_id] = f"fake {label}@{row}"
+            self.opts[fake_id] = {"row": row, "col": 0.0}
+            self.edges[fake_id] = []
+            if result:
+                self.link(result[-1], fake_id, edge_type)
+            result.append(fake_id)
+        return result
+
+    def link(self, source: GoalId, target: GoalId, edge_type: EdgeType) -> None:
+        edges = self.edges.setdefault(source, [])
+        for i, (g, t) in enumerate(edges):
+            if g == target:
+                edges[i] = (g, max(t, edge_type))
+                return
+        edges.append((target, edge_type))
+
+    def place(self, chain: list[GoalId], source: GoalId, target: GoalId) -> None:
+        """Put a chain on a straight line between two goals (a vertical one,
+        when they are the same goal)."""
+        (r1, c1), (r2, c2) = self.pos(source), self.pos(target)
+        for fake_id in chain:
+            row = self.opts[fake_id]["row"]
+            self.opts[fake_id]["col"] = (
+                c1 if r1 == r2 else c1 + (c2 - c1) * (row - r1) / (r2 - r1)
+            )
+
+
+def add_fake_goals(
+    r: RenderResult, width: int, concentrate: bool = False
+) -> RenderResult:
+    """Split every edge longer than 1 layer with fake goals on each layer.
+
+    By default, every long edge gets its own chain of fake goals. With
+    `concentrate`, long edges from the same source share a single chain that
+    goes straight down and splits only at the layer right above each target.
+    Remaining long edges with the same target are merged the same way, from
+    the target upwards. Cols are normalized afterwards.
+    """
+    fakes = _FakeChains(r)
+    long_edges: list[tuple[GoalId, GoalId, EdgeType]] = []
+    for row in r.rows:
+        for target, edge_type in row.edges:
+            if fakes.pos(target)[0] - fakes.pos(row.goal_id)[0] > 1:
+                long_edges.append((row.goal_id, target, edge_type))
+            else:
+                fakes.link(row.goal_id, target, edge_type)
+
+    single = long_edges
+    if concentrate:
+        by_source: dict[GoalId, list[tuple[GoalId, EdgeType]]] = {}
+        for source, target, edge_type in long_edges:
+            by_source.setdefault(source, []).append((target, edge_type))
+        single = []
+        for source, targets in by_source.items():
+            if len(targets) == 1:
+                single.append((source, *targets[0]))
+                continue
+            s_row = fakes.pos(source)[0]
+            last_row = max(fakes.pos(t)[0] for t, _ in targets) - 1
+            edge_type = max(t for _, t in targets)
+            trunk = fakes.chain(source, s_row + 1, last_row, edge_type)
+            fakes.place(trunk, source, source)
+            fakes.link(source, trunk[0], edge_type)
+            for target, edge_type in targets:
+                fakes.link(trunk[fakes.pos(target)[0] - s_row - 2], target, edge_type)
+
+        by_target: dict[GoalId, list[tuple[GoalId, EdgeType]]] = {}
+        for source, target, edge_type in single:
+            by_target.setdefault(target, []).append((source, edge_type))
+        single = []
+        for target, sources in by_target.items():
+            if len(sources) == 1:
+                single.append((sources[0][0], target, sources[0][1]))
+                continue
+            t_row = fakes.pos(target)[0]
+            first_row = max(fakes.pos(s)[0] for s, _ in sources) + 1
+            edge_type = max(t for _, t in sources)
+            trunk = fakes.chain(target, first_row, t_row - 1, edge_type)
+            fakes.place(trunk, target, target)
+            fakes.link(trunk[-1], target, edge_type)
+            for source, edge_type in sources:
+                s_row = fakes.pos(source)[0]
+                branch = fakes.chain(source, s_row + 1, first_row - 1, edge_type)
+                fakes.place(branch, source, trunk[0])
+                for g, g1 in zip([source] + branch, branch + [trunk[0]]):
+                    fakes.link(g, g1, edge_type)
+
+    for source, target, edge_type in single:
+        s_row = fakes.pos(source)[0]
+        t_row = fakes.pos(target)[0]
+        chain = fakes.chain(source, s_row + 1, t_row - 1, edge_type)
+        fakes.place(chain, source, target)
+        for g, g1 in zip([source] + chain, chain + [target]):
+            fakes.link(g, g1, edge_type)
+
+    rows = [
+        RenderRow(
+            row.goal_id,
+            row.raw_id,
+            row.name,
+            row.is_open,
+            row.is_switchable,
+            fakes.edges.get(row.goal_id, []),
+            row.attrs,
+        )
+        for row in r.rows
+    ] + [
+        RenderRow(
+            fake_id, fake_id, name, False, False, fakes.edges[fake_id], {FAKE_ATTR: "1"}
+        )
+        for fake_id, name in fakes.names.items()
+    ]
+    fake_ids = list(fakes.names)
+    store = LayoutStore.of(r)
+    store.extend(fake_ids)
+    numbers = np.array([store.index.number(f) for f in fake_ids], np.int64)
+    for key, dtype in (("row", np.int32), ("col", np.float64)):
+        values = store.column(key).astype(dtype)
+        values[numbers] = [fakes.opts[f][key] for f in fake_ids]
+        present = store.present[key]
+        present[numbers] = True
+        store.set_column(key, values, present)
+    normalize_columns(store, width)
+    return RenderResult(rows, node_opts=store, select=r.select, roots=r.roots)
+
+
+def render(
+    rr: RenderResult,
+    width: int,
+    fake_goals: bool = False,
+    previous: Optional[RenderResult] = None,
+) -> RenderResult:
+    """Whole pipeline: layering with `tube`, then horizontal tweaking.
+
+    Pass a `previous` render to warm-start horizontal tweaking from it.
+    """
+    step = build_with(rr, tube_with_fakes if fake_goals else tube, width)
+    return tweak_horizontal(step.rr, width, previous)
+
+
+def layout_of(rr: RenderResult) -> dict[GoalId, tuple[int, int]]:
+    """Placement of every goal as (row, col), handy for comparing results."""
+    return {g: (opts["row"], opts["col"]) for g, opts in rr.node_opts.items()}
@@ -0,0 +1,323 @@
+"""Local asyncio render service around the layout pipeline.
+
+Identical in-flight requests (same graph hash, width and flags) are collapsed
+into a single computation. Computations run in an executor, behind a bounded
+queue: when it's full, new requests wait for a free place (backpressure).
+
+The service may be used directly (`await service.render(...)`), or exposed on
+localhost with `serve` and reached with `RenderClient`. Protocol is trivial:
+one JSON object per line in both directions.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Optional
+
+from siebenapp import EdgeType, RenderResult, RenderRow, graph_hash
+from render import render
+
+if TYPE_CHECKING:
+    from shared_layouts import SharedLayouts
+
+log = logging.getLogger(__name__)
+
+# Stream buffer limit: a whole graph is sent as a single line
+LINE_LIMIT = 64 * 1024 * 1024
+
+
+# Everything that makes two render requests different
+@dataclass(frozen=True)
+class RenderKey:
+    graph: str
+    width: int
+    fake_goals: bool
+
+
+class ServiceStopped(RuntimeError):
+    """A request wasn't computed because the service was stopped."""
+
+
+@dataclass
+class _Job:
+    key: RenderKey
+    rr: RenderResult
+    result: asyncio.Future
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest-rank percentile, `p` in range 0..100."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+class RenderService:
+    def __init__(
+        self,
+        executor: Optional[Executor] = None,
+        workers: int = 2,
+        max_pending: int = 16,
+        keep_latencies: int = 1000,
+        store: Optional["SharedLayouts"] = None,
+    ):
+        self.executor = executor
+        # Layouts shared with other processes: looked up first, published after
+        self.store = store
+        self.workers = workers
+        self.max_pending = max_pending
+        self.latencies: deque[float] = deque(maxlen=keep_latencies)
+        self.requests = 0
+        self.coalesced = 0
+        self.computed = 0
+        self.shared_hits = 0
+        self._own_executor = executor is None
+        self._queue: Optional[asyncio.Queue[_Job]] = None
+        self._inflight: dict[RenderKey, asyncio.Future] = {}
+        self._tasks: list[asyncio.Task] = []
+        # Publishing takes a file lock, which doesn't exclude threads of the
+        # same process, so layouts are published by a single thread
+        self._publisher: Optional[ThreadPoolExecutor] = None
+
+    async def start(self) -> None:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        if self.store is not None:
+            self._publisher = ThreadPoolExecutor(max_workers=1)
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._tasks = [
+            asyncio.create_task(self._work()) for _ in range(self.workers)
+        ]
+
+    async def stop(self) -> None:
+        """Stop workers; requests which aren't computed yet fail."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._queue is not None:
+            while not self._queue.empty():
+                self._queue.get_nowait()
+                self._queue.task_done()
+        for future in self._inflight.values():
+            if not future.done():
+                future.set_exception(ServiceStopped())
+        self._inflight.clear()
+        if self._own_executor and self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self._publisher is not None:
+            self._publisher.shutdown()
+            self._publisher = None
+
+    async def __aenter__(self) -> "RenderService":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.stop()
+
+    async def render(
+        self, rr: RenderResult, width: int, fake_goals: bool = False
+    ) -> RenderResult:
+        assert self._queue is not None, "Service is not started"
+        started = time.perf_counter()
+        self.requests += 1
+        key = RenderKey(graph_hash(rr), width, fake_goals)
+        shared = self.store.get(key) if self.store is not None else None
+        if shared is not None:
+            result = shared.to_result(rr)
+            if shared.valid():
+                self.shared_hits += 1
+                self.latencies.append(time.perf_counter() - started)
+                return result
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[key] = future
+            put = asyncio.ensure_future(self._queue.put(_Job(key, rr, future)))
+            try:
+                # Waiting for a place in the queue ends when the service stops
+                await asyncio.wait({put, future}, return_when=asyncio.FIRST_COMPLETED)
+            except BaseException:
+                put.cancel()
+                self._inflight.pop(key, None)
+                future.cancel()
+                raise
+            put.cancel()
+        try:
+            # One impatient client must not cancel the job for everyone else
+            return await asyncio.shield(future)
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+
+    async def _work(self) -> None:
+        assert self._queue is not None
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            try:
+                result = await loop.run_in_executor(
+                    self.executor,
+                    render,
+                    job.rr,
+                    job.key.width,
+                    job.key.fake_goals,
+                )
+                self.computed += 1
+                if not job.result.done():
+                    job.result.set_result(result)
+                if self.store is not None:
+                    await self._publish(job, result)
+            except asyncio.CancelledError:
+                if not job.result.done():
+                    job.result.set_exception(ServiceStopped())
+                raise
+            except Exception as e:
+                if not job.result.done():
+                    job.result.set_exception(e)
+            finally:
+                self._inflight.pop(job.key, None)
+                self._queue.task_done()
+
+    async def _publish(self, job: _Job, result: RenderResult) -> None:
+        """Put a computed layout into the store, off the event loop. Clients
+        already have the result, so a failure is only logged."""
+        assert self.store is not None
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(
+                self._publisher, self.store.put, job.key, job.rr, result
+            )
+        except Exception:
+            log.exception("Can't publish a layout of %s", job.key)
+
+    def stats(self) -> dict[str, Any]:
+        """Request counters and latency percentiles (in seconds)."""
+        latencies = list(self.latencies)
+        return {
+            "requests": self.requests,
+            "coalesced": self.coalesced,
+            "computed": self.computed,
+            "shared_hits": self.shared_hits,
+            "pending": self._queue.qsize() if self._queue is not None else 0,
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+        }
+
+
+def result_to_json(rr: RenderResult) -> dict[str, Any]:
+    return {
+        "rows": [
+            [
+                row.goal_id,
+                row.raw_id,
+                row.name,
+                row.is_open,
+                row.is_switchable,
+                [[e[0], int(e[1])] for e in row.edges],
+                row.attrs,
+            ]
+            for row in rr.rows
+        ],
+        "select": list(rr.select),
+        "roots": list(rr.roots),
+        "node_opts": [
+            [goal_id, dict(opts)] for goal_id, opts in rr.node_opts.items()
+        ],
+    }
+
+
+def result_from_json(data: dict[str, Any]) -> RenderResult:
+    rows = [
+        RenderRow(
+            goal_id,
+            raw_id,
+            name,
+            is_open,
+            is_switchable,
+            [(e[0], EdgeType(e[1])) for e in edges],
+            attrs,
+        )
+        for goal_id, raw_id, name, is_open, is_switchable, edges, attrs in data[
+            "rows"
+        ]
+    ]
+    return RenderResult(
+        rows,
+        select=tuple(data["select"]),  # type: ignore
+        node_opts={goal_id: opts for goal_id, opts in data["node_opts"]},
+        roots=set(data["roots"]),
+    )
+
+
+async def serve(
+    service: RenderService, host: str = "127.0.0.1", port: int = 0
+) -> asyncio.AbstractServer:
+    """Expose `service` over TCP. Use port 0 to pick any free port."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                request = json.loads(line)
+                try:
+                    rr = await service.render(
+                        result_from_json(request["graph"]),
+                        request["width"],
+                        request.get("fake_goals", False),
+                    )
+                    response = {"result": result_to_json(rr)}
+                except Exception as e:
+                    response = {"error": repr(e)}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port, limit=LINE_LIMIT)
+
+
+class RenderClient:
+    """In-process client for a service exposed with `serve`."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    async def connect(cls, host: str, port: int) -> "RenderClient":
+        reader, writer = await asyncio.open_connection(
+            host, port, limit=LINE_LIMIT
+        )
+        return cls(reader, writer)
+
+    async def render(
+        self, rr: RenderResult, width: int, fake_goals: bool = False
+    ) -> RenderResult:
+        request = {
+            "graph": result_to_json(rr),
+            "width": width,
+            "fake_goals": fake_goals,
+        }
+        # Responses come in the same order, so one request per connection at a time
+        async with self._lock:
+            self.writer.write(json.dumps(request).encode() + b"\n")
+            await self.writer.drain()
+            response = json.loads(await self.reader.readline())
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return result_from_json(response["result"])
+
+    async def close(self) -> None:
+        self.writer.close()
+        await self.writer.wait_closed()
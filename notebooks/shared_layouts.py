@@ -0,0 +1,292 @@
+"""Finished layouts shared by several processes through an mmap-ed file.
+
+Every worker process opens the same file. An entry is a laid out graph, keyed
+by `RenderKey` (graph hash, width, fake goals flag): goal ids, rows and cols as
+arrays, and rows which differ from the input graph (fake goals, and goals
+whose edges were rerouted through them) as JSON.
+
+File layout: a header, a table of fixed-size slots (one per entry), and a data
+area. Entries are placed into the data area first-fit, and when there's no
+room, least recently used entries are evicted.
+
+Publishing is serialized with an exclusive `flock` on the file, so there's a
+single writer at a time, which writes entry data into a free range first and
+only then fills its slot. Readers take no locks: every slot has a sequence
+number (a seqlock), odd while the slot is being changed, and a read is retried
+when the number changed under it. Entry arrays are read without copying, as
+views of the file. A view stays valid until its entry is evicted, so check
+`SharedLayout.valid()` after using views, or `copy()` them first. Readers
+mark entries as used with a monotonic clock, which is shared by processes, so
+eviction is LRU across all of them.
+
+`RenderService(store=...)` looks layouts up in a store before computing them,
+and publishes ones it computed.
+"""
+
+import fcntl
+import json
+import mmap
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import numpy as np
+
+from siebenapp import EdgeType, GoalId, RenderResult, RenderRow
+from service import RenderKey
+
+MAGIC = b"SIEBLAY1"
+
+HEADER = np.dtype([("magic", "S8"), ("slots", "<u8"), ("data_size", "<u8")])
+
+SLOT = np.dtype(
+    [
+        ("seq", "<u8"),
+        ("key", "S16"),  # graph hash, as bytes
+        ("width", "<u4"),
+        ("fake_goals", "<u4"),
+        ("offset", "<u8"),
+        ("length", "<u8"),  # 0 for a free slot
+        ("used", "<u8"),  # time.monotonic_ns() of the last use
+    ]
+)
+
+# Entry data: goals amount and JSON size, then ids, rows, cols and JSON
+ENTRY = np.dtype([("goals", "<u8"), ("meta", "<u8")])
+
+# Retries of a read which raced with a writer
+READ_ATTEMPTS = 8
+
+
+def _pad(size: int) -> int:
+    return -(-size // 8) * 8
+
+
+@dataclass
+class SharedLayout:
+    """A layout read from a store; arrays are views of the shared file."""
+
+    ids: np.ndarray  # int goal ids, see `goal_id` for others
+    rows: np.ndarray
+    cols: np.ndarray
+    meta: dict[str, Any]
+    _store: "SharedLayouts"
+    _slot: int
+    _seq: int
+
+    def goal_id(self, i: int) -> GoalId:
+        return self.meta["str_ids"].get(str(i), int(self.ids[i]))
+
+    def valid(self) -> bool:
+        """True while the entry wasn't evicted (so views hold its data)."""
+        return int(self._store.slots["seq"][self._slot]) == self._seq
+
+    def copy(self) -> "SharedLayout":
+        return SharedLayout(
+            self.ids.copy(),
+            self.rows.copy(),
+            self.cols.copy(),
+            self.meta,
+            self._store,
+            self._slot,
+            self._seq,
+        )
+
+    def to_result(self, rr: RenderResult) -> RenderResult:
+        """The layout of `rr` (the graph it was published for)."""
+        encoded = self.meta["rows"]
+        changed = {
+            goal_id: RenderRow(
+                goal_id,
+                raw_id,
+                name,
+                is_open,
+                is_switchable,
+                [(e[0], EdgeType(e[1])) for e in edges],
+                attrs,
+            )
+            for goal_id, raw_id, name, is_open, is_switchable, edges, attrs in encoded
+        }
+        goal_ids = [self.goal_id(i) for i in range(len(self.ids))]
+        rows = [changed.get(g) or rr.by_id(g) for g in goal_ids]
+        new_opts = {
+            goal_id: dict(rr.node_opts.get(goal_id, {}))
+            | {"row": int(row), "col": col.item()}
+            for goal_id, row, col in zip(goal_ids, self.rows, self.cols)
+        }
+        return RenderResult(rows, node_opts=new_opts, select=rr.select, roots=rr.roots)
+
+
+def _encode(rr: RenderResult, laid_out: RenderResult) -> bytes:
+    goal_ids = [row.goal_id for row in laid_out.rows]
+    str_ids = {str(i): g for i, g in enumerate(goal_ids) if not isinstance(g, int)}
+    changed = [
+        row
+        for row in laid_out.rows
+        if row.goal_id not in rr.index or rr.by_id(row.goal_id) != row
+    ]
+    meta = json.dumps(
+        {
+            "str_ids": str_ids,
+            "rows": [
+                [
+                    row.goal_id,
+                    row.raw_id,
+                    row.name,
+                    row.is_open,
+                    row.is_switchable,
+                    [[e[0], int(e[1])] for e in row.edges],
+                    row.attrs,
+                ]
+                for row in changed
+            ],
+        }
+    ).encode()
+    n = len(goal_ids)
+    ids = np.array([g if isinstance(g, int) else 0 for g in goal_ids], np.int64)
+    rows = np.array([laid_out.node_opts[g]["row"] for g in goal_ids], np.int32)
+    cols = np.array([laid_out.node_opts[g]["col"] for g in goal_ids], np.float64)
+    head = np.array([(n, len(meta))], ENTRY).tobytes()
+    rows_bytes = rows.tobytes().ljust(_pad(rows.nbytes), b"\0")
+    return head + ids.tobytes() + rows_bytes + cols.tobytes() + meta
+
+
+class SharedLayouts:
+    def __init__(
+        self, path: str, slots: int = 256, data_size: int = 64 * 1024 * 1024
+    ):
+        """Open a store, creating the file when it doesn't exist yet (then
+        `slots` and `data_size` are used, otherwise ones from the file)."""
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size == 0:
+                size = HEADER.itemsize + slots * SLOT.itemsize + data_size
+                os.ftruncate(self.fd, size)
+                header = np.array([(MAGIC, slots, data_size)], HEADER)
+                os.pwrite(self.fd, header.tobytes(), 0)
+            self.mm = mmap.mmap(self.fd, 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        header = np.frombuffer(self.mm, HEADER, 1)[0]
+        assert header["magic"] == MAGIC, f"{path} is not a layout store"
+        self.slots = np.frombuffer(
+            self.mm, SLOT, int(header["slots"]), HEADER.itemsize
+        )
+        self.data_start = HEADER.itemsize + self.slots.nbytes
+        self.data_size = int(header["data_size"])
+
+    def close(self) -> None:
+        """Close the store; views of entries must be dropped before that."""
+        del self.slots
+        self.mm.close()
+        os.close(self.fd)
+
+    def __enter__(self) -> "SharedLayouts":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _find(self, key: RenderKey) -> Optional[int]:
+        matches = np.flatnonzero(
+            (self.slots["key"] == bytes.fromhex(key.graph))
+            & (self.slots["width"] == key.width)
+            & (self.slots["fake_goals"] == key.fake_goals)
+            & (self.slots["length"] > 0)
+        )
+        return int(matches[0]) if len(matches) else None
+
+    def get(self, key: RenderKey) -> Optional[SharedLayout]:
+        """An entry by key, or None. Doesn't block on writers."""
+        for _ in range(READ_ATTEMPTS):
+            i = self._find(key)
+            if i is None:
+                return None
+            seq = int(self.slots["seq"][i])
+            if seq % 2:
+                continue
+            slot = self.slots[i]
+            start = self.data_start + int(slot["offset"])
+            head = np.frombuffer(self.mm, ENTRY, 1, start)[0]
+            n, meta_size = int(head["goals"]), int(head["meta"])
+            if ENTRY.itemsize + n * 20 + meta_size > int(slot["length"]):
+                continue  # torn read
+            start += ENTRY.itemsize
+            ids = np.frombuffer(self.mm, np.int64, n, start)
+            rows = np.frombuffer(self.mm, np.int32, n, start + 8 * n)
+            cols_start = start + 8 * n + _pad(4 * n)
+            cols = np.frombuffer(self.mm, np.float64, n, cols_start)
+            meta_start = cols_start + 8 * n
+            try:
+                meta = json.loads(self.mm[meta_start : meta_start + meta_size])
+            except ValueError:
+                continue
+            if int(self.slots["seq"][i]) != seq or self._find(key) != i:
+                continue
+            self.slots["used"][i] = time.monotonic_ns()
+            return SharedLayout(ids, rows, cols, meta, self, i, seq)
+        return None
+
+    def put(self, key: RenderKey, rr: RenderResult, laid_out: RenderResult) -> bool:
+        """Publish a layout of `rr`, evicting least recently used entries when
+        there's no room. False when it's too big for the store."""
+        data = _encode(rr, laid_out)
+        if len(data) > self.data_size:
+            return False
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if self._find(key) is not None:
+                return True
+            offset = self._allocate(len(data))
+            start = self.data_start + offset
+            self.mm[start : start + len(data)] = data
+            free = np.flatnonzero(self.slots["length"] == 0)
+            i = int(free[0]) if len(free) else self._evict()
+            self.slots["seq"][i] += 1
+            self.slots[i] = (
+                int(self.slots["seq"][i]),
+                bytes.fromhex(key.graph),
+                key.width,
+                key.fake_goals,
+                offset,
+                len(data),
+                time.monotonic_ns(),
+            )
+            self.slots["seq"][i] += 1
+            return True
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _evict(self) -> int:
+        """Free the least recently used slot, return its number."""
+        never = np.iinfo(np.uint64).max
+        used = np.where(self.slots["length"] > 0, self.slots["used"], never)
+        i = int(np.argmin(used))
+        self.slots["seq"][i] += 1
+        self.slots["length"][i] = 0
+        self.slots["key"][i] = b""
+        self.slots["seq"][i] += 1
+        return i
+
+    def _allocate(self, size: int) -> int:
+        """Offset of a free range of the data area (first fit)."""
+        size = _pad(size)
+        while True:
+            live = np.flatnonzero(self.slots["length"] > 0)
+            starts = self.slots["offset"][live].astype(np.int64)
+            ends = starts + self.slots["length"][live].astype(np.int64)
+            order = np.argsort(starts)
+            position = 0
+            for s, e in zip(starts[order], ends[order]):
+                if s - position >= size:
+                    return position
+                position = max(position, _pad(int(e)))
+            if self.data_size - position >= size:
+                return position
+            self._evict()
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.slots["length"]))
@@ -0,0 +1,48 @@
+from random import Random
+from typing import Optional
+
+from siebenapp import EdgeType, GoalId, RenderResult, RenderRow
+
+
+# Random goal trees of any size, shaped like real ones: every goal (except the root)
+# has a parent, and some goals are also blocked by other goals
+def random_tree(
+    size: int,
+    seed: int = 0,
+    blockers: float = 0.3,
+    max_children: Optional[int] = None,
+    closed: float = 0.3,
+) -> RenderResult:
+    rnd = Random(seed)
+    edges: dict[int, list[tuple[GoalId, EdgeType]]] = {
+        g: [] for g in range(1, size + 1)
+    }
+    for goal_id in range(2, size + 1):
+        # Prefer recent goals as parents, so trees get deep rather than flat
+        parent = max(1, goal_id - 1 - int(rnd.expovariate(1 / 8)))
+        if max_children is not None:
+            while parent > 1 and len(edges[parent]) >= max_children:
+                parent -= 1
+        edges[parent].append((goal_id, EdgeType.PARENT))
+        if goal_id > 2 and rnd.random() < blockers:
+            blocker = rnd.randrange(1, goal_id)
+            if all(e[0] != goal_id for e in edges[blocker]):
+                edges[blocker].append((goal_id, EdgeType.BLOCKER))
+    rows = [
+        RenderRow(
+            goal_id=goal_id,
+            raw_id=goal_id,
+            name=f"node {goal_id}",
+            is_open=rnd.random() >= closed,
+            is_switchable=not edges[goal_id],
+            edges=edges[goal_id],
+            attrs={},
+        )
+        for goal_id in range(1, size + 1)
+    ]
+    return RenderResult(
+        rows=rows,
+        select=(1, 1),
+        roots={1},
+        node_opts={goal_id: {} for goal_id in range(1, size + 1)},
+    )
@@ -1,6 +1,7 @@
+import hashlib
 from enum import IntEnum
 from dataclasses import dataclass, field
-from typing import Any, Union, Optional
+from typing import Any, Iterable, Iterator, Union, Optional
 
 
 # One of two supported edge types
@@ -21,6 +22,74 @@ class Edge:
 GoalId = Union[str, int]
 
 
+def is_real_goal(goal_id: GoalId) -> bool:
+    return isinstance(goal_id, int)
+
+
+# Attribute which marks fake goals added by layout stages (their ids are ints,
+# and names may be anything)
+FAKE_ATTR = "fake"
+
+
+# Dense numbering of goal ids, so that layout stages could use plain int arrays
+class GoalIndex:
+    """Bidirectional mapping between arbitrary goal ids and integers 0..N-1.
+
+    Mixed str/int goal ids can't be used as array indices, and comparing them
+    raises TypeError. Pipeline stages translate goal ids once, at the boundary,
+    and work with dense numbers afterwards. `real` is a flag bitmap: 1 for real
+    goals, 0 for pseudo goals.
+    """
+
+    ids: list[GoalId]
+    numbers: dict[GoalId, int]
+    real: bytearray
+
+    def __init__(self, goal_ids: Iterable[GoalId] = ()):
+        self.ids = []
+        self.numbers = {}
+        self.real = bytearray()
+        for goal_id in goal_ids:
+            self.add(goal_id)
+
+    @classmethod
+    def of_real(cls, goal_ids: list[int]) -> "GoalIndex":
+        """Index of distinct real goals, built in bulk."""
+        index = cls()
+        index.ids = goal_ids
+        index.numbers = dict(zip(goal_ids, range(len(goal_ids))))
+        index.real = bytearray(b"\x01") * len(goal_ids)
+        return index
+
+    def add(self, goal_id: GoalId) -> int:
+        number = self.numbers.get(goal_id)
+        if number is None:
+            number = len(self.ids)
+            self.ids.append(goal_id)
+            self.numbers[goal_id] = number
+            self.real.append(is_real_goal(goal_id))
+        return number
+
+    def number(self, goal_id: GoalId) -> int:
+        assert goal_id in self.numbers, f"Goal id {goal_id} is unknown"
+        return self.numbers[goal_id]
+
+    def goal_id(self, number: int) -> GoalId:
+        return self.ids[number]
+
+    def is_real(self, number: int) -> bool:
+        return bool(self.real[number])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[GoalId]:
+        return iter(self.ids)
+
+    def __contains__(self, goal_id: GoalId) -> bool:
+        return goal_id in self.numbers
+
+
 # Single row of "render result" (well, actually, it's a single goal)
 @dataclass(frozen=True)
 class RenderRow:
@@ -35,15 +104,64 @@ class RenderRow:
     attrs: dict[str, str] = field(default_factory=lambda: {})
 
 
-# A whole result of "rendering" (also suitable for result returned by a single request to goal tree)
+def is_fake_row(row: RenderRow) -> bool:
+    return FAKE_ATTR in row.attrs
+
+
+# A batch of changes for `RenderResult.apply`
 @dataclass
+class RenderEdit:
+    add_rows: list[RenderRow] = field(default_factory=list)
+    # New edges of existing (or just added) rows
+    set_edges: dict[GoalId, list[tuple[GoalId, EdgeType]]] = field(
+        default_factory=dict
+    )
+    # Edges to removed goals are dropped too
+    remove_rows: list[GoalId] = field(default_factory=list)
+    # Replace layout options of given goals
+    node_opts: dict[GoalId, Any] = field(default_factory=dict)
+    # Rows replacing existing rows with the same goal ids
+    replace_rows: list[RenderRow] = field(default_factory=list)
+
+
+# Rows, options and roots which a `RenderResult` made for itself, so it may
+# change them in place until they're given to another result (`shared`)
+class _OwnRows(list):
+    shared = False
+
+
+class _OwnOpts(dict):
+    shared = False
+
+
+class _OwnRoots(set):
+    shared = False
+
+    def __repr__(self) -> str:
+        return repr(set(self))
+
+
+def _share(value: Any) -> Any:
+    if isinstance(value, (_OwnRows, _OwnOpts, _OwnRoots)):
+        value.shared = True
+    return value
+
+
+def _own(value: Any, kind: type) -> Any:
+    """`value` when it may be changed in place, otherwise its copy."""
+    if type(value) is kind and not value.shared:
+        return value
+    if kind is _OwnOpts and not isinstance(value, dict):
+        # Columnar options (`layout_store.LayoutStore`) give live views of
+        # shared columns, so they are copied into plain dicts
+        return kind(value.to_dicts())
+    return kind(value)
+
+
+# A whole result of "rendering" (also suitable for result returned by a single request to goal tree)
 class RenderResult:
-    rows: list[RenderRow]
     edge_opts: dict[str, tuple[int, int, int]]
     select: tuple[GoalId, GoalId]
-    node_opts: dict[GoalId, Any]
-    roots: set[GoalId]
-    index: dict[GoalId, int]
 
     def __init__(
         self,
@@ -53,20 +171,246 @@ class RenderResult:
         node_opts: Optional[dict[GoalId, Any]] = None,
         roots: Optional[set[GoalId]] = None,
     ):
-        self.rows = rows
+        # Removed rows are kept as `None` tombstones until rows are read. Given
+        # rows, options and roots belong to the caller (or to another result),
+        # so they're copied before edits
+        self._rows: list[Optional[RenderRow]] = _share(rows)
+        self._index = {row.goal_id: i for i, row in enumerate(rows)}
+        self._dead = 0
         self.edge_opts = edge_opts or {}
         self.select = select or (0, 0)
-        self.node_opts = node_opts or {}
-        self.roots = roots or set()
-        self.index = {row.goal_id: i for i, row in enumerate(rows)}
+        self._node_opts: dict[GoalId, Any] = _share(node_opts) or {}
+        self._roots: set[GoalId] = _share(roots) or set()
+        self._goal_index: Optional[GoalIndex] = None
+        self._goals: Optional[tuple[dict, int, tuple[tuple[GoalId, Any], ...]]] = None
+        self._fingerprints: dict[GoalId, bytes] = {}
+        self._parents: Optional[dict[GoalId, list[GoalId]]] = None
+
+    def __repr__(self) -> str:
+        return (
+            f"RenderResult(rows={self.rows!r}, edge_opts={self.edge_opts!r}, "
+            f"select={self.select!r}, node_opts={self.node_opts!r}, "
+            f"roots={self.roots!r})"
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, RenderResult):
+            return NotImplemented
+        return (self.rows, self.edge_opts, self.select, self.node_opts, self.roots) == (
+            other.rows,
+            other.edge_opts,
+            other.select,
+            other.node_opts,
+            other.roots,
+        )
+
+    @property
+    def node_opts(self) -> dict[GoalId, Any]:
+        return self._node_opts
+
+    @node_opts.setter
+    def node_opts(self, value: dict[GoalId, Any]) -> None:
+        self._node_opts = _share(value)
+        self._goals = None
+
+    @property
+    def roots(self) -> set[GoalId]:
+        return self._roots
+
+    @roots.setter
+    def roots(self, value: set[GoalId]) -> None:
+        self._roots = _share(value)
+
+    @property
+    def rows(self) -> list[RenderRow]:
+        """Rows in order; the list itself changes with `apply` (copy it to keep
+        the current rows, giving it to another result is fine)."""
+        self._compact()
+        return self._rows  # type: ignore
+
+    @property
+    def index(self) -> dict[GoalId, int]:
+        """Positions of rows in `rows`."""
+        self._compact()
+        return self._index
+
+    def _compact(self) -> None:
+        if self._dead:
+            self._rows = _OwnRows(row for row in self._rows if row is not None)
+            self._index = {row.goal_id: i for i, row in enumerate(self._rows)}
+            self._dead = 0
+            self._goal_index = None
+
+    @property
+    def goal_index(self) -> GoalIndex:
+        """Dense numbering of all rows, built on first use."""
+        self._compact()
+        if self._goal_index is None:
+            self._goal_index = GoalIndex(row.goal_id for row in self.rows)
+        return self._goal_index
 
-    def goals(self):
-        return [
-            (goal_id, attrs)
-            for goal_id, attrs in self.node_opts.items()
-            if isinstance(goal_id, int)
-        ]
+    @property
+    def parents(self) -> dict[GoalId, list[GoalId]]:
+        """Sources of incoming edges of every goal, built on first use."""
+        if self._parents is None:
+            parents: dict[GoalId, list[GoalId]] = {g: [] for g in self._index}
+            for row in self._rows:
+                if row is not None:
+                    for e in row.edges:
+                        if e[0] in parents:
+                            parents[e[0]].append(row.goal_id)
+            self._parents = parents
+        return self._parents
+
+    def fingerprint(self, goal_id: GoalId) -> bytes:
+        """`row_fingerprint` of a row, computed on first use."""
+        result = self._fingerprints.get(goal_id)
+        if result is None:
+            result = row_fingerprint(self.by_id(goal_id))
+            self._fingerprints[goal_id] = result
+        return result
+
+    def goals(self) -> tuple[tuple[GoalId, Any], ...]:
+        """Real goals with their options.
+
+        Cached until `node_opts` is assigned or changed by `apply` (or changes
+        its size in place). Replacing options of a goal in place, like
+        `rr.node_opts[g] = {...}`, isn't noticed: the cache keeps the old ones.
+        Pipeline stages never modify `node_opts` in place, they build a new one.
+        """
+        opts = self._node_opts
+        cached = self._goals
+        if cached is None or cached[0] is not opts or cached[1] != len(opts):
+            index = self.goal_index
+            goals: list[tuple[GoalId, Any]] = []
+            for goal_id, attrs in opts.items():
+                number = index.numbers.get(goal_id)
+                if index.real[number] if number is not None else is_real_goal(goal_id):
+                    goals.append((goal_id, attrs))
+            self._goals = (opts, len(opts), tuple(goals))
+        return self._goals[2]
 
     def by_id(self, goal_id: GoalId) -> RenderRow:
-        assert goal_id in self.index, f"Goal id {goal_id} is unknown"
-        return self.rows[self.index[goal_id]]
+        assert goal_id in self._index, f"Goal id {goal_id} is unknown"
+        return self._rows[self._index[goal_id]]  # type: ignore
+
+    def apply(self, edit: RenderEdit) -> None:
+        """Change rows and options in place, in time proportional to the edit.
+
+        Removed rows become tombstones and are dropped on the next read of
+        `rows`. Caches (positions, dense numbers, parents, fingerprints) are
+        updated rather than rebuilt. Rows, options and roots which were given
+        to the constructor (or by this result to another one) are copied on
+        the first edit after that, reading them doesn't make copies. Columnar
+        options (a `LayoutStore`) become a dict of plain dicts on that copy.
+        """
+        self._rows = _own(self._rows, _OwnRows)
+        self._node_opts = _own(self._node_opts, _OwnOpts)
+        self._roots = _own(self._roots, _OwnRoots)
+        # Edges to removed goals are found with parents
+        parents = self.parents if edit.remove_rows else self._parents
+        for row in edit.add_rows:
+            assert row.goal_id not in self._index, f"Goal id {row.goal_id} exists"
+            self._index[row.goal_id] = len(self._rows)
+            self._rows.append(row)
+            if self._goal_index is not None:
+                self._goal_index.add(row.goal_id)
+            if parents is not None:
+                parents[row.goal_id] = []
+            self.node_opts.setdefault(row.goal_id, {})
+        # Added rows may link to each other
+        for row in edit.add_rows:
+            self._link(row.goal_id, row.edges, +1)
+        for row in edit.replace_rows:
+            self._replace(row)
+        for goal_id, edges in edit.set_edges.items():
+            self._set_edges(goal_id, edges)
+        removed = set(edit.remove_rows)
+        if removed:
+            # Dense numbers are never reused
+            self._goal_index = None
+        for goal_id in edit.remove_rows:
+            if parents is not None:
+                for parent in set(parents[goal_id]) - removed:
+                    edges = self.by_id(parent).edges
+                    self._set_edges(parent, [e for e in edges if e[0] != goal_id])
+            self._link(goal_id, self.by_id(goal_id).edges, -1)
+            self._rows[self._index.pop(goal_id)] = None
+            self._dead += 1
+            self._fingerprints.pop(goal_id, None)
+            if parents is not None:
+                del parents[goal_id]
+            self.node_opts.pop(goal_id, None)
+            self.roots.discard(goal_id)
+        self.node_opts.update(edit.node_opts)
+        self._goals = None
+
+    def reorder(self, goal_ids: list[GoalId]) -> None:
+        """Put rows in the order of `goal_ids`, which lists every goal once."""
+        assert len(goal_ids) == len(self.index), "Not an order of all rows"
+        rows = self.rows
+        self._rows = _OwnRows(rows[self._index[g]] for g in goal_ids)
+        self._index = {g: i for i, g in enumerate(goal_ids)}
+        self._goal_index = None
+
+    def _set_edges(
+        self, goal_id: GoalId, edges: list[tuple[GoalId, EdgeType]]
+    ) -> None:
+        row = self.by_id(goal_id)
+        self._replace(
+            RenderRow(
+                row.goal_id,
+                row.raw_id,
+                row.name,
+                row.is_open,
+                row.is_switchable,
+                edges,
+                row.attrs,
+            )
+        )
+
+    def _replace(self, row: RenderRow) -> None:
+        self._link(row.goal_id, self.by_id(row.goal_id).edges, -1)
+        self._rows[self._index[row.goal_id]] = row
+        self._link(row.goal_id, row.edges, +1)
+        self._fingerprints.pop(row.goal_id, None)
+
+    def _link(
+        self, goal_id: GoalId, edges: list[tuple[GoalId, EdgeType]], sign: int
+    ) -> None:
+        """Add (or remove) `goal_id` to parents of edge targets."""
+        if self._parents is None:
+            return
+        for e in edges:
+            if e[0] not in self._parents:
+                continue
+            if sign > 0:
+                self._parents[e[0]].append(goal_id)
+            else:
+                self._parents[e[0]].remove(goal_id)
+
+
+def row_fingerprint(row: RenderRow) -> bytes:
+    """Stable digest of a single row, including its edges and attributes."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(
+        repr(
+            (row.goal_id, row.raw_id, row.name, row.is_open, row.is_switchable)
+        ).encode()
+    )
+    h.update(repr([(e[0], int(e[1])) for e in row.edges]).encode())
+    h.update(repr(sorted(row.attrs.items())).encode())
+    return h.digest()
+
+
+def graph_hash(rr: RenderResult) -> str:
+    """Digest of goal tree structure: rows (in order) and roots.
+
+    Row order is included because it breaks ties in `normalize_cols`. Layout
+    options and selection are not included.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for row in rr.rows:
+        h.update(rr.fingerprint(row.goal_id))
+    h.update(repr(sorted(repr(g) for g in rr.roots)).encode())
+    return h.hexdigest()
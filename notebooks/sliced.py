@@ -0,0 +1,151 @@
+"""Cooperative, time-sliced layout for event-loop driven front ends.
+
+`render` is a single blocking call, which freezes a UI for seconds on a big
+graph. Here the same pipeline is split into short units of work (finding
+parents, every `tube` step, every horizontal pass), and `render_sliced` runs
+them in slices of about `slice_ms` milliseconds, yielding to the event loop
+between slices. A unit can't be interrupted, so a slice may overrun by the
+duration of one unit; slice timings are returned to see how much.
+
+A sliced layout is an ordinary task, so it's cancelled as usual. With
+`LayoutDriver`, a newer request cancels the one still running.
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Generator, Optional
+
+from siebenapp import RenderResult
+from render import (
+    RenderStep,
+    adjust_horisontal,
+    find_previous,
+    normalize_cols,
+    resolve_collisions,
+    tube,
+    tube_with_fakes,
+    tweak_horizontal,
+)
+
+
+def layout_units(
+    rr: RenderResult,
+    width: int,
+    fake_goals: bool = False,
+    previous: Optional[RenderResult] = None,
+) -> Generator[str, None, RenderResult]:
+    """`render` as a generator: the stage of every unit is yielded right before
+    the unit runs, and the layout is returned."""
+    yield "layering"
+    step = RenderStep(rr, list(rr.roots), [], find_previous(rr), {})
+    fn = tube_with_fakes if fake_goals else tube
+    while step.roots:
+        yield "layering"
+        step = fn(step, width)
+    yield "horizontal"
+    if previous is not None:
+        return tweak_horizontal(step.rr, width, previous)
+    # Same passes as `tweak_horizontal` makes
+    r1 = adjust_horisontal(step.rr, 1.0)
+    yield "horizontal"
+    r2 = adjust_horisontal(r1, 0.5)
+    yield "horizontal"
+    r3 = resolve_collisions(r2, width)[0]
+    yield "horizontal"
+    return normalize_cols(r3, width)
+
+
+@dataclass
+class Slice:
+    stage: str
+    units: int
+    elapsed: float  # seconds of work, without the time given to the event loop
+
+
+@dataclass
+class SlicedResult:
+    rr: RenderResult
+    elapsed: float  # wall time, including other tasks run between slices
+    slices: list[Slice] = field(default_factory=list)
+
+    @property
+    def work(self) -> float:
+        return sum(s.elapsed for s in self.slices)
+
+    @property
+    def longest(self) -> float:
+        """The longest time the event loop was blocked for."""
+        return max((s.elapsed for s in self.slices), default=0.0)
+
+
+async def render_sliced(
+    rr: RenderResult,
+    width: int,
+    fake_goals: bool = False,
+    previous: Optional[RenderResult] = None,
+    slice_ms: float = 10.0,
+) -> SlicedResult:
+    """Same result as `render`, computed in slices. A slice ends when its time
+    is over or a stage ends."""
+    started = time.perf_counter()
+    units = layout_units(rr, width, fake_goals, previous)
+    slices: list[Slice] = []
+    stage = next(units)
+    count = 0
+    slice_started = time.perf_counter()
+    while True:
+        try:
+            upcoming = units.send(None)
+        except StopIteration as stop:
+            now = time.perf_counter()
+            slices.append(Slice(stage, count + 1, now - slice_started))
+            return SlicedResult(stop.value, now - started, slices)
+        count += 1
+        now = time.perf_counter()
+        if upcoming != stage or now - slice_started >= slice_ms / 1000:
+            slices.append(Slice(stage, count, now - slice_started))
+            await asyncio.sleep(0)
+            count = 0
+            slice_started = time.perf_counter()
+        stage = upcoming
+
+
+class LayoutDriver:
+    """Runs a single sliced layout at a time, a newer request supersedes (and
+    cancels) the running one."""
+
+    def __init__(self, slice_ms: float = 10.0):
+        self.slice_ms = slice_ms
+        self.cancelled = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def render(
+        self,
+        rr: RenderResult,
+        width: int,
+        fake_goals: bool = False,
+        previous: Optional[RenderResult] = None,
+    ) -> Optional[SlicedResult]:
+        """A layout of `rr`, or None when a newer request superseded this one."""
+        self.cancel()
+        task = asyncio.create_task(
+            render_sliced(rr, width, fake_goals, previous, self.slice_ms)
+        )
+        self._task = task
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task.cancelled() and self._task is not task:
+                return None
+            raise
+        finally:
+            if self._task is task:
+                self._task = None
+
+    def cancel(self) -> None:
+        """Cancel the running layout, if any."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            self.cancelled += 1
+        self._task = None
@@ -0,0 +1,160 @@
+"""Spatial index over laid out goals.
+
+Drawing only the visible part of a big canvas and finding a goal under the
+cursor both need goals by their positions, and scanning all of `node_opts`
+for every pan or click is O(N). `GridIndex` buckets goals into square cells of
+a uniform grid over (row, col), so a rectangle query visits only cells it
+overlaps, and a nearest goal query visits rings of cells around a point until
+no closer goal may be found. Layouts are dense (there are at most `width`
+goals in a row), so both take about O(cells visited + goals found).
+
+An index is built once per layout. When a re-layout moves only some goals,
+pass them to `update` instead of building a new index.
+"""
+
+import math
+from collections.abc import Mapping
+from typing import Iterator, Optional
+
+from siebenapp import GoalId, RenderResult
+
+# (row, col) of a goal; cols may be floats before normalization
+Position = tuple[float, float]
+
+Cell = tuple[int, int]
+
+
+class GridIndex:
+    def __init__(self, cell_size: int = 8):
+        self.cell_size = cell_size
+        self.positions: dict[GoalId, Position] = {}
+        self.cells: dict[Cell, set[GoalId]] = {}
+        # Bounds of cells ever used (they're not shrunk on removals)
+        self._min: Optional[Cell] = None
+        self._max: Optional[Cell] = None
+
+    @classmethod
+    def from_result(cls, rr: RenderResult, cell_size: int = 8) -> "GridIndex":
+        """Index of all placed goals of `rr` (ones having both row and col)."""
+        index = cls(cell_size)
+        for goal_id, opts in rr.node_opts.items():
+            row, col = opts.get("row"), opts.get("col")
+            if row is not None and col is not None:
+                index.add(goal_id, (row, col))
+        return index
+
+    def cell(self, position: Position) -> Cell:
+        return (
+            math.floor(position[0] / self.cell_size),
+            math.floor(position[1] / self.cell_size),
+        )
+
+    def add(self, goal_id: GoalId, position: Position) -> None:
+        if goal_id in self.positions:
+            self.remove(goal_id)
+        self.positions[goal_id] = position
+        cell = self.cell(position)
+        self.cells.setdefault(cell, set()).add(goal_id)
+        if self._min is None or self._max is None:
+            self._min = self._max = cell
+        else:
+            self._min = (min(self._min[0], cell[0]), min(self._min[1], cell[1]))
+            self._max = (max(self._max[0], cell[0]), max(self._max[1], cell[1]))
+
+    def remove(self, goal_id: GoalId) -> None:
+        cell = self.cell(self.positions.pop(goal_id))
+        goals = self.cells[cell]
+        goals.discard(goal_id)
+        if not goals:
+            del self.cells[cell]
+
+    def update(self, moves: Mapping[GoalId, Optional[Position]]) -> None:
+        """Move goals to new positions, `None` removes a goal."""
+        for goal_id, position in moves.items():
+            if position is None:
+                if goal_id in self.positions:
+                    self.remove(goal_id)
+            elif self.positions.get(goal_id) != position:
+                self.add(goal_id, position)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __contains__(self, goal_id: GoalId) -> bool:
+        return goal_id in self.positions
+
+    def _in_cells(self, first: Cell, last: Cell) -> Iterator[tuple[GoalId, Position]]:
+        if self._min is None or self._max is None:
+            return
+        rows = range(max(first[0], self._min[0]), min(last[0], self._max[0]) + 1)
+        cols = range(max(first[1], self._min[1]), min(last[1], self._max[1]) + 1)
+        if len(rows) * len(cols) > len(self.cells):
+            # A huge rectangle: cheaper to check every used cell
+            cells: Iterator[Cell] = (
+                c for c in self.cells if c[0] in rows and c[1] in cols
+            )
+        else:
+            cells = ((r, c) for r in rows for c in cols)
+        for cell in cells:
+            for goal_id in self.cells.get(cell, ()):
+                yield goal_id, self.positions[goal_id]
+
+    def query(
+        self, min_row: float, min_col: float, max_row: float, max_col: float
+    ) -> list[GoalId]:
+        """Goals within a rectangle (bounds included), ordered by (row, col)."""
+        found = [
+            (position, goal_id)
+            for goal_id, position in self._in_cells(
+                self.cell((min_row, min_col)), self.cell((max_row, max_col))
+            )
+            if min_row <= position[0] <= max_row and min_col <= position[1] <= max_col
+        ]
+        return [goal_id for _, goal_id in sorted(found, key=lambda f: f[0])]
+
+    def nearest(
+        self, row: float, col: float, max_distance: float = math.inf
+    ) -> Optional[GoalId]:
+        """The closest goal to a point (ties are broken by row, then col), or
+        None when there are no goals within `max_distance`."""
+        if self._min is None or self._max is None:
+            return None
+        center = self.cell((row, col))
+        # Farthest ring which may have goals
+        limit = max(
+            center[0] - self._min[0],
+            self._max[0] - center[0],
+            center[1] - self._min[1],
+            self._max[1] - center[1],
+        )
+        best: Optional[tuple[float, Position, GoalId]] = None
+        for ring in range(limit + 1):
+            # Goals in further rings are at least that far
+            if (ring - 1) * self.cell_size > min(
+                max_distance, best[0] if best else math.inf
+            ):
+                break
+            for goal_id, position in self._ring(center, ring):
+                distance = math.hypot(position[0] - row, position[1] - col)
+                if distance <= max_distance and (
+                    best is None or (distance, position) < best[:2]
+                ):
+                    best = (distance, position, goal_id)
+        return best[2] if best else None
+
+    def _ring(self, center: Cell, ring: int) -> Iterator[tuple[GoalId, Position]]:
+        """Goals of cells at exactly `ring` cells away (Chebyshev distance)."""
+        r0, c0 = center
+        if ring == 0:
+            yield from self._in_cells(center, center)
+            return
+        # Top and bottom sides, then left and right ones without corners
+        yield from self._in_cells((r0 - ring, c0 - ring), (r0 - ring, c0 + ring))
+        yield from self._in_cells((r0 + ring, c0 - ring), (r0 + ring, c0 + ring))
+        top, bottom = r0 - ring + 1, r0 + ring - 1
+        yield from self._in_cells((top, c0 - ring), (bottom, c0 - ring))
+        yield from self._in_cells((top, c0 + ring), (bottom, c0 + ring))
+
+    def hit(self, row: float, col: float, radius: float = 0.5) -> Optional[GoalId]:
+        """A goal under the cursor at (row, col)."""
+        return self.nearest(row, col, radius)
@@ -0,0 +1,184 @@
+"""Loading goal trees from SiebenApp SQLite files.
+
+SiebenApp keeps goals in two tables:
+
+    goals(goal_id integer primary key, name string, open boolean)
+    edges(parent integer, child integer, reltype integer)
+
+where `reltype` uses `EdgeType` values. `load_compact` fills `CompactGraph`
+arrays right from a few bulk queries, without creating a `RenderRow` for every
+goal, while `load_result` builds a usual `RenderResult` (as `sieben_example1`
+does) for stages that still need one.
+
+Both loaders may be restricted to a subtree of a given root, and to open goals
+only. Filtering is done in SQL: selected goal ids are put into a temporary
+table first, and goals and edges are queried by joining it.
+"""
+
+import sqlite3
+from contextlib import closing
+from itertools import chain
+from typing import Optional
+
+import numpy as np
+
+from siebenapp import EdgeType, GoalId, GoalIndex, RenderResult, RenderRow
+from compact import CompactGraph
+
+SCHEMA = [
+    "create table goals (goal_id integer primary key, name string, open boolean)",
+    "create table edges (parent integer, child integer, reltype integer, "
+    "primary key (parent, child))",
+]
+
+
+def _select(conn: sqlite3.Connection, root: Optional[int], only_open: bool) -> None:
+    """Put ids of goals to load into the temporary `selected` table."""
+    conn.execute("drop table if exists temp.selected")
+    is_open = "and g.open" if only_open else ""
+    if root is None:
+        query = f"select g.goal_id from goals g where 1 {is_open}"
+        conn.execute(f"create temp table selected as {query}")
+    else:
+        # Closed goals are skipped together with everything reachable only via them
+        query = f"""
+            with recursive sub(goal_id) as (
+                select g.goal_id from goals g where g.goal_id = ? {is_open}
+                union
+                select e.child from edges e
+                join sub on e.parent = sub.goal_id
+                join goals g on g.goal_id = e.child {is_open}
+            )
+            select goal_id from sub
+        """
+        conn.execute(f"create temp table selected as {query}", (root,))
+    conn.execute("create unique index temp.selected_id on selected (goal_id)")
+
+
+_GOALS = """
+    select g.goal_id, g.open from goals g
+    join selected s on s.goal_id = g.goal_id
+    order by g.goal_id
+"""
+
+_ROWS = """
+    select g.goal_id, g.name, g.open from goals g
+    join selected s on s.goal_id = g.goal_id
+    order by g.goal_id
+"""
+
+# Edges are grouped by parent, and keep the order they were added in
+_EDGES = """
+    select e.parent, e.child, e.reltype from edges e
+    join selected p on p.goal_id = e.parent
+    join selected c on c.goal_id = e.child
+    order by e.parent, e.rowid
+"""
+
+
+def _columns(cursor: sqlite3.Cursor, count: int) -> np.ndarray:
+    flat = np.fromiter(chain.from_iterable(cursor), np.int64)
+    return flat.reshape(-1, count)
+
+
+def load_compact(
+    path: str, root: Optional[int] = None, only_open: bool = False
+) -> CompactGraph:
+    """Load goals into arrays. Goals get numbers in the order of their ids.
+
+    Roots are `root` when it's given, or goals without parents otherwise.
+    Switchable goals are found as in SiebenApp (among loaded goals): open ones
+    without open children, and closed ones without closed parents.
+    """
+    with closing(sqlite3.connect(path)) as conn:
+        _select(conn, root, only_open)
+        goals = _columns(conn.execute(_GOALS), 2)
+        edges = _columns(conn.execute(_EDGES), 3)
+    ids = goals[:, 0]
+    is_open = goals[:, 1].astype(bool)
+    sources = np.searchsorted(ids, edges[:, 0]).astype(np.int32)
+    targets = np.searchsorted(ids, edges[:, 1]).astype(np.int32)
+    offsets = np.zeros(len(ids) + 1, np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(ids)), out=offsets[1:])
+    open_children = np.bincount(sources[is_open[targets]], minlength=len(ids))
+    closed_parents = np.bincount(targets[~is_open[sources]], minlength=len(ids))
+    if root is not None:
+        roots = np.flatnonzero(ids == root).astype(np.int32)
+    else:
+        has_parents = np.zeros(len(ids), bool)
+        has_parents[targets] = True
+        roots = np.flatnonzero(~has_parents).astype(np.int32)
+    return CompactGraph(
+        GoalIndex.of_real(ids.tolist()),
+        offsets,
+        targets,
+        edges[:, 2].astype(np.int8),
+        is_open,
+        np.where(is_open, open_children == 0, closed_parents == 0),
+        roots,
+    )
+
+
+def load_result(
+    path: str, root: Optional[int] = None, only_open: bool = False
+) -> RenderResult:
+    """Load goals into a `RenderResult`, with a `RenderRow` for every goal.
+
+    Roots and switchable goals are found as in `load_compact`.
+    """
+    with closing(sqlite3.connect(path)) as conn:
+        _select(conn, root, only_open)
+        goals = conn.execute(_ROWS).fetchall()
+        edges = conn.execute(_EDGES).fetchall()
+    children: dict[int, list[tuple[GoalId, EdgeType]]] = {g[0]: [] for g in goals}
+    is_open = {goal_id: bool(flag) for goal_id, _, flag in goals}
+    has_parents: set[int] = set()
+    has_closed_parents: set[int] = set()
+    for parent, child, reltype in edges:
+        children[parent].append((child, EdgeType(reltype)))
+        has_parents.add(child)
+        if not is_open[parent]:
+            has_closed_parents.add(child)
+    rows = [
+        RenderRow(
+            goal_id=goal_id,
+            raw_id=goal_id,
+            name=name,
+            is_open=is_open[goal_id],
+            is_switchable=not any(is_open[c] for c, _ in children[goal_id])
+            if is_open[goal_id]
+            else goal_id not in has_closed_parents,
+            edges=children[goal_id],
+            attrs={},
+        )
+        for goal_id, name, _ in goals
+    ]
+    roots = {root} if root is not None else set(children) - has_parents
+    return RenderResult(
+        rows,
+        select=(rows[0].goal_id, rows[0].goal_id) if rows else None,
+        node_opts={row.goal_id: {} for row in rows},
+        roots=roots & set(children),
+    )
+
+
+def save_result(rr: RenderResult, path: str) -> None:
+    """Write real goals of `rr` into a new SiebenApp-like database."""
+    with closing(sqlite3.connect(path)) as conn:
+        for statement in SCHEMA:
+            conn.execute(statement)
+        real = [row for row in rr.rows if isinstance(row.goal_id, int)]
+        conn.executemany(
+            "insert into goals values (?, ?, ?)",
+            ((row.goal_id, row.name, row.is_open) for row in real),
+        )
+        conn.executemany(
+            "insert into edges values (?, ?, ?)",
+            (
+                (row.goal_id, target, int(edge_type))
+                for row in real
+                for target, edge_type in row.edges
+                if isinstance(target, int)
+            ),
+        )
+        conn.commit()
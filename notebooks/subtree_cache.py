@@ -0,0 +1,388 @@
+"""Content-addressed cache of subtree layouts.
+
+Goal trees often contain big subtrees that rarely change (archived projects,
+templates reused under several parents). Every such subtree is identified by
+a Merkle-style hash: a digest of its goals (names, flags, attributes, but not
+ids) and of the hashes of its children, in edge order. Layout of a subtree is
+stored once, as placements relative to the subtree, and spliced into layouts
+of any graph containing a subtree with the same hash.
+
+Only tree-shaped subtrees are cached: every goal inside (except the top one)
+has exactly one parent, so a subtree can't be reached from outside and may be
+laid out independently.
+
+Splicing: the rest of the graph ("skeleton") is laid out as usual. Then, below
+every skeleton row, rows for subtrees of its goals are inserted. Subtrees are
+packed side by side while they fit into the render width, so edges still go
+down only and the width limit holds.
+
+Blocks are nested where a subtree is reused: a block is laid out from its own
+goals and the blocks below goals whose subtrees occur more often in the graph
+than the block itself (templates under several parents), and keeps only
+references to them. So a template is laid out once however many times it is
+used. The skeleton layout is cached as well.
+"""
+
+import hashlib
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from siebenapp import GoalId, RenderResult, RenderRow, graph_hash
+from render import layout_of, render
+
+# Layout of goals below a top goal: (row, col) of every goal in canonical
+# (preorder) order, rows start from 0
+Placements = list[tuple[int, int]]
+
+
+class LayoutCache:
+    """LRU cache of subtree layouts, bounded by a total amount of placements."""
+
+    def __init__(self, max_goals: int = 100_000):
+        self.max_goals = max_goals
+        self.goals = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[tuple[str, int], "Block"] = OrderedDict()
+
+    def get(self, key: tuple[str, int]) -> Optional["Block"]:
+        block = self._entries.get(key)
+        if block is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return block
+
+    def put(self, key: tuple[str, int], block: "Block") -> None:
+        if key in self._entries or len(block) > self.max_goals:
+            return
+        self._entries[key] = block
+        self.goals += len(block)
+        while self.goals > self.max_goals:
+            _, evicted = self._entries.popitem(last=False)
+            self.goals -= len(evicted)
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "goals": self.goals,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+@dataclass
+class SubtreeInfo:
+    digest: str  # Merkle hash of the goal and everything below it
+    size: int  # amount of goals below, the goal itself is not included
+    tree_shaped: bool
+
+
+def _content(row: RenderRow) -> bytes:
+    return repr(
+        (row.name, row.is_open, row.is_switchable, sorted(row.attrs.items()))
+    ).encode()
+
+
+def subtrees(rr: RenderResult) -> dict[GoalId, SubtreeInfo]:
+    """Merkle hashes and shapes of subtrees under every goal, in O(V + E)."""
+    parents: dict[GoalId, int] = {row.goal_id: 0 for row in rr.rows}
+    for row in rr.rows:
+        for e in row.edges:
+            parents[e[0]] += 1
+    result: dict[GoalId, SubtreeInfo] = {}
+    for row in rr.rows:
+        if row.goal_id in result:
+            continue
+        # Iterative post-order traversal: deep trees don't fit into the stack
+        stack: list[tuple[GoalId, bool]] = [(row.goal_id, False)]
+        while stack:
+            goal_id, children_done = stack.pop()
+            if goal_id in result:
+                continue
+            goal = rr.by_id(goal_id)
+            if not children_done:
+                stack.append((goal_id, True))
+                stack.extend((e[0], False) for e in goal.edges if e[0] not in result)
+                continue
+            h = hashlib.blake2b(_content(goal), digest_size=16)
+            size = 0
+            tree_shaped = True
+            for target, edge_type in goal.edges:
+                child = result[target]
+                h.update(bytes([edge_type]) + child.digest.encode())
+                size += 1 + child.size
+                tree_shaped = tree_shaped and child.tree_shaped and parents[target] == 1
+            result[goal_id] = SubtreeInfo(h.hexdigest(), size, tree_shaped)
+    return result
+
+
+def block_key(rr: RenderResult, info: dict[GoalId, SubtreeInfo], top: GoalId) -> str:
+    """Cache key of everything below `top` (the top goal itself doesn't matter)."""
+    h = hashlib.blake2b(digest_size=16)
+    for target, edge_type in rr.by_id(top).edges:
+        h.update(bytes([edge_type]) + info[target].digest.encode())
+    return h.hexdigest()
+
+
+def block_goals(rr: RenderResult, top: GoalId) -> list[GoalId]:
+    """Goals below `top` in canonical (preorder, edge order) order."""
+    result: list[GoalId] = []
+    stack = [e[0] for e in reversed(rr.by_id(top).edges)]
+    while stack:
+        goal_id = stack.pop()
+        result.append(goal_id)
+        stack.extend(e[0] for e in reversed(rr.by_id(goal_id).edges))
+    return result
+
+
+@dataclass
+class Block:
+    """Cached layout of everything below a goal.
+
+    Goals of nested blocks aren't stored here, only their placement: a block
+    is shared by every block (or graph) containing it.
+    """
+
+    placements: Placements  # own goals, in canonical order
+    # Position (in `placements`) of a goal -> key of the block below it, and
+    # the block's offset
+    nested: dict[int, tuple[str, int, int]]
+    width: int
+    height: int
+
+    def __len__(self) -> int:
+        return len(self.placements)
+
+
+def _own_goals(
+    rr: RenderResult, top: GoalId, keys: dict[GoalId, str], uses: Counter[str]
+) -> tuple[list[GoalId], list[GoalId]]:
+    """Goals below `top` in canonical order, without ones below nested tops,
+    and nested tops: goals whose blocks are used more often than the one below
+    `top`, i.e. not only as a part of it."""
+    limit = uses[keys[top]]
+    goals: list[GoalId] = []
+    tops: list[GoalId] = []
+    stack = [e[0] for e in reversed(rr.by_id(top).edges)]
+    while stack:
+        goal_id = stack.pop()
+        goals.append(goal_id)
+        if goal_id in keys and uses[keys[goal_id]] > limit:
+            tops.append(goal_id)
+        else:
+            stack.extend(e[0] for e in reversed(rr.by_id(goal_id).edges))
+    return goals, tops
+
+
+def _nested_tops(
+    rr: RenderResult, top: GoalId, block: "Block"
+) -> list[tuple[GoalId, str]]:
+    """Goals below `top` where blocks nested in `block` are placed, with keys."""
+    result: list[tuple[GoalId, str]] = []
+    stack = [e[0] for e in reversed(rr.by_id(top).edges)]
+    i = 0
+    while stack:
+        goal_id = stack.pop()
+        if i in block.nested:
+            result.append((goal_id, block.nested[i][0]))
+        else:
+            stack.extend(e[0] for e in reversed(rr.by_id(goal_id).edges))
+        i += 1
+    return result
+
+
+def _skeleton_layout(
+    rr: RenderResult,
+    goals: list[GoalId],
+    tops: set[GoalId],
+    roots: set[GoalId],
+    width: int,
+    cache: Optional[LayoutCache] = None,
+) -> dict[GoalId, tuple[int, int]]:
+    """Layout of `goals`, with edges of `tops` cut. When `cache` is given, it's
+    cached too, so an edit inside a block doesn't lay out the rest again."""
+    rows = [
+        _without_edges(rr.by_id(g)) if g in tops else rr.by_id(g) for g in goals
+    ]
+    skeleton = RenderResult(
+        rows, select=rr.select, node_opts={g: {} for g in goals}, roots=roots
+    )
+    if cache is None:
+        return layout_of(render(skeleton, width))
+    key = (f"skeleton {graph_hash(skeleton)}", width)
+    block = cache.get(key)
+    if block is None:
+        placed = layout_of(render(skeleton, width))
+        block = Block([placed[g] for g in goals], {}, 0, 0)
+        cache.put(key, block)
+    return dict(zip(goals, block.placements))
+
+
+def _splice(
+    placement: dict[GoalId, tuple[int, int]],
+    blocks: dict[GoalId, Block],
+    width: int,
+) -> tuple[dict[GoalId, tuple[int, int]], dict[GoalId, tuple[int, int]]]:
+    """Insert rows for `blocks` below every row of their top goals. Returns new
+    positions of placed goals, and offsets of blocks."""
+    by_row: dict[int, list[GoalId]] = {}
+    for goal_id, (row, _) in placement.items():
+        by_row.setdefault(row, []).append(goal_id)
+    positions: dict[GoalId, tuple[int, int]] = {}
+    offsets: dict[GoalId, tuple[int, int]] = {}
+    offset = 0
+    for row in sorted(by_row):
+        for goal_id in by_row[row]:
+            positions[goal_id] = (row + offset, placement[goal_id][1])
+        # Shelf packing: blocks go side by side while they fit into width
+        shelf_row, shelf_col, shelf_height = row + offset + 1, 0, 0
+        for top in sorted(by_row[row], key=lambda g: placement[g][1]):
+            if top not in blocks:
+                continue
+            block = blocks[top]
+            if shelf_col > 0 and shelf_col + block.width > width:
+                shelf_row += shelf_height
+                offset += shelf_height
+                shelf_col, shelf_height = 0, 0
+            offsets[top] = (shelf_row, shelf_col)
+            shelf_col += block.width
+            shelf_height = max(shelf_height, block.height)
+        offset += shelf_height
+    return positions, offsets
+
+
+def _expand(blocks: dict[str, Block], key: str) -> Placements:
+    """Placements of all goals below a block's top, in canonical order."""
+    result: Placements = []
+    # Blocks being expanded: (block, next position, row and col offsets)
+    stack: list[tuple[Block, int, int, int]] = [(blocks[key], 0, 0, 0)]
+    while stack:
+        block, i, dr, dc = stack.pop()
+        if i == len(block.placements):
+            continue
+        r, c = block.placements[i]
+        result.append((r + dr, c + dc))
+        stack.append((block, i + 1, dr, dc))
+        if i in block.nested:
+            nested_key, r1, c1 = block.nested[i]
+            stack.append((blocks[nested_key], 0, dr + r1, dc + c1))
+    return result
+
+
+def _ensure_blocks(
+    rr: RenderResult,
+    tops: list[GoalId],
+    keys: dict[GoalId, str],
+    uses: Counter[str],
+    width: int,
+    cache: LayoutCache,
+) -> dict[str, Block]:
+    """Blocks below `tops` and every block nested in them, by key, taken from
+    `cache` or laid out (and put there).
+
+    The result holds all blocks in use, so ones evicted from a cache too small
+    for the graph still may be expanded.
+    """
+    result: dict[str, Block] = {}
+    missed: set[str] = set()
+    todo = [(top, keys[top]) for top in tops]
+    while todo:
+        top, key = todo[-1]
+        if key in result:
+            todo.pop()
+            continue
+        if key not in missed:
+            block = cache.get((key, width))
+            if block is not None:
+                result[key] = block
+                todo.pop()
+                # Blocks nested in a cached one may be evicted already
+                todo.extend(_nested_tops(rr, top, block))
+                continue
+            missed.add(key)
+        goals, nested = _own_goals(rr, top, keys, uses)
+        missing = [(g, keys[g]) for g in nested if keys[g] not in result]
+        if missing:
+            # Nested blocks go first
+            todo.extend(missing)
+            continue
+        placement = _skeleton_layout(
+            rr, goals, set(nested), {e[0] for e in rr.by_id(top).edges}, width
+        )
+        nested_blocks = {g: result[keys[g]] for g in nested}
+        positions, offsets = _splice(placement, nested_blocks, width)
+        position_of = {g: i for i, g in enumerate(goals)}
+        # Bottom right corners of own goals and nested blocks
+        corners = list(positions.values()) + [
+            (r + nested_blocks[g].height - 1, c + nested_blocks[g].width - 1)
+            for g, (r, c) in offsets.items()
+        ]
+        block = Block(
+            [positions[g] for g in goals],
+            {position_of[g]: (keys[g], *offsets[g]) for g in nested},
+            1 + max(c for _, c in corners),
+            1 + max(r for r, _ in corners),
+        )
+        cache.put((key, width), block)
+        result[key] = block
+        todo.pop()
+    return result
+
+
+def render_cached(
+    rr: RenderResult, width: int, cache: LayoutCache, min_size: int = 8
+) -> RenderResult:
+    """Render `rr`, taking layouts of tree-shaped subtrees of at least `min_size`
+    goals from `cache` (and putting missing ones there)."""
+    info = subtrees(rr)
+    keys = {
+        row.goal_id: block_key(rr, info, row.goal_id)
+        for row in rr.rows
+        if info[row.goal_id].tree_shaped and info[row.goal_id].size >= min_size
+    }
+    uses = Counter(keys.values())
+
+    # Topmost goals with big enough tree-shaped subtrees below them
+    tops: list[GoalId] = []
+    hidden: set[GoalId] = set()
+    seen: set[GoalId] = set(rr.roots)
+    queue = list(rr.roots)
+    while queue:
+        goal_id = queue.pop()
+        if goal_id in keys:
+            tops.append(goal_id)
+            hidden.update(block_goals(rr, goal_id))
+            continue
+        for e in rr.by_id(goal_id).edges:
+            if e[0] not in seen:
+                seen.add(e[0])
+                queue.append(e[0])
+
+    blocks = _ensure_blocks(rr, tops, keys, uses, width, cache)
+    goals = [row.goal_id for row in rr.rows if row.goal_id not in hidden]
+    placement = _skeleton_layout(rr, goals, set(tops), rr.roots, width, cache)
+    positions, offsets = _splice(
+        placement, {top: blocks[keys[top]] for top in tops}, width
+    )
+    new_opts = {g: {"row": r, "col": c} for g, (r, c) in positions.items()}
+    for top in tops:
+        dr, dc = offsets[top]
+        placements = _expand(blocks, keys[top])
+        for goal_id, (r, c) in zip(block_goals(rr, top), placements):
+            new_opts[goal_id] = {"row": dr + r, "col": dc + c}
+    return RenderResult(rr.rows, node_opts=new_opts, select=rr.select, roots=rr.roots)
+
+
+def _without_edges(row: RenderRow) -> RenderRow:
+    return RenderRow(
+        row.goal_id, row.raw_id, row.name, row.is_open, row.is_switchable, [], row.attrs
+    )
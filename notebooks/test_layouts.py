@@ -0,0 +1,150 @@
+"""Layout invariants and regression cases, run with `python -m pytest notebooks`."""
+
+from random import Random
+
+import pytest
+
+from siebenapp import EdgeType, GoalId, RenderEdit, RenderResult, RenderRow
+from anytime import render_anytime
+from fuzz import random_graph
+from layout_delta import apply_delta, encode_delta
+from lod import ABOVE, collapse
+from render import layout_of, render
+from sieben_random import random_tree
+from subtree_cache import LayoutCache, render_cached
+
+# The fuzz corpus: (seed, size) of `random_graph`, laid out in every width
+CORPUS = [(seed, size) for size in (5, 20, 100, 300) for seed in range(10)]
+WIDTHS = (2, 3, 5)
+
+
+def upward_edges(rr: RenderResult) -> list[tuple[GoalId, GoalId]]:
+    """Edges which don't go at least one row down."""
+    rows = {g: opts["row"] for g, opts in rr.node_opts.items()}
+    return [
+        (row.goal_id, e[0])
+        for row in rr.rows
+        for e in row.edges
+        if rows[e[0]] <= rows[row.goal_id]
+    ]
+
+
+def check_layout(rr: RenderResult, width: int) -> None:
+    assert not upward_edges(rr)
+    placement = layout_of(rr)
+    assert len(set(placement.values())) == len(placement), "goals collide"
+    assert all(0 <= col < width for _, col in placement.values())
+
+
+@pytest.mark.parametrize("seed, size", CORPUS)
+def test_render_invariants(seed, size):
+    rr = random_graph(seed, size)
+    for width in WIDTHS:
+        check_layout(render(rr, width), width)
+
+
+@pytest.mark.parametrize("seed, size", CORPUS)
+def test_fake_goals_keep_edges_down(seed, size):
+    # Fake goals may take more columns than the width, so it isn't checked
+    rr = random_graph(seed, size)
+    for width in WIDTHS:
+        laid_out = render(rr, width, fake_goals=True)
+        assert not upward_edges(laid_out)
+        placement = layout_of(laid_out)
+        assert len(set(placement.values())) == len(placement), "goals collide"
+
+
+@pytest.mark.parametrize("seed, size", CORPUS)
+def test_cached_render_invariants(seed, size):
+    rr = random_graph(seed, size)
+    cache = LayoutCache()
+    for width in WIDTHS:
+        laid_out = render_cached(rr, width, cache)
+        check_layout(laid_out, width)
+        assert render_cached(rr, width, cache).node_opts == laid_out.node_opts
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_anytime_falls_back_to_coarse_layout(seed):
+    rr = random_graph(seed, 300)
+    for width in WIDTHS:
+        result = render_anytime(rr, width, budget=0.0)
+        assert result.coarse
+        check_layout(result.rr, width)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_lod_expansions_keep_edges_down(seed):
+    # Expanding a summary below used to leave other summaries above the new
+    # goals linking to them
+    width = 5
+    c = collapse(random_tree(2000, seed), 3)
+    laid_out = render(c.rr, width)
+    for step in range(12):
+        summaries = sorted(r.goal_id for r in laid_out.rows if r.goal_id in c.groups)
+        below = [s for s in summaries if s != ABOVE]
+        if not below:
+            break
+        laid_out = c.expand(laid_out, below[step * 7 % len(below)], width)
+        check_layout(laid_out, width)
+    if ABOVE in c.groups:
+        check_layout(c.expand(laid_out, ABOVE, width), width)
+
+
+def _edited(rr: RenderResult, rnd: Random, step: int) -> RenderResult:
+    """A copy of `rr` with a random goal added, renamed or selected."""
+    edited = RenderResult(
+        rr.rows, select=rr.select, node_opts=rr.node_opts, roots=rr.roots
+    )
+    goal = rnd.choice(rr.rows)
+    kind = rnd.choice("ars")
+    if kind == "a":
+        new = 10**6 + step
+        edges = goal.edges + [(new, EdgeType.PARENT)]
+        row = RenderRow(new, new, "new", True, True, [])
+        edited.apply(RenderEdit([row], {goal.goal_id: edges}))
+    elif kind == "r":
+        row = RenderRow(
+            goal.goal_id,
+            goal.raw_id,
+            goal.name + "!",
+            not goal.is_open,
+            goal.is_switchable,
+            goal.edges,
+            {"k": "v"},
+        )
+        edited.apply(RenderEdit(replace_rows=[row]))
+    else:
+        edited.select = (goal.goal_id, rr.select[1])
+    return edited
+
+
+@pytest.mark.parametrize("fake_goals", [False, True])
+@pytest.mark.parametrize("seed", range(5))
+def test_delta_reproduces_layout(seed, fake_goals):
+    # Row order used to be lost, so a client differed from the server
+    rnd = Random(seed)
+    source = random_tree(rnd.randint(10, 150), seed)
+    previous = render(source, 5, fake_goals=fake_goals)
+    for step in range(4):
+        source = _edited(source, rnd, step)
+        current = render(source, 5, fake_goals=fake_goals, previous=previous)
+        client = RenderResult(
+            previous.rows,
+            select=previous.select,
+            node_opts=previous.node_opts,
+            roots=previous.roots,
+        )
+        apply_delta(client, encode_delta(previous, current))
+        assert client == current
+        previous = current
+
+
+def test_edit_doesnt_change_laid_out_source():
+    laid_out = render(random_tree(50, 1), 4)
+    before = layout_of(laid_out)
+    edited = RenderResult(laid_out.rows, node_opts=laid_out.node_opts)
+    goal_id = laid_out.rows[3].goal_id
+    edited.apply(RenderEdit(node_opts={goal_id: {"row": 99, "col": 0}}))
+    assert layout_of(laid_out) == before
+    assert layout_of(edited)[goal_id] == (99, 0)
@@ -0,0 +1,137 @@
+"""Vertical adjustment with spring forces (parts 5 and 6), as an array solver.
+
+Every edge is a spring with the rest length of 1 row, stronger for parent
+edges than for blockers. Rows are relaxed as floats: on every iteration, forces
+of all edges are computed at once and summed per goal with `np.bincount`, and
+goals move with damped velocities.
+
+As part 5 noted, a goal can't move between full rows for free, it has to
+exchange places with another one. So relaxed rows are used as an order only:
+goals are packed by it (see `virtual_layers.place_rows`), which keeps every
+edge going down and every row within the width limit. Packing is a heap pass
+in Python, so it's made only every `legalize_every` sweeps and after the last
+one. In between, relaxed rows are only kept at or below virtual layers, with
+arrays.
+
+Packing may bounce between several layouts, so the best one (by spring
+energy) is returned instead of the last one.
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+
+from siebenapp import EdgeType, GoalId, RenderResult
+from compact import CompactGraph
+from render import tweak_horizontal
+from virtual_layers import UNREACHABLE, layout_rows, place_rows, virtual_layers
+
+# Spring strengths from part 5
+STRENGTH = {EdgeType.PARENT: 1.0, EdgeType.BLOCKER: 0.6}
+
+
+@dataclass
+class VerticalResult:
+    rows: np.ndarray
+    energy: float
+    iterations: int
+    converged: bool
+
+
+def strengths(g: CompactGraph) -> np.ndarray:
+    result = np.empty(g.num_edges)
+    for edge_type, k in STRENGTH.items():
+        result[g.edge_types == edge_type] = k
+    return result
+
+
+def energy(g: CompactGraph, rows: np.ndarray, k: np.ndarray) -> float:
+    """Total potential energy of springs, `E = k * x^2 / 2` for every edge."""
+    sources = g.sources()
+    placed = rows[sources] != UNREACHABLE
+    stretch = rows[g.targets[placed]] - rows[sources[placed]] - 1.0
+    return float((k[placed] * stretch * stretch).sum() / 2)
+
+
+def solve_vertical(
+    g: CompactGraph,
+    rows: np.ndarray,
+    width: int,
+    damping: float = 0.3,
+    step: float = 0.5,
+    tolerance: float = 0.01,
+    max_iterations: int = 100,
+    legalize_every: int = 10,
+) -> VerticalResult:
+    """Relax valid `rows` (UNREACHABLE for goals not to be placed)."""
+    layers = virtual_layers(g)
+    k = strengths(g)
+    placed = (rows != UNREACHABLE) & (layers != UNREACHABLE)
+    sources = g.sources()
+    active = placed[sources]
+    sources, targets, k_active = sources[active], g.targets[active], k[active]
+    # Moving by `net / stiffness` puts a goal into its own equilibrium
+    stiffness = np.bincount(sources, k_active, g.size) + np.bincount(
+        targets, k_active, g.size
+    )
+    stiffness[stiffness == 0] = 1.0
+
+    best, best_energy = rows, energy(g, rows, k)
+
+    def legalize(y: np.ndarray) -> None:
+        # Relaxed rows only order goals, constraints decide the actual rows
+        nonlocal best, best_energy
+        projected = place_rows(g, layers, width, y)
+        projected[~placed] = UNREACHABLE
+        current = energy(g, projected, k)
+        if current < best_energy:
+            best, best_energy = projected, current
+
+    y = np.where(placed, rows, 0).astype(np.float64)
+    velocity = np.zeros(g.size)
+    for iteration in range(1, max_iterations + 1):
+        # Positive force pulls the source down and the target up
+        forces = k_active * (y[targets] - y[sources] - 1.0)
+        net = np.bincount(sources, forces, g.size) - np.bincount(
+            targets, forces, g.size
+        )
+        velocity = np.where(placed, damping * velocity + step * net / stiffness, 0)
+        # No goal can get above its virtual layer
+        moved = np.maximum(y + velocity, layers)
+        velocity = np.where(placed, moved - y, 0)
+        y = np.where(placed, moved, 0)
+        converged = np.abs(velocity).max(initial=0.0) < tolerance
+        if converged or iteration == max_iterations or iteration % legalize_every == 0:
+            legalize(y)
+        if converged:
+            return VerticalResult(best, best_energy, iteration, True)
+    return VerticalResult(best, best_energy, max_iterations, False)
+
+
+def adjust_vertical(rr: RenderResult, width: int, **kwargs) -> RenderResult:
+    """Move goals of a laid out `rr` between rows, keeping their col order."""
+    g = CompactGraph.from_result(rr)
+    opts = [rr.node_opts.get(goal_id, {}) for goal_id in g.index]
+    rows = np.array([o.get("row", UNREACHABLE) for o in opts], np.int32)
+    solved = solve_vertical(g, rows, width, **kwargs).rows
+    by_row: dict[int, list[tuple[float, int]]] = {}
+    for number, row in enumerate(solved.tolist()):
+        if row != UNREACHABLE:
+            by_row.setdefault(row, []).append((opts[number]["col"], number))
+    new_opts: dict[GoalId, dict] = {}
+    for row, goals in by_row.items():
+        for col, (_, number) in enumerate(sorted(goals)):
+            goal_id = g.index.goal_id(number)
+            new_opts[goal_id] = rr.node_opts[goal_id] | {"row": row, "col": col}
+    return RenderResult(rr.rows, node_opts=new_opts, select=rr.select, roots=rr.roots)
+
+
+def render_vertical(rr: RenderResult, width: int, **kwargs) -> RenderResult:
+    """Virtual layers, vertical relaxation, then the usual horizontal stage."""
+    g = CompactGraph.from_result(rr)
+    rows = place_rows(g, virtual_layers(g), width)
+    rows = solve_vertical(g, rows, width, **kwargs).rows
+    placed = RenderResult(
+        rr.rows, node_opts=layout_rows(g, rows), select=rr.select, roots=rr.roots
+    )
+    return tweak_horizontal(placed, width)
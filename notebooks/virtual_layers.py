@@ -0,0 +1,137 @@
+"""Virtual layers from part 11, as a pipeline stage on a `CompactGraph`.
+
+A virtual layer of a goal is the length of the longest path to it from roots:
+roots get 0, and every goal is placed at least 1 layer below all its parents.
+Part 11 computed them with repeated relaxations over dicts. Here, they are
+computed by a level-synchronous topological sort (Kahn's algorithm): a goal
+becomes ready when its last parent is processed, and the iteration where it
+happens is its longest path length. Each edge is visited once.
+
+Then the width limit is applied on top of virtual layers: goals are taken in
+virtual layer order, and every goal is put into the first row below all its
+parents which still has room. Unlike part 11, goals of different virtual
+layers may share a row, so the result is not less dense than needed.
+"""
+
+import heapq
+from typing import Optional
+
+import numpy as np
+
+from siebenapp import GoalId, RenderResult
+from compact import CompactGraph
+from render import tweak_horizontal
+
+# Virtual layer of goals not reachable from roots
+UNREACHABLE = -1
+
+
+def virtual_layers(g: CompactGraph) -> np.ndarray:
+    """Longest path length from roots for every goal (or UNREACHABLE)."""
+    reachable = g.reachable()
+    sources = g.sources()
+    counted = reachable[sources]
+    waiting = np.bincount(g.targets[counted], minlength=g.size).astype(np.int64)
+    layers = np.full(g.size, UNREACHABLE, np.int32)
+    frontier = np.flatnonzero(reachable & (waiting == 0))
+    layer = 0
+    while len(frontier):
+        layers[frontier] = layer
+        targets = g.targets[g.edges_of(frontier)]
+        np.subtract.at(waiting, targets, 1)
+        candidates = np.unique(targets)
+        frontier = candidates[waiting[candidates] == 0]
+        layer += 1
+    return layers
+
+
+def check_virtual_layers(g: CompactGraph, layers: np.ndarray) -> np.ndarray:
+    """Positions of edges that don't go down at least 1 layer, in O(E)."""
+    sources = g.sources()
+    placed = layers[sources] != UNREACHABLE
+    wrong = layers[g.targets] <= layers[sources]
+    return np.flatnonzero(placed & wrong)
+
+
+def place_rows(
+    g: CompactGraph,
+    layers: np.ndarray,
+    width: int,
+    priority: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Apply the width limit: a row for every goal (UNREACHABLE ones stay so).
+
+    Goals are taken when all their parents are placed, by `priority` (smaller
+    first, virtual layers by default), and put into the first row below all
+    their parents which still has room."""
+    order = (layers if priority is None else priority).tolist()
+    offsets = g.offsets.tolist()
+    targets = g.targets.tolist()
+    layer_of = layers.tolist()
+    waiting = [0] * g.size
+    for number, layer in enumerate(layer_of):
+        if layer != UNREACHABLE:
+            for child in targets[offsets[number] : offsets[number + 1]]:
+                waiting[child] += 1
+    ready = [
+        (order[n], layer, n)
+        for n, layer in enumerate(layer_of)
+        if layer != UNREACHABLE and not waiting[n]
+    ]
+    heapq.heapify(ready)
+
+    earliest = [0] * g.size
+    rows = np.full(g.size, UNREACHABLE, np.int32)
+    used: list[int] = []
+    # Next row that may have room, with path compression (like union-find)
+    next_free: list[int] = []
+
+    def free_row(row: int) -> int:
+        path = []
+        while row < len(next_free) and next_free[row] != row:
+            path.append(row)
+            row = next_free[row]
+        for r in path:
+            next_free[r] = row
+        return row
+
+    while ready:
+        _, _, number = heapq.heappop(ready)
+        row = free_row(earliest[number])
+        while row >= len(used):
+            used.append(0)
+            next_free.append(len(next_free))
+        rows[number] = row
+        used[row] += 1
+        if used[row] == width:
+            next_free[row] = row + 1
+        for child in targets[offsets[number] : offsets[number + 1]]:
+            if earliest[child] <= row:
+                earliest[child] = row + 1
+            waiting[child] -= 1
+            if not waiting[child]:
+                key = (order[child], layer_of[child], child)
+                heapq.heappush(ready, key)
+    return rows
+
+
+def layout_rows(g: CompactGraph, rows: np.ndarray) -> dict[GoalId, dict]:
+    """Node options with rows, and cols in order of numbers within a row."""
+    result: dict[GoalId, dict] = {}
+    cols: dict[int, int] = {}
+    for number, row in enumerate(rows.tolist()):
+        if row != UNREACHABLE:
+            col = cols.get(row, 0)
+            cols[row] = col + 1
+            result[g.index.goal_id(number)] = {"row": row, "col": col}
+    return result
+
+
+def render_virtual(rr: RenderResult, width: int) -> RenderResult:
+    """Whole pipeline with virtual layers instead of step-by-step `tube`."""
+    g = CompactGraph.from_result(rr)
+    rows = place_rows(g, virtual_layers(g), width)
+    placed = RenderResult(
+        rr.rows, node_opts=layout_rows(g, rows), select=rr.select, roots=rr.roots
+    )
+    return tweak_horizontal(placed, width)
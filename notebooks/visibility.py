@@ -0,0 +1,259 @@
+"""Pre-layout filtering: which goals are visible, as a mask over `CompactGraph`.
+
+A view shows goals reachable from its roots (a focus goal, or roots of the
+whole graph), optionally without closed goals and without any other goals
+from a `hidden` mask. Reachability goes through hidden goals too: a visible
+goal below a hidden one stays visible, and gets a reconnecting BLOCKER edge
+from every visible goal above it that reaches it only through hidden goals
+(so it's still drawn below them), unless another path through visible goals
+connects them already. Goals without visible parents become roots.
+Unlike `sqlite_loader`, which drops goals reachable only through closed ones,
+nothing reachable is lost here.
+
+Everything is computed with arrays. `Visible` itself is a view of the source
+graph: masks over its goals and edges, plus reconnecting edges. Building a
+layout input from it is not zero-copy: `Visible.result` makes a new rows list
+and new rows for goals which lose or get edges (rows of other goals and their
+options are shared), and `Visible.compact` builds new CSR arrays. Both take
+memory proportional to the visible part, not to the whole graph.
+"""
+
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import numpy as np
+
+from siebenapp import EdgeType, GoalIndex, RenderResult, RenderRow
+from compact import CompactGraph
+
+
+@dataclass
+class Visible:
+    g: CompactGraph  # the whole graph
+    mask: np.ndarray  # bool, visible goals
+    kept: np.ndarray  # bool, edges of `g` between visible goals
+    # Edges reconnected across hidden goals (numbers in `g`), all BLOCKERs
+    extra_sources: np.ndarray
+    extra_targets: np.ndarray
+    roots: np.ndarray  # numbers in `g`
+
+    @property
+    def size(self) -> int:
+        return int(np.count_nonzero(self.mask))
+
+    def compact(self) -> CompactGraph:
+        """Visible goals as a graph of their own, numbered in the same order.
+
+        Arrays are copies: edges of the visible part, sorted by sources.
+        """
+        numbers = np.flatnonzero(self.mask)
+        renumber = np.full(self.g.size, -1, np.int64)
+        renumber[numbers] = np.arange(len(numbers))
+        sources = np.concatenate([self.g.sources()[self.kept], self.extra_sources])
+        targets = np.concatenate([self.g.targets[self.kept], self.extra_targets])
+        types = np.concatenate(
+            [
+                self.g.edge_types[self.kept],
+                np.full(len(self.extra_targets), EdgeType.BLOCKER, np.int8),
+            ]
+        )
+        # Original edges go first among edges of a goal, keeping their order
+        order = np.argsort(sources, kind="stable")
+        offsets = np.zeros(len(numbers) + 1, np.int64)
+        np.cumsum(
+            np.bincount(renumber[sources], minlength=len(numbers)), out=offsets[1:]
+        )
+        ids = self.g.index.ids
+        return CompactGraph(
+            GoalIndex(ids[n] for n in numbers.tolist()),
+            offsets,
+            renumber[targets[order]].astype(np.int32),
+            types[order],
+            self.g.is_open[numbers],
+            self.g.is_switchable[numbers],
+            renumber[self.roots].astype(np.int32),
+        )
+
+    def result(self, rr: RenderResult) -> RenderResult:
+        """Visible goals of `rr` (the graph `g` was built from), ready for layout.
+
+        Rows of goals which keep all their edges are the rows of `rr`, other
+        rows (and the rows list, options dict and roots) are new.
+        """
+        ids = self.g.index.ids
+        numbers = np.flatnonzero(self.mask).tolist()
+        # Goals which lose an edge or get a reconnected one need new rows
+        lost = self.g.sources()[~self.kept]
+        changed = np.zeros(self.g.size, bool)
+        changed[lost] = True
+        changed[self.extra_sources] = True
+        changed_rows = changed.tolist()
+        extra: dict[int, list[int]] = {}
+        for s, t in zip(self.extra_sources.tolist(), self.extra_targets.tolist()):
+            extra.setdefault(s, []).append(t)
+        # Goal numbers of `g` are positions of rows in `rr`
+        source_rows = rr.rows
+        visible = self.mask.tolist()
+        index = self.g.index.numbers
+        rows = []
+        for n in numbers:
+            row = source_rows[n]
+            if changed_rows[n]:
+                edges = [e for e in row.edges if visible[index[e[0]]]]
+                edges.extend((ids[t], EdgeType.BLOCKER) for t in extra.get(n, []))
+                row = RenderRow(
+                    row.goal_id,
+                    row.raw_id,
+                    row.name,
+                    row.is_open,
+                    row.is_switchable,
+                    edges,
+                    row.attrs,
+                )
+            rows.append(row)
+        opts = rr.node_opts
+        node_opts = {row.goal_id: opts.get(row.goal_id, {}) for row in rows}
+        select = rr.select if rr.select[0] in node_opts else None
+        roots = {ids[n] for n in self.roots.tolist()}
+        return RenderResult(rows, select=select, node_opts=node_opts, roots=roots)
+
+
+def _reconnect(
+    g: CompactGraph, visible: np.ndarray, scope: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Pairs of visible goals (u, v) connected only through hidden goals.
+
+    Pairs (visible source, hidden goal on a path) are walked down together,
+    level by level, until they meet visible goals.
+    """
+    size = np.int64(g.size)
+    sources = g.sources()
+    hidden = scope & ~visible
+    first = visible[sources] & hidden[g.targets]
+    pairs_u = sources[first].astype(np.int64)
+    pairs_h = g.targets[first].astype(np.int64)
+    seen = np.unique(pairs_u * size + pairs_h)
+    found: list[np.ndarray] = []
+    while len(seen) and len(pairs_u):
+        positions = g.edges_of(pairs_h)
+        counts = g.offsets[pairs_h + 1] - g.offsets[pairs_h]
+        u = np.repeat(pairs_u, counts)
+        t = g.targets[positions].astype(np.int64)
+        found.append(u[visible[t]] * size + t[visible[t]])
+        keys = np.unique(u[hidden[t]] * size + t[hidden[t]])
+        keys = keys[~np.isin(keys, seen, assume_unique=True)]
+        seen = np.union1d(seen, keys)
+        pairs_u, pairs_h = keys // size, keys % size
+    if not found:
+        return np.zeros(0, np.int32), np.zeros(0, np.int32)
+    keys = np.unique(np.concatenate(found))
+    # Pairs which are connected directly too don't need another edge
+    direct = sources.astype(np.int64) * size + g.targets
+    keys = keys[~np.isin(keys, direct)]
+    return (keys // size).astype(np.int32), (keys % size).astype(np.int32)
+
+
+def _implied(
+    children: list[list[int]], starts: list[int], sources: list[int], targets: list[int]
+) -> np.ndarray:
+    """Mask of edges (sources, targets) of a graph (`children` of every goal)
+    which longer paths imply.
+
+    Goals are visited in DFS post-order from `starts`, so children go first,
+    and every goal gets a bitset (Python int, a bit per distinct target) of
+    targets below it, dropped once all parents of its goal are visited. An
+    edge is implied when its target is below another child of its source.
+    """
+    order: list[int] = []
+    done = bytearray(len(children))
+    for start in starts:
+        if done[start]:
+            continue
+        done[start] = 1
+        stack = [(start, iter(children[start]))]
+        while stack:
+            goal, rest = stack[-1]
+            for c in rest:
+                if not done[c]:
+                    done[c] = 1
+                    stack.append((c, iter(children[c])))
+                    break
+            else:
+                stack.pop()
+                order.append(goal)
+    is_target = bytearray(len(children))
+    for t in targets:
+        is_target[t] = 1
+    bits = [0] * len(children)
+    rank = 0
+    for goal in order:
+        if is_target[goal]:
+            bits[goal] = 1 << rank
+            rank += 1
+    waiting = [0] * len(children)
+    for goal in order:
+        for c in children[goal]:
+            waiting[c] += 1
+    wanted: dict[int, list[int]] = {}
+    for i, s in enumerate(sources):
+        wanted.setdefault(s, []).append(i)
+    result = np.zeros(len(sources), bool)
+    below: dict[int, int] = {}
+    for goal in order:
+        strictly = 0
+        with_children = 0
+        for c in children[goal]:
+            reach = below[c]
+            strictly |= reach
+            with_children |= reach | bits[c]
+            waiting[c] -= 1
+            if not waiting[c]:
+                del below[c]
+        for i in wanted.get(goal, ()):
+            result[i] = bool(strictly & bits[targets[i]])
+        if waiting[goal]:
+            below[goal] = with_children
+    return result
+
+
+def filter_goals(
+    g: CompactGraph,
+    roots: Optional[Iterable[int]] = None,
+    only_open: bool = False,
+    hidden: Optional[np.ndarray] = None,
+) -> Visible:
+    """Visible goals of `g` reachable from `roots` numbers (roots of `g` by
+    default), without closed ones (with `only_open`) and `hidden` ones."""
+    start = g.roots if roots is None else np.array(list(roots), np.int32)
+    scope = g.reachable(start)
+    visible = scope.copy()
+    if only_open:
+        visible &= g.is_open
+    if hidden is not None:
+        visible &= ~hidden
+    sources = g.sources()
+    kept = visible[sources] & visible[g.targets]
+    extra_sources, extra_targets = _reconnect(g, visible, scope)
+    has_parents = np.zeros(g.size, bool)
+    has_parents[g.targets[kept]] = True
+    has_parents[extra_targets] = True
+    new_roots = np.flatnonzero(visible & ~has_parents).astype(np.int32)
+    # Roots which are still visible keep their order
+    order = {n: i for i, n in enumerate(start.tolist())}
+    new_roots = np.array(
+        sorted(new_roots.tolist(), key=lambda n: (order.get(n, len(order)), n)),
+        np.int32,
+    )
+    if len(extra_sources):
+        # Reconnected edges implied by other visible paths are dropped. Such a
+        # path goes through another visible parent of a target, so roots stay
+        children: list[list[int]] = [[] for _ in range(g.size)]
+        for s, t in zip(sources[kept].tolist(), g.targets[kept].tolist()):
+            children[s].append(t)
+        extra = (extra_sources.tolist(), extra_targets.tolist())
+        for s, t in zip(*extra):
+            children[s].append(t)
+        implied = _implied(children, new_roots.tolist(), *extra)
+        extra_sources = extra_sources[~implied]
+        extra_targets = extra_targets[~implied]
+    return Visible(g, visible, kept, extra_sources, extra_targets, new_roots)